@@ -7,18 +7,29 @@ import sys
 import time
 from urllib.parse import quote
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 
 # --- 导入模块 ---
 # 注意：不要导入 TOKEN，它应该通过 load_config() 动态获取
-from modules.config import load_config, save_config, is_owner, CONFIG_FILE
+from modules.config import load_config, save_config, flush_config, is_owner, CONFIG_FILE
 from modules.utils import (
     get_local_ip, get_all_ips, get_env_report, scan_local_audio, scan_local_images, 
     format_size, run_shell_command, run_speedtest_sync, check_port_open
 )
-from modules.alist import get_alist_pid, fix_alist_config, alist_list_files, mount_local_storage
+from modules.alist import get_alist_pid, fix_alist_config, get_alist_listing, mount_local_storage, prefetch_alist_link
+from modules.alist_client import close_alist_client
+from modules.proxy import read_ahead_proxy
+from modules.recorder import list_recordings, run_retention
+from modules.calibrate import run_calibration, calibration_text, is_calibrating, CalibrationBusy
+from modules.pretranscode import pretranscode_queue
+from modules.prepared import prepared_catalog
+from modules.media import media_info_store, alist_media_key, media_summary
+from modules.prefetch import schedule_prefetch
+from modules.search import search_index
 from modules.cloudflared import get_cloudflared_pid, start_cloudflared, stop_cloudflared, get_cloudflared_log
-from modules.stream import run_ffmpeg_stream, stop_ffmpeg_process, get_stream_status, get_log_content, kill_zombie_processes
+from modules.stream import run_ffmpeg_stream, stop_ffmpeg_process, get_stream_status, get_log_content, kill_zombie_processes, stream_manager
+from modules.playlist import playlist_channel, set_playlist_loop
 from modules.downloader import aria2_download_task, get_active_downloads
 from modules.keyboards import (
     get_main_menu_keyboard,
@@ -28,7 +39,9 @@ from modules.keyboards import (
     get_keys_management_keyboard,
     get_alist_browser_keyboard,
     get_alist_file_actions_keyboard,
-    get_download_menu_keyboard
+    get_download_menu_keyboard,
+    get_stream_sessions_keyboard,
+    ALIST_PAGE_SIZE
 )
 
 # 配置日志
@@ -87,8 +100,18 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📘 **Termux Bot 帮助文档**\n\n"
         "🎮 **基础指令**:\n"
         "• `/start` - 呼出底部菜单\n"
-        "• `/stopstream` - 强制停止推流\n"
+        "• `/stream [@密钥名] <链接>` - 使用指定密钥推流\n"
+        "• `/stream @密钥A,密钥B|@all <链接>` - 编码一次同时推到多个密钥\n"
+        "• `/stream --loop [@密钥名] <链接>` - 无限循环播放 (转码只做第一遍)\n"
+        "• `/streams` - 查看所有推流会话\n"
+        "• `/queue add|list|skip|clear|loop` - 无缝播放列表\n"
+        "• `/recordings [on|off]` - 推流录像列表 / 开关\n"
+        "• `/calibrate [off]` - 测试本机编码能力并设为默认画质\n"
+        "• `/prepare [路径|clear]` - 空闲时预转码，推流时直接封装\n"
+        "• `/stopstream [ID]` - 停止推流 (多路时可选择)\n"
         "• `/speedtest` - 网络测速\n"
+        "• `/find <关键词>` - 搜索 Alist 文件\n"
+        "• `/reindex` - 立即更新搜索索引\n"
         "• `/cmd <命令>` - 执行 Termux 命令\n\n"
         "⚙️ **配置指令**:\n"
         "• `/settoken <Token>` - 修改 Bot Token\n"
@@ -189,24 +212,19 @@ async def speedtest_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await status_msg.edit_text(f"📊 **测速结果**\n\n{result}")
 
 # --- Alist 浏览逻辑核心 ---
-async def update_alist_browser(query, context, path, page=0):
+async def update_alist_browser(query, context, path, page=0, refresh=False):
     """刷新文件浏览消息"""
-    # 检查是否是同一路径的翻页操作 (使用缓存)
-    cached_path = context.user_data.get('alist_path')
-    cached_items = context.user_data.get('alist_items')
-    
-    if path == cached_path and cached_items:
-        items = cached_items
-    else:
-        success, items = alist_list_files(path)
-        if not success:
-            await query.answer(f"❌ 读取失败: {items}", show_alert=True)
-            return
-        context.user_data['alist_path'] = path
-        context.user_data['alist_items'] = items
+    # 按页向 Alist 请求，页面由共享缓存提供，前进/后退不会重复请求
+    success, listing = await get_alist_listing(path, page=page + 1, per_page=ALIST_PAGE_SIZE, refresh=refresh)
+    if not success:
+        await query.answer(f"❌ 读取失败: {listing}", show_alert=True)
+        return
+    # 只保存当前页的精简条目，alist_go 使用页内索引
+    context.user_data['alist_path'] = path
+    context.user_data['alist_page'] = page
+    context.user_data['alist_items'] = listing.entries
 
-    # 排序并生成键盘
-    keyboard = get_alist_browser_keyboard(path, items, page=page)
+    keyboard = get_alist_browser_keyboard(listing)
     
     try:
         await query.edit_message_text(
@@ -218,7 +236,15 @@ async def update_alist_browser(query, context, path, page=0):
         # 消息未变动时忽略错误
         pass
 
+    # 用户查看当前页时，后台预取下一页和前几个子目录
+    schedule_prefetch(path, page + 1, listing, ALIST_PAGE_SIZE)
+
 # --- 回调处理 (Inline Buttons) ---
+async def cached_media_line(path, size, modified):
+    """文件菜单中显示已缓存的媒体信息 (不触发探测)，没有记录时返回空字符串"""
+    summary = media_summary(await media_info_store.get(alist_media_key(path, size, modified)))
+    return f"🎞 `{summary}`\n" if summary else ""
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
@@ -271,20 +297,26 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             if 0 <= idx < len(items):
                 target = items[idx]
-                if target['is_dir']:
+                if target.is_dir:
                     # 进入目录
-                    new_path = os.path.join(current_path, target['name']).replace("\\", "/")
+                    new_path = os.path.join(current_path, target.name).replace("\\", "/")
                     await update_alist_browser(query, context, new_path, page=0)
                 else:
                     # 选中文件
                     context.user_data['alist_selected_file'] = target
-                    context.user_data['alist_selected_path'] = os.path.join(current_path, target['name']).replace("\\", "/")
+                    context.user_data['alist_selected_path'] = os.path.join(current_path, target.name).replace("\\", "/")
+                    # 预先解析真实链接，缩短推流启动时间
+                    prefetch_alist_link(context.user_data['alist_selected_path'])
                     
-                    size_str = format_size(target['size'])
+                    size_str = format_size(target.size)
+                    media_line = await cached_media_line(
+                        context.user_data['alist_selected_path'], target.size, target.modified
+                    )
                     text = (
                         f"📄 **文件操作**\n\n"
-                        f"文件名: `{target['name']}`\n"
-                        f"大小: {size_str}\n\n"
+                        f"文件名: `{target.name}`\n"
+                        f"大小: {size_str}\n"
+                        f"{media_line}\n"
                         "请选择操作："
                     )
                     await query.edit_message_text(text, reply_markup=get_alist_file_actions_keyboard(), parse_mode='Markdown')
@@ -312,10 +344,48 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.answer("已经是根目录了", show_alert=True)
 
+    elif data.startswith("find_go:"):
+        # 搜索结果：目录直接打开浏览器，文件进入操作菜单
+        try:
+            idx = int(data.split(":")[1])
+            results = context.user_data.get('find_results', [])
+            if not 0 <= idx < len(results):
+                await query.answer("❌ 结果已过期，请重新搜索", show_alert=True)
+                return
+            target = results[idx]
+            if target['is_dir']:
+                await update_alist_browser(query, context, target['path'], page=0)
+                return
+
+            parent = os.path.dirname(target['path']) or "/"
+            context.user_data['alist_path'] = parent
+            context.user_data['alist_page'] = 0
+            context.user_data['alist_selected_path'] = target['path']
+            prefetch_alist_link(target['path'])
+
+            text = (
+                f"📄 **文件操作**\n\n"
+                f"文件名: `{target['name']}`\n"
+                f"路径: `{target['path']}`\n"
+                f"大小: {format_size(target['size'])}\n"
+                f"{await cached_media_line(target['path'], target['size'], target['modified'])}\n"
+                "请选择操作："
+            )
+            await query.edit_message_text(text, reply_markup=get_alist_file_actions_keyboard(), parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"Find error: {e}")
+            await query.answer("❌ 打开失败", show_alert=True)
+
+    elif data == "alist_refresh":
+        # 跳过缓存重新读取当前目录
+        path = context.user_data.get('alist_path', "/")
+        await update_alist_browser(query, context, path, page=0, refresh=True)
+
     elif data == "alist_act_back":
-        # 返回当前目录列表 (重置为第一页)
+        # 返回文件所在的目录页
         path = context.user_data.get('alist_path', "/")
-        await update_alist_browser(query, context, path, page=0)
+        page = context.user_data.get('alist_page', 0)
+        await update_alist_browser(query, context, path, page=page)
 
     elif data == "alist_act_stream":
         # Alist 推流
@@ -343,6 +413,14 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("🚀 已添加到后台下载队列", parse_mode='Markdown')
         asyncio.create_task(aria2_download_task(full_url, context, user_id))
         
+    elif data == "alist_act_prepare":
+        file_path = context.user_data.get('alist_selected_path')
+        if not file_path:
+            await query.answer("❌ 文件信息丢失", show_alert=True)
+            return
+        ok, msg = await pretranscode_queue.add(file_path)
+        await query.answer(("📦 " if ok else "❌ ") + msg, show_alert=True)
+
     elif data == "btn_check_downloads":
         tasks = get_active_downloads()
         if not tasks:
@@ -621,7 +699,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data.startswith("delete_key_"):
         idx = int(data.split("_")[-1])
         config = load_config()
-        keys = config.get('stream_keys', [])
+        # 配置快照为只读，复制后再修改
+        keys = [dict(k) for k in config.get('stream_keys', [])]
         if 0 <= idx < len(keys):
             del keys[idx]
             active_index = config.get('active_key_index', 0)
@@ -637,8 +716,25 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['state'] = 'waiting_server'
         await query.message.reply_text("✍️ **配置 RTMP 服务器**\n\n请输入完整的 rtmp:// 地址 (回复 `cancel` 取消)：", reply_markup=get_back_keyboard("settings"))
         
-    elif data == "btn_view_log":
-        log_content = get_log_content()
+    elif data.startswith("btn_stream_stats:"):
+        sess = stream_manager.get(data.split(":", 1)[1])
+        if sess is None:
+            await query.answer("⚠️ 该推流已结束", show_alert=True)
+            return
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 刷新", callback_data=data)],
+            [InlineKeyboardButton("📜 实时日志", callback_data=f"btn_view_log:{sess.id}")],
+            [InlineKeyboardButton("🛑 停止推流", callback_data=f"btn_stop_stream_quick:{sess.id}")]
+        ])
+        try:
+            await query.edit_message_text(sess.status_text(), reply_markup=keyboard)
+        except BadRequest:
+            # 内容未变化
+            await query.answer("数据未变化")
+
+    elif data == "btn_view_log" or data.startswith("btn_view_log:"):
+        session_id = data.split(":", 1)[1] if ":" in data else None
+        log_content = get_log_content(3000, session_id=session_id)
         if len(log_content) > 3000: log_content = "..." + log_content[-3000:]
         
         # 添加下载日志按钮
@@ -649,7 +745,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await context.bot.send_message(
             chat_id=user_id, 
-            text=f"📜 **实时日志** (后3000字符):\n\n```\n{log_content}\n```", 
+            text=f"📜 **实时日志{' #' + session_id if session_id else ''}** (后3000字符):\n\n```\n{log_content}\n```", 
             parse_mode='Markdown',
             reply_markup=keyboard
         )
@@ -668,11 +764,28 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
              await query.answer("✅ 日志已发送")
         
-    elif data == "btn_stop_stream_quick":
-        if stop_ffmpeg_process():
-            await query.message.reply_text("🛑 **已成功停止推流**")
+    elif data.startswith("rec_send:"):
+        recordings = context.user_data.get('recordings', [])
+        idx = int(data.split(":")[1])
+        if not 0 <= idx < len(recordings) or not os.path.exists(recordings[idx]):
+            await query.answer("❌ 录像已不存在，请重新查看列表", show_alert=True)
+            return
+        path = recordings[idx]
+        if os.path.getsize(path) > TELEGRAM_UPLOAD_LIMIT:
+            await query.answer("⚠️ 文件超过 50MB，无法通过 Telegram 发送", show_alert=True)
+            return
+        await query.answer("📤 正在发送...")
+        with open(path, "rb") as f:
+            await context.bot.send_document(chat_id=user_id, document=f, caption=f"📼 {os.path.basename(path)}")
+
+    elif data == "btn_stop_stream_quick" or data.startswith("btn_stop_stream_quick:"):
+        # 按钮中带会话 ID 时只停止该会话，旧按钮或 all 停止全部
+        session_id = data.split(":", 1)[1] if ":" in data else "all"
+        if await stop_ffmpeg_process(None if session_id == "all" else session_id):
+            label = "全部推流" if session_id == "all" else f"推流 #{session_id}"
+            await query.message.reply_text(f"🛑 **已成功停止{label}**", parse_mode='Markdown')
         else:
-            await query.answer("⚠️ 当前没有运行中的推流", show_alert=True)
+            await query.answer("⚠️ 该推流已不在运行", show_alert=True)
 
 
 # --- 消息/菜单指令处理 ---
@@ -685,10 +798,7 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- 全局菜单命令匹配 ---
     if text == "🛑 停止推流":
         context.user_data['state'] = None
-        if stop_ffmpeg_process():
-            await update.message.reply_text("🛑 已停止推流")
-        else:
-            await update.message.reply_text("⚠️ 当前没有推流任务")
+        await stop_stream_cmd(update, context)
         return
 
     if text == "📊 状态监控":
@@ -717,6 +827,8 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 强制保存配置，防止覆盖时丢失
         curr_config = load_config()
         save_config({'token': curr_config['token'], 'owner_id': curr_config['owner_id']})
+        # setup.sh 会备份配置文件，先确保延迟写入已落盘
+        flush_config()
         
         # 使用 --force 参数确保即使 hash 一样也重装依赖和重启
         subprocess.Popen("nohup bash setup.sh --force > logs/update_trigger.log 2>&1 &", shell=True)
@@ -780,18 +892,19 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         await update.message.reply_text("🔍 正在连接 Alist...", parse_mode='Markdown')
         
-        # 获取根目录
-        success, items = alist_list_files("/")
+        # 获取根目录第一页
+        success, listing = await get_alist_listing("/", page=1, per_page=ALIST_PAGE_SIZE)
         if not success:
-            await update.message.reply_text(f"❌ **连接失败**\n请检查 Alist Token 是否配置正确。\n错误: `{items}`", parse_mode='Markdown')
+            await update.message.reply_text(f"❌ **连接失败**\n请检查 Alist Token 是否配置正确。\n错误: `{listing}`", parse_mode='Markdown')
             return
             
         context.user_data['alist_path'] = "/"
-        context.user_data['alist_items'] = items
+        context.user_data['alist_page'] = 0
+        context.user_data['alist_items'] = listing.entries
         
-        # 初始页码为 0
-        keyboard = get_alist_browser_keyboard("/", items, page=0)
+        keyboard = get_alist_browser_keyboard(listing)
         await update.message.reply_text("☁️ **云盘浏览**\n📂 路径: `/`", reply_markup=keyboard, parse_mode='Markdown')
+        schedule_prefetch("/", 1, listing, ALIST_PAGE_SIZE)
         return
 
     if text == "🎵 音频+图片":
@@ -849,7 +962,7 @@ async def handle_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif state == 'waiting_key_value':
         name = context.user_data.get('temp_key_name', '未命名')
         config = load_config()
-        keys = config.get('stream_keys', [])
+        keys = [dict(k) for k in config.get('stream_keys', [])]
         keys.append({'name': name, 'key': text})
         save_config({'stream_keys': keys, 'active_key_index': len(keys) - 1})
         await update.message.reply_text(f"✅ **密钥已添加**: {name}", parse_mode='Markdown')
@@ -920,17 +1033,276 @@ async def handle_audio_stream_logic(query, context, message=None):
 async def start_stream_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_owner(update.effective_user.id): return
     if len(context.args) == 0:
-        await update.message.reply_text("💡 命令用法: `/stream <链接> [RTMP地址]`", parse_mode='Markdown')
+        await update.message.reply_text("💡 命令用法: `/stream [--loop] [@密钥名] <链接>`", parse_mode='Markdown')
         return
-    raw_src = " ".join(context.args).strip()
-    await run_ffmpeg_stream(update, raw_src)
+
+    args = list(context.args)
+    loop = False
+    if args[0] == "--loop" and len(args) > 1:
+        args.pop(0)
+        loop = True
+    key_index = None
+    key_indexes = None
+    # 以 @ 开头的第一个参数指定推流密钥 (名称或序号)，逗号分隔或 @all 表示多路推流
+    if args[0].startswith("@") and len(args) > 1:
+        key_refs = args.pop(0)[1:]
+        keys = load_config().get('stream_keys', [])
+        if key_refs == "all":
+            key_indexes = list(range(len(keys)))
+        else:
+            key_indexes = []
+            for key_ref in key_refs.split(","):
+                for idx, key_data in enumerate(keys):
+                    if key_data.get('name') == key_ref or str(idx + 1) == key_ref:
+                        key_indexes.append(idx)
+                        break
+                else:
+                    await update.message.reply_text(f"❌ 未找到推流密钥 `{key_ref}`", parse_mode='Markdown')
+                    return
+        if not key_indexes:
+            await update.message.reply_text("❌ 没有可用的推流密钥")
+            return
+        if len(key_indexes) == 1:
+            key_index, key_indexes = key_indexes[0], None
+
+    raw_src = " ".join(args).strip()
+    await run_ffmpeg_stream(update, raw_src, key_index=key_index, key_indexes=key_indexes, loop=loop)
 
 async def stop_stream_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """停止推流：/stopstream [会话ID|all]，多路推流时弹出选择菜单"""
     if not is_owner(update.effective_user.id): return
-    if stop_ffmpeg_process():
-        await update.message.reply_text("🛑 已停止推流")
-    else:
+    sessions = stream_manager.running()
+    target = context.args[0].lstrip("#") if context.args else None
+
+    if not sessions:
         await update.message.reply_text("⚠️ 无运行中的任务")
+        return
+
+    if target is None and len(sessions) > 1:
+        await update.message.reply_text(
+            "🛑 **选择要停止的推流**",
+            reply_markup=get_stream_sessions_keyboard(sessions),
+            parse_mode='Markdown'
+        )
+        return
+
+    session_id = None if target in (None, "all") else target
+    if await stop_ffmpeg_process(session_id):
+        await update.message.reply_text("🛑 已停止推流" if session_id is None else f"🛑 已停止推流 #{session_id}")
+    else:
+        await update.message.reply_text(f"⚠️ 未找到推流 #{target}")
+
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """播放列表：/queue add|list|skip|clear|loop"""
+    if not is_owner(update.effective_user.id): return
+    args = context.args
+    action = args[0].lower() if args else "list"
+
+    if action == "add":
+        src = " ".join(args[1:]).strip()
+        if not src:
+            await update.message.reply_text("💡 用法: `/queue add <路径或链接>`", parse_mode='Markdown')
+            return
+        position = playlist_channel.add(src)
+        if playlist_channel.is_running():
+            await update.message.reply_text(f"➕ 已加入队列 (第 {position} 位)\n📄 {os.path.basename(src)}")
+            return
+        if await playlist_channel.start(update.message):
+            await update.message.reply_text(
+                f"📻 **播放列表已开始推流** (#{playlist_channel.session.id})\n"
+                f"🔑 {playlist_channel.session.key_name}\n"
+                f"📄 {os.path.basename(src)}",
+                parse_mode='Markdown'
+            )
+        else:
+            # 启动失败的原因已由 start() 回复；只撤回本次加入的条目，保留原有队列
+            playlist_channel.remove_last()
+            if playlist_channel.queue:
+                await update.message.reply_text(
+                    f"⚠️ 播放列表未启动，{os.path.basename(src)} 未加入队列 (队列中仍保留 {len(playlist_channel.queue)} 个)"
+                )
+
+    elif action == "skip":
+        if playlist_channel.skip():
+            await update.message.reply_text("⏭ 已跳到下一个")
+        else:
+            await update.message.reply_text("⚠️ 当前没有正在播放的条目")
+
+    elif action == "clear":
+        count = playlist_channel.clear()
+        await update.message.reply_text(f"🗑 已清空队列 ({count} 个)，当前条目播放完后进入待机画面")
+
+    elif action == "loop":
+        enabled = (args[1].lower() in ("on", "1", "开")) if len(args) > 1 else not load_config().get('playlist_loop', 0)
+        set_playlist_loop(enabled)
+        await update.message.reply_text(f"🔁 队列循环已{'开启' if enabled else '关闭'}")
+
+    else:
+        await update.message.reply_text(playlist_channel.status_text())
+
+# Telegram Bot API 上传文件大小上限
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+async def recordings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """录像：/recordings [on|off]，不带参数时列出最近的录像"""
+    if not is_owner(update.effective_user.id): return
+    args = context.args
+    if args and args[0].lower() in ("on", "off", "1", "0", "开", "关"):
+        enabled = args[0].lower() in ("on", "1", "开")
+        save_config({'stream_record': 1 if enabled else 0})
+        await update.message.reply_text(f"⏺ 推流录像已{'开启' if enabled else '关闭'} (对新启动的推流生效)")
+        return
+
+    items = list_recordings(limit=10)
+    state = "开启" if load_config().get('stream_record', 0) else "关闭"
+    if not items:
+        await update.message.reply_text(f"📼 暂无录像 (录像功能: {state})\n💡 `/recordings on` 开启录像", parse_mode='Markdown')
+        return
+
+    context.user_data['recordings'] = [path for path, _, _ in items]
+    keyboard = [
+        [InlineKeyboardButton(
+            f"📤 {time.strftime('%m-%d %H:%M', time.localtime(mtime))} {os.path.basename(path)[:24]} ({format_size(size)})",
+            callback_data=f"rec_send:{idx}"
+        )]
+        for idx, (path, size, mtime) in enumerate(items)
+    ]
+    keyboard.append([InlineKeyboardButton("❌ 关闭", callback_data="btn_close")])
+    await update.message.reply_text(
+        f"📼 **最近录像** (录像功能: {state})\n点击发送文件：",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+async def calibrate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """测试本机编码能力并保存默认编码档位：/calibrate [off]"""
+    if not is_owner(update.effective_user.id): return
+    if context.args and context.args[0].lower() in ("off", "reset", "0"):
+        save_config({'calibrated_profile': None})
+        await update.message.reply_text("🗑 已清除校准结果，恢复使用配置中的编码参数")
+        return
+    if stream_manager.running():
+        await update.message.reply_text("⚠️ 推流进行中，校准结果会不准确。请先停止推流。")
+        return
+    if is_calibrating():
+        await update.message.reply_text("⚠️ 已有校准正在进行，请等待完成。")
+        return
+
+    status_msg = await update.message.reply_text("🧪 **编码性能校准**\n\n⏳ 准备测试...", parse_mode='Markdown')
+
+    async def progress(results):
+        try:
+            await status_msg.edit_text(calibration_text(results), parse_mode='Markdown')
+        except BadRequest:
+            pass
+
+    async def _run():
+        try:
+            chosen, results = await run_calibration(progress)
+            await status_msg.edit_text(calibration_text(results, chosen, done=True), parse_mode='Markdown')
+        except CalibrationBusy:
+            await status_msg.edit_text("⚠️ 已有校准正在进行，请等待完成。")
+        except Exception as e:
+            logger.error(f"Calibration error: {e}")
+            await status_msg.edit_text(f"❌ 校准失败: {e}")
+
+    asyncio.create_task(_run())
+
+async def prepare_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """空闲预转码：/prepare <路径> 加入队列，/prepare clear 清除未完成的任务，无参数查看队列"""
+    if not is_owner(update.effective_user.id): return
+    args = context.args
+    if args and args[0].lower() == "clear":
+        count = await prepared_catalog.remove_unfinished()
+        await update.message.reply_text(f"🗑 已清除 {count} 个排队中/失败的任务")
+        return
+    if args:
+        ok, msg = await pretranscode_queue.add(" ".join(args))
+        await update.message.reply_text(("📦 " if ok else "❌ ") + msg)
+        return
+    await update.message.reply_text(await pretranscode_queue.status_text(), parse_mode='Markdown')
+
+async def streams_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """列出所有推流会话"""
+    if not is_owner(update.effective_user.id): return
+    sessions = stream_manager.running()
+    if not sessions:
+        await update.message.reply_text("💤 当前没有运行中的推流")
+        return
+    text = "📺 **推流会话**\n\n" + "\n\n".join(sess.status_text() for sess in sessions)
+    if load_config().get('stream_proxy', 0):
+        text += f"\n\n{read_ahead_proxy.status_text()}"
+    await update.message.reply_text(text, reply_markup=get_stream_sessions_keyboard(sessions))
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """在本地索引中搜索 Alist 文件"""
+    if not is_owner(update.effective_user.id): return
+
+    if not context.args:
+        status = await search_index.status()
+        last = time.strftime("%m-%d %H:%M", time.localtime(status['last_crawl'])) if status['last_crawl'] else "尚未完成"
+        await update.message.reply_text(
+            "🔎 **文件搜索**\n\n"
+            "💡 用法: `/find <关键词>`\n\n"
+            f"📚 已索引: {status['files']} 个文件 / {status['dirs']} 个目录\n"
+            f"🕒 上次更新: {last}{' (更新中...)' if status['crawling'] else ''}",
+            parse_mode='Markdown'
+        )
+        return
+
+    query = " ".join(context.args).strip()
+    results = await search_index.search(query, limit=10)
+    if not results:
+        await update.message.reply_text(f"🔍 未找到与 `{query}` 相关的文件\n(索引可能尚未完成，可使用 /reindex 更新)", parse_mode='Markdown')
+        return
+
+    context.user_data['find_results'] = results
+    keyboard = []
+    for idx, item in enumerate(results):
+        name = item['name']
+        if len(name) > 30: name = name[:28] + ".."
+        icon = "📂" if item['is_dir'] else "📄"
+        keyboard.append([InlineKeyboardButton(f"{icon} {name}", callback_data=f"find_go:{idx}")])
+    keyboard.append([InlineKeyboardButton("❌ 关闭", callback_data="btn_close")])
+
+    await update.message.reply_text(
+        f"🔎 **搜索结果**: `{query}` ({len(results)} 项)",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+async def reindex_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """立即在后台更新搜索索引"""
+    if not is_owner(update.effective_user.id): return
+    if search_index.crawling:
+        await update.message.reply_text("⏳ 索引正在更新中，请稍候...")
+        return
+    if not get_alist_pid():
+        await update.message.reply_text("⚠️ **Alist 未启动**，无法更新索引。", parse_mode='Markdown')
+        return
+
+    status_msg = await update.message.reply_text("🔄 正在后台更新索引...")
+
+    async def _run():
+        listed, skipped = await search_index.crawl()
+        try:
+            await status_msg.edit_text(f"✅ **索引更新完成**\n\n📂 重新列出: {listed} 个目录\n⏭ 未变化跳过: {skipped} 个目录", parse_mode='Markdown')
+        except Exception:
+            pass
+
+    asyncio.create_task(_run())
+
+async def on_startup(application):
+    """启动后台索引、录像清理和预转码任务"""
+    asyncio.create_task(search_index.run_periodic())
+    asyncio.create_task(run_retention())
+    asyncio.create_task(pretranscode_queue.run())
+
+async def on_shutdown(application):
+    """机器人退出时中止预转码并释放 Alist 连接池和预读代理"""
+    await pretranscode_queue.stop()
+    await read_ahead_proxy.close()
+    await close_alist_client()
 
 def main():
     print(f"🚀 机器人启动中 (Reply Menu v3.0)...")
@@ -954,15 +1326,22 @@ def main():
         return
 
     try:
-        application = ApplicationBuilder().token(final_token).build()
+        application = ApplicationBuilder().token(final_token).post_init(on_startup).post_shutdown(on_shutdown).build()
         
         application.add_handler(CommandHandler("start", start))
         application.add_handler(CommandHandler("help", help_command)) # 添加帮助指令
         application.add_handler(CommandHandler("stream", start_stream_cmd))
         application.add_handler(CommandHandler("stopstream", stop_stream_cmd))
+        application.add_handler(CommandHandler("streams", streams_command))
+        application.add_handler(CommandHandler("queue", queue_command))
+        application.add_handler(CommandHandler("recordings", recordings_command))
+        application.add_handler(CommandHandler("calibrate", calibrate_command))
+        application.add_handler(CommandHandler("prepare", prepare_command))
         application.add_handler(CommandHandler("cmd", cmd_handler)) # Shell CMD Handler
         application.add_handler(CommandHandler("sh", cmd_handler))  # Alias
         application.add_handler(CommandHandler("speedtest", speedtest_handler)) # Speedtest handler
+        application.add_handler(CommandHandler("find", find_command))
+        application.add_handler(CommandHandler("reindex", reindex_command))
         
         # 新增的配置指令
         application.add_handler(CommandHandler("settoken", set_token_command))
@@ -973,6 +1352,7 @@ def main():
         
         print("✅ 服务已就绪，按 Ctrl+C 停止")
         application.run_polling()
+        flush_config()
     except Exception as e:
         print(f"❌ 启动失败: {e}")
         # 如果是网络错误等临时问题，稍微等待再退出，防止快速闪退
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import time
+from collections import deque
+import psutil
+
+logger = logging.getLogger("Adaptive")
+
+# x264 preset 从快到慢
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+
+SAMPLE_INTERVAL = 2
+# 每次调整都要重启编码器并重连 RTMP (观众端会短暂中断)，因此阈值偏保守
+# 降级: 最近 DOWN_WINDOW 秒的实时速度低于阈值
+DOWN_WINDOW = 30
+# 升级: 最近 UP_WINDOW 秒速度达标且系统 CPU 有余量；同一级别失败过一次，等待时间翻倍
+UP_WINDOW = 300
+MAX_UP_BACKOFF = 3
+# 每小时最多升级的次数 (降级不受限制，跟不上实时比重连更影响观看)
+MAX_UPS_PER_HOUR = 2
+# 两次调整之间的最短间隔 (秒)，包括重启后的稳定时间
+COOLDOWN = 120
+# 音频码率 (编码参数固定为 128k)
+AUDIO_KBPS = 128
+# 实际发出的码率低于目标的该比例时，认为是上传带宽不足
+UPLINK_SHORTFALL = 0.9
+
+def _even(value):
+    return max(2, int(value) // 2 * 2)
+
+def _kbps(bitrate):
+    text = str(bitrate).lower().rstrip("k")
+    try:
+        return int(float(text))
+    except ValueError:
+        return 2000
+
+def calibration_target(config):
+    """校准结果对应的目标画质，目标变化后旧的校准结果不再使用"""
+    return f"{config.get('stream_width', 1280)}x{config.get('stream_height', 720)}@{config.get('stream_fps', 25)}"
+
+def base_encoder_profile(config):
+    """
+    默认编码参数: 有与当前目标画质匹配的 /calibrate 结果时使用校准档位，否则使用配置
+    """
+    calibrated = config.get('calibrated_profile')
+    if calibrated and config.get('stream_use_calibration', 1) and calibrated.get('target') == calibration_target(config):
+        return {k: calibrated[k] for k in ('preset', 'width', 'height', 'fps', 'kbps')}
+    return {
+        'preset': config.get('stream_preset', 'veryfast'),
+        'width': config.get('stream_width', 1280),
+        'height': config.get('stream_height', 720),
+        'fps': config.get('stream_fps', 25),
+        'kbps': _kbps(config.get('stream_bitrate', '2000k')),
+    }
+
+def build_encoder_ladder(config):
+    """
+    根据配置生成编码档位，第 0 档为默认编码参数，越往后越省 CPU:
+    更快的 preset -> 降帧率 -> 降分辨率和码率
+    """
+    base = base_encoder_profile(config)
+    width, height, fps, kbps, preset = base['width'], base['height'], base['fps'], base['kbps'], base['preset']
+    ladder = [base]
+
+    idx = X264_PRESETS.index(preset) if preset in X264_PRESETS else 2
+    while idx > 0:
+        idx -= 1
+        ladder.append(dict(ladder[-1], preset=X264_PRESETS[idx]))
+
+    if fps > 20:
+        ladder.append(dict(ladder[-1], fps=max(15, round(fps * 0.6))))
+
+    for scale in (0.75, 0.5):
+        ladder.append(dict(
+            ladder[-1], width=_even(width * scale), height=_even(height * scale), kbps=int(kbps * scale)
+        ))
+    return ladder
+
+def profile_label(profile):
+    return f"{profile['width']}x{profile['height']}@{profile['fps']} {profile['preset']} {profile['kbps']}k"
+
+class AdaptiveController:
+    """
+    推流编码闭环控制。
+    根据 -progress 指标计算实际编码速度 (输出时长增量 / 实际时间增量)：
+    持续跟不上实时就降一档，速度达标且系统 CPU 有余量一段时间后再升一档。
+    CPU 有余量但每秒实际发出的数据量低于目标码率时 (上传带宽不足)，换更快的 preset 没有用，
+    直接降到码率更低的档位。
+    每次调整都通过 restart(profile, start_at) 从当前播放位置重启编码器，
+    RTMP 会重新连接，观众端有几秒中断，所以调整频率受到限制。
+    """
+
+    def __init__(self, session, ladder, restart, seekable, config):
+        self.session = session
+        self.ladder = ladder
+        self.restart = restart
+        self.seekable = seekable
+        self.level = 0
+        self.down_speed = config.get('stream_adapt_down_speed', 0.95)
+        self.up_cpu = config.get('stream_adapt_up_cpu', 60)
+        self.failures = {}
+        self.decisions = deque(maxlen=10)
+        self._ups = deque()
+        self.changes = 0
+        self._samples = deque()
+        self._last_change = time.time()
+        self._task = None
+
+    @property
+    def profile(self):
+        return self.ladder[self.level]
+
+    def start(self):
+        psutil.cpu_percent(interval=None)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        # 进程崩溃后由监督任务恢复期间继续等待
+        while self.session.is_running() or self.session.supervising:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            metrics = self.session.metrics
+            if not self.session.is_running() or self.session.restarting or self.session.plan.get('kind') != 'encode':
+                # 循环推流改为直接封装缓存后不再编码
+                self._samples.clear()
+                continue
+            if not self.session.ready or metrics.get("out_time") is None:
+                continue
+
+            now = time.time()
+            self._samples.append((
+                now, metrics["out_time"], psutil.cpu_percent(interval=None), metrics.get("total_size") or 0
+            ))
+            while self._samples and now - self._samples[0][0] > UP_WINDOW * 2 ** MAX_UP_BACKOFF:
+                self._samples.popleft()
+
+            if now - self._last_change < COOLDOWN:
+                continue
+            try:
+                await self._evaluate(now, metrics)
+            except Exception as e:
+                logger.error(f"#{self.session.id} 自适应调整失败: {e}")
+
+    def _window(self, now, seconds):
+        """
+        返回窗口内的 (实时速度, 平均系统 CPU, 每秒实际发出的码率 kbps)，
+        样本不足覆盖窗口时返回 None
+        """
+        window = [s for s in self._samples if now - s[0] <= seconds]
+        if len(window) < 2 or window[-1][0] - window[0][0] < seconds * 0.8:
+            return None
+        elapsed = window[-1][0] - window[0][0]
+        speed = (window[-1][1] - window[0][1]) / elapsed
+        cpu = sum(s[2] for s in window) / len(window)
+        throughput = (window[-1][3] - window[0][3]) * 8 / 1000 / elapsed
+        return speed, cpu, throughput
+
+    def _lower_bitrate_level(self):
+        """码率低于当前档位的第一个档位，没有时返回下一档"""
+        kbps = self.profile['kbps']
+        for level in range(self.level + 1, len(self.ladder)):
+            if self.ladder[level]['kbps'] < kbps:
+                return level
+        return self.level + 1
+
+    async def _evaluate(self, now, metrics):
+        down = self._window(now, DOWN_WINDOW)
+        if down is None:
+            return
+        speed, cpu, throughput = down
+        target_kbps = self.profile['kbps'] + AUDIO_KBPS
+
+        if speed < self.down_speed and self.level < len(self.ladder) - 1:
+            self.failures[self.level] = self.failures.get(self.level, 0) + 1
+            reason = f"速度 {speed:.2f}x < {self.down_speed}x, CPU {cpu:.0f}%, 发出 {throughput:.0f}/{target_kbps}k"
+            if cpu < self.up_cpu and throughput < target_kbps * UPLINK_SHORTFALL:
+                await self._change(self._lower_bitrate_level(), reason + " (上传带宽不足)")
+            else:
+                await self._change(self.level + 1, reason)
+            return
+
+        if self.level > 0:
+            while self._ups and now - self._ups[0] > 3600:
+                self._ups.popleft()
+            if len(self._ups) >= MAX_UPS_PER_HOUR:
+                return
+            up_window = UP_WINDOW * 2 ** min(self.failures.get(self.level - 1, 0), MAX_UP_BACKOFF)
+            up = self._window(now, up_window)
+            if up is None:
+                return
+            up_speed, up_cpu, up_throughput = up
+            # 上一档码率更高时，要求当前档位的码率已能完整发出
+            uplink_ok = (
+                self.ladder[self.level - 1]['kbps'] <= self.profile['kbps']
+                or up_throughput >= target_kbps * UPLINK_SHORTFALL
+            )
+            if up_speed >= 0.99 and up_cpu < self.up_cpu and uplink_ok:
+                self._ups.append(now)
+                await self._change(
+                    self.level - 1, f"{up_window}s 内速度 {up_speed:.2f}x, CPU {up_cpu:.0f}% 有余量, 发出 {up_throughput:.0f}k"
+                )
+
+    async def _change(self, level, reason):
+        old = self.profile
+        start_at = self.session.position() if self.seekable else 0
+        self.level = level
+        decision = f"{profile_label(old)} -> {profile_label(self.profile)} ({reason})"
+        logger.info(f"#{self.session.id} 调整编码: {decision}")
+        self.decisions.append(f"{time.strftime('%H:%M:%S')} {decision}")
+        self.changes += 1
+
+        self._samples.clear()
+        self._last_change = time.time()
+        await self.restart(self.profile, start_at)
+        self._last_change = time.time()
+
+    def status_text(self):
+        text = f"🎚 自适应: 第 {self.level}/{len(self.ladder) - 1} 档 ({profile_label(self.profile)})"
+        if self.decisions:
+            text += f"\n   最近调整: {self.decisions[-1]}"
+            text += f"\n   ⚠️ 已调整 {self.changes} 次，每次切换会重连 RTMP，观众端有几秒中断"
+        return text
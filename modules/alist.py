@@ -4,8 +4,13 @@ import os
 import signal
 import asyncio
 import json
-import requests
+import time
+import base64
+import calendar
+from urllib.parse import urlsplit, parse_qsl
 from .config import load_config, save_config
+from .alist_client import get_alist_client
+from .cache import TTLCache
 
 def get_alist_pid():
     """查找 alist 进程 PID"""
@@ -59,121 +64,273 @@ def get_alist_admin_password():
         print(f"Failed to get alist admin password: {e}")
         return None
 
-def get_auth_token():
-    """获取 Alist Token，如果未配置则尝试通过账号密码登录获取"""
-    config = load_config()
-    token = config.get('alist_token', '')
-    
-    # 如果已有 Token，直接返回
-    if token:
-        return token
-        
-    # 尝试自动登录
-    user = config.get('alist_user', 'admin')
-    pwd = config.get('alist_password')
-    host = config.get('alist_host', "http://127.0.0.1:5244")
-    
-    # 1. 如果没有密码，尝试从 CLI 获取
-    if not pwd:
-        print("Bot: 未配置 Alist 密码，尝试自动获取...")
-        pwd = get_alist_admin_password()
-        if pwd:
-            print(f"Bot: 自动获取密码成功，已保存。")
-            save_config({'alist_password': pwd})
-        else:
-            print("Bot: 自动获取密码失败，请手动配置。")
+class AlistTokenManager:
+    """
+    Alist Token 管理器。
+    - Token 保存在内存中，仅当 Token 实际变化时才写入配置文件
+    - 解析 JWT 的 exp 字段，在过期前 REFRESH_MARGIN 秒主动刷新
+    - 多个协程同时需要刷新时只发出一次登录请求 (single-flight)
+    """
+    REFRESH_MARGIN = 300
+    FAILURE_BACKOFF = 10
+
+    def __init__(self):
+        self._token = ""
+        self._expires_at = None
+        self._config_token = None
+        self._refresh_task = None
+        self._last_failure = 0
 
-    # 2. 尝试登录获取 Token
-    if user and pwd:
+    @staticmethod
+    def decode_expiry(token):
+        """从 JWT 中解析过期时间戳，非 JWT 或无 exp 时返回 None"""
+        parts = token.split(".")
+        if len(parts) != 3:
+            return None
         try:
-            login_url = f"{host}/api/auth/login"
-            resp = requests.post(login_url, json={"username": user, "password": pwd}, timeout=5)
-            data = resp.json()
-            if data.get("code") == 200:
-                new_token = data.get("data", {}).get("token")
-                if new_token:
-                    print("Bot: Alist 登录成功，Token 已更新。")
-                    # 登录成功，保存 Token 到配置文件，避免重复登录
-                    save_config({'alist_token': new_token})
-                    return new_token
+            payload = parts[1] + "=" * (-len(parts[1]) % 4)
+            exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+            return float(exp) if exp else None
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+    def _sync_from_config(self):
+        """配置中的 Token 被外部修改 (手动配置/修复重置) 时采用新值"""
+        config_token = load_config().get('alist_token', '')
+        if config_token != self._config_token:
+            self._config_token = config_token
+            self._set_token(config_token)
+
+    def _set_token(self, token):
+        self._token = token or ""
+        self._expires_at = self.decode_expiry(token) if token else None
+
+    def _needs_refresh(self):
+        if not self._token:
+            return True
+        return self._expires_at is not None and self._expires_at - time.time() < self.REFRESH_MARGIN
+
+    async def get_token(self):
+        """返回可用 Token，必要时登录刷新；失败返回空字符串"""
+        self._sync_from_config()
+        if not self._needs_refresh():
+            return self._token
+        return await self._refresh()
+
+    async def invalidate(self, token):
+        """
+        Token 被服务器拒绝 (401) 时调用并返回新 Token。
+        只有被拒绝的仍是当前 Token 时才清空，避免并发请求重复登录。
+        """
+        if token and token == self._token:
+            self._set_token("")
+            self._last_failure = 0
+        return await self.get_token()
+
+    async def _refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            # 登录失败后短时间内不再重试，直接返回现有 Token
+            if time.time() - self._last_failure < self.FAILURE_BACKOFF:
+                return self._token
+            self._refresh_task = asyncio.create_task(self._login())
+        return await asyncio.shield(self._refresh_task)
+
+    async def _login(self):
+        config = load_config()
+        user = config.get('alist_user', 'admin')
+        pwd = config.get('alist_password')
+
+        # 1. 如果没有密码，尝试从 CLI 获取 (子进程调用放到线程中，避免阻塞事件循环)
+        if not pwd:
+            print("Bot: 未配置 Alist 密码，尝试自动获取...")
+            loop = asyncio.get_running_loop()
+            pwd = await loop.run_in_executor(None, get_alist_admin_password)
+            if pwd:
+                print(f"Bot: 自动获取密码成功，已保存。")
+                save_config({'alist_password': pwd})
             else:
-                print(f"Bot: Alist 登录失败: {data.get('message')}")
-        except Exception as e:
-            print(f"Bot: Alist 登录请求异常: {e}")
-            pass
-            
-    return ""
+                print("Bot: 自动获取密码失败，请手动配置。")
+
+        # 2. 尝试登录获取 Token
+        if user and pwd:
+            try:
+                _, data = await get_alist_client().post("/api/auth/login", {"username": user, "password": pwd})
+                if data.get("code") == 200:
+                    new_token = (data.get("data") or {}).get("token")
+                    if new_token:
+                        print("Bot: Alist 登录成功，Token 已更新。")
+                        self._set_token(new_token)
+                        # 仅在 Token 变化时写盘
+                        if new_token != self._config_token:
+                            self._config_token = new_token
+                            save_config({'alist_token': new_token})
+                        return new_token
+                else:
+                    print(f"Bot: Alist 登录失败: {data.get('message')}")
+            except Exception as e:
+                print(f"Bot: Alist 登录请求异常: {e}")
 
-def resolve_alist_path(path):
+        self._last_failure = time.time()
+        # 登录失败时，若旧 Token 尚未真正过期则继续使用
+        if self._token and (self._expires_at is None or self._expires_at > time.time()):
+            return self._token
+        return ""
+
+token_manager = AlistTokenManager()
+
+async def get_auth_token():
+    """获取 Alist Token，如果未配置则尝试通过账号密码登录获取"""
+    return await token_manager.get_token()
+
+async def alist_api_post(endpoint, payload):
     """
-    通过 API 获取文件的真实下载链接
+    带鉴权的 Alist API 请求
     包含 401 自动重试逻辑 (Token 过期自动刷新)
+    返回: (http_status, data_dict)
+    """
+    client = get_alist_client()
+    token = await token_manager.get_token()
+    status, data = await client.post(endpoint, payload, token=token)
+
+    # 处理 401 Unauthorized (Token 失效)
+    if status == 401 or data.get("code") == 401:
+        print("Bot: Alist Token 已失效，尝试重新登录...")
+        new_token = await token_manager.invalidate(token)
+        if new_token and new_token != token:
+            status, data = await client.post(endpoint, payload, token=new_token) # 重试
+    return status, data
+
+# --- 真实链接 (raw_url) 缓存 ---
+# 签名链接通常在 URL 参数中带有过期时间；解析不到时使用 alist_link_ttl
+LINK_EXPIRY_MARGIN = 60
+LINK_MAX_TTL = 3600
+link_cache = TTLCache(max_entries=256, ttl=load_config().get('alist_link_ttl', 300))
+# 解析直链时顺带拿到的 (大小, 修改时间)，用于标识文件版本 (媒体信息缓存的键)
+file_stamps = TTLCache(max_entries=256, ttl=LINK_MAX_TTL)
+_link_inflight = {}
+
+def parse_link_expiry(url):
+    """
+    从签名链接中解析过期时间戳，无法解析时返回 None
+    支持: Alist sign=xxx:<ts>、Expires/expires、e、X-Amz-Date + X-Amz-Expires、x-oss-date + x-oss-expires
     """
-    config = load_config()
-    base_url = config.get('alist_host', "http://127.0.0.1:5244")
-    api_url = f"{base_url}/api/fs/get"
-    
-    # 定义请求函数
-    def _do_request(_token):
-        headers = {
-            "User-Agent": "TermuxBot",
-            "Content-Type": "application/json"
-        }
-        if _token:
-            headers["Authorization"] = _token
-            
-        payload = {
-            "path": path,
-            "password": ""
-        }
-        return requests.post(api_url, json=payload, headers=headers, timeout=8)
-
-    # 第一次尝试
-    token = get_auth_token()
     try:
-        resp = _do_request(token)
-        data = resp.json()
-        
-        # 处理 401 Unauthorized (Token 失效)
-        if resp.status_code == 401 or data.get("code") == 401:
-            print("Bot: Alist Token 已失效，尝试重新登录...")
-            save_config({'alist_token': ''}) # 清除旧 Token
-            token = get_auth_token() # 触发重新获取
-            if token:
-                resp = _do_request(token) # 重试
-                data = resp.json()
+        params = {k.lower(): v for k, v in parse_qsl(urlsplit(url).query)}
+    except ValueError:
+        return None
+
+    def _amz_time(value):
+        return calendar.timegm(time.strptime(value, "%Y%m%dT%H%M%SZ"))
+
+    try:
+        if 'x-amz-date' in params and 'x-amz-expires' in params:
+            return _amz_time(params['x-amz-date']) + int(params['x-amz-expires'])
+        if 'x-oss-date' in params and 'x-oss-expires' in params:
+            return _amz_time(params['x-oss-date']) + int(params['x-oss-expires'])
+        for name in ('expires', 'x-oss-expires', 'e'):
+            if params.get(name, '').isdigit():
+                return int(params[name])
+        sign = params.get('sign', '')
+        if ':' in sign:
+            ts = sign.rsplit(':', 1)[1]
+            # Alist 的 sign 以 :0 结尾表示永不过期
+            if ts.isdigit() and int(ts) > 0:
+                return int(ts)
+    except (ValueError, OverflowError):
+        return None
+    return None
+
+def _link_ttl(url):
+    """计算链接在缓存中的存活秒数"""
+    expires_at = parse_link_expiry(url)
+    if expires_at is None:
+        return link_cache.ttl
+    return max(0, min(expires_at - time.time() - LINK_EXPIRY_MARGIN, LINK_MAX_TTL))
+
+async def _fetch_raw_url(path):
+    payload = {
+        "path": path,
+        "password": ""
+    }
+
+    try:
+        _, data = await alist_api_post("/api/fs/get", payload)
 
         if data.get("code") == 200:
-            return data.get("data", {}).get("raw_url")
+            info = data.get("data") or {}
+            raw_url = info.get("raw_url")
+            file_stamps.set(path, (info.get("size") or 0, info.get("modified") or ""))
+            if raw_url:
+                ttl = _link_ttl(raw_url)
+                if ttl > 0:
+                    link_cache.set(path, raw_url, ttl=ttl)
+            return raw_url
         else:
             print(f"Resolve Path Error: {data.get('message')}")
     except Exception as e:
         print(f"Resolve Path Exception: {e}")
+    finally:
+        # 刷新时可能已被新的请求替换，只移除自己
+        if _link_inflight.get(path) is asyncio.current_task():
+            del _link_inflight[path]
         
     return None
 
+async def resolve_alist_path(path, use_cache=True):
+    """
+    通过 API 获取文件的真实下载链接
+    结果按路径缓存至链接过期前，过期后在下次调用时重新获取
+    """
+    if use_cache:
+        raw_url = link_cache.get(path)
+        if raw_url:
+            return raw_url
+        task = _link_inflight.get(path)
+        if task is not None:
+            return await asyncio.shield(task)
+
+    task = asyncio.get_running_loop().create_task(_fetch_raw_url(path))
+    _link_inflight[path] = task
+    return await asyncio.shield(task)
+
+def get_alist_file_stamp(path):
+    """返回最近一次解析得到的 (大小, 修改时间)，未解析过返回 None"""
+    return file_stamps.get(path)
+
+def invalidate_resolved_link(path=None):
+    """清除已缓存的真实链接 (链接失效或文件变化时)"""
+    if path is None:
+        link_cache.invalidate()
+    else:
+        link_cache.pop(path)
+
+# 后台预解析任务；事件循环只保留任务的弱引用，需要在这里持有直到完成
+_prefetch_tasks = set()
+
+def _prefetch_done(task):
+    _prefetch_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Prefetch Link Exception: {task.exception()}")
+
+def prefetch_alist_link(path):
+    """在后台预先解析链接 (浏览器中选中文件时调用)"""
+    if path in link_cache or path in _link_inflight:
+        return
+    task = asyncio.get_running_loop().create_task(resolve_alist_path(path))
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_done)
+
 async def mount_local_storage():
     """调用 API 挂载本机存储"""
-    config = load_config()
-    
     # 确保 Alist 正在运行
     if not get_alist_pid():
         return False, "Alist 未运行，请先启动服务"
 
-    token = get_auth_token() # 使用自动获取逻辑
+    token = await token_manager.get_token() # 使用自动获取逻辑
     
     if not token:
         return False, "未获取到 Alist Token，且自动获取密码失败。\n请尝试手动运行 `alist admin` 查看密码，并在 Bot 设置中配置。"
     
-    base_url = config.get('alist_host', "http://127.0.0.1:5244")
-    api_url = f"{base_url}/api/admin/storage/create"
-    
-    headers = {
-        "User-Agent": "TermuxBot",
-        "Content-Type": "application/json",
-        "Authorization": token
-    }
-    
     # 挂载 /sdcard
     payload = {
         "mount_path": "/本机存储",
@@ -188,9 +345,9 @@ async def mount_local_storage():
     }
 
     try:
-        resp = requests.post(api_url, json=payload, headers=headers, timeout=5)
-        data = resp.json()
+        _, data = await alist_api_post("/api/admin/storage/create", payload)
         if data.get("code") == 200:
+            invalidate_alist_listing()
             return True, "✅ 挂载成功！请刷新列表查看 `/本机存储`"
         elif "repect" in str(data.get("message")): # 兼容拼写错误 'repect' vs 'repeat'
             return True, "✅ 存储已存在，无需重复挂载"
@@ -291,38 +448,141 @@ async def fix_alist_config():
     
     return log_msg, status, new_pid
 
-def alist_list_files(path="/", page=1, per_page=0):
-    """
-    调用 Alist API 获取文件列表
-    返回: (success, data_list/error_msg)
-    """
-    config = load_config()
-    token = get_auth_token() # 使用自动获取逻辑
-    base_url = config.get('alist_host', "http://127.0.0.1:5244")
-    
-    api_url = f"{base_url}/api/fs/list"
-    headers = {
-        "User-Agent": "TermuxBot",
-        "Content-Type": "application/json"
-    }
-    if token:
-        headers["Authorization"] = token
-
+async def _fs_list(path, page, per_page, refresh):
+    """调用 /api/fs/list，返回 (success, data_dict/error_msg)"""
     payload = {
         "path": path,
         "password": "",
         "page": page,
         "per_page": per_page,
-        "refresh": False
+        "refresh": refresh
     }
 
     try:
-        resp = requests.post(api_url, json=payload, headers=headers, timeout=5)
-        data = resp.json()
+        _, data = await alist_api_post("/api/fs/list", payload)
         
         if data.get("code") == 200:
-            return True, data.get("data", {}).get("content", [])
+            return True, data.get("data") or {}
         else:
             return False, data.get("message", "Unknown API Error")
     except Exception as e:
         return False, str(e)
+
+async def alist_list_files(path="/", page=1, per_page=0, refresh=False):
+    """
+    调用 Alist API 获取文件列表
+    refresh: 要求 Alist 绕过其自身缓存重新读取存储
+    返回: (success, data_list/error_msg)
+    """
+    success, data = await _fs_list(path, page, per_page, refresh)
+    if not success:
+        return False, data
+    return True, data.get("content") or []
+
+class AlistEntry:
+    """精简的目录条目，只保留浏览器需要的字段"""
+    __slots__ = ('name', 'is_dir', 'size', 'modified')
+
+    def __init__(self, name, is_dir, size, modified):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.modified = modified
+
+class AlistPage:
+    """
+    服务端返回的一页目录数据
+    entries 在加载时排序一次 (文件夹在前)，markup 缓存该页生成的键盘
+    """
+    __slots__ = ('path', 'page', 'per_page', 'total', 'entries', 'approx_bytes', 'markup')
+
+    def __init__(self, path, page, per_page, total, entries, approx_bytes=0):
+        self.path = path
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.entries = entries
+        self.approx_bytes = approx_bytes
+        self.markup = None
+
+    @property
+    def total_pages(self):
+        return (self.total + self.per_page - 1) // self.per_page
+
+async def alist_list_page(path="/", page=1, per_page=15, refresh=False):
+    """
+    分页获取文件列表，由 Alist 服务端切片，大目录也只传输一页数据
+    返回: (success, AlistPage / error_msg)
+    """
+    success, data = await _fs_list(path, page, per_page, refresh)
+    if not success:
+        return False, data
+    content = data.get("content") or []
+    entries = tuple(sorted(
+        (AlistEntry(item.get('name', ''), bool(item.get('is_dir')), item.get('size', 0), item.get('modified', ''))
+         for item in content),
+        key=lambda e: (not e.is_dir, e.name)
+    ))
+    total = data.get("total")
+    if not isinstance(total, int):
+        total = (page - 1) * per_page + len(entries)
+    # 以原始条目估算响应大小 (用于预取预算)
+    approx_bytes = len(json.dumps(content, ensure_ascii=False).encode('utf-8'))
+    return True, AlistPage(path, page, per_page, total, entries, approx_bytes)
+
+# --- 目录列表缓存 ---
+# 所有用户共享，以 (路径, 页码, 每页条数) 为键；总权重为缓存的文件条目数，用于限制内存占用
+_list_config = load_config()
+listing_cache = TTLCache(
+    max_entries=256,
+    ttl=_list_config.get('alist_list_cache_ttl', 120),
+    max_weight=_list_config.get('alist_list_cache_items', 20000),
+)
+
+# 正在进行中的列表请求，预取与用户点击同一页时共享同一个请求
+_listing_inflight = {}
+
+async def _fetch_listing(key, refresh):
+    """拉取一页并写入缓存 (独立任务运行，调用方被取消也不影响结果入缓存)"""
+    path, page, per_page = key
+    try:
+        success, listing = await alist_list_page(path, page, per_page, refresh=refresh)
+        if success:
+            listing_cache.set(key, listing, weight=len(listing.entries) + 1)
+        return success, listing
+    finally:
+        # refresh 时可能已被新的请求替换，只移除自己
+        if _listing_inflight.get(key) is asyncio.current_task():
+            del _listing_inflight[key]
+
+async def get_alist_listing(path="/", page=1, per_page=15, refresh=False):
+    """
+    获取目录的某一页 (优先使用缓存)
+    refresh=True 时清除该目录所有缓存页并要求 Alist 刷新
+    返回: (success, AlistPage / error_msg)
+    """
+    key = (path, page, per_page)
+    if refresh:
+        listing_cache.invalidate(lambda k: k[0] == path)
+    else:
+        listing = listing_cache.get(key)
+        if listing is not None:
+            return True, listing
+        task = _listing_inflight.get(key)
+        if task is not None:
+            return await asyncio.shield(task)
+
+    task = asyncio.get_running_loop().create_task(_fetch_listing(key, refresh))
+    _listing_inflight[key] = task
+    return await asyncio.shield(task)
+
+def invalidate_alist_listing(path=None):
+    """
+    使目录缓存失效
+    path 为空时清空全部 (例如挂载新存储、下载完成后)，否则清除该目录及其子目录
+    """
+    if path is None:
+        listing_cache.invalidate()
+        return
+    prefix = path.rstrip("/") + "/"
+    listing_cache.invalidate(lambda key: key[0] == path or key[0].startswith(prefix))
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import httpx
+from .config import load_config
+
+logger = logging.getLogger("AlistClient")
+
+# 各接口独立超时 (秒)，未列出的接口使用 DEFAULT_TIMEOUT
+ENDPOINT_TIMEOUTS = {
+    "/api/auth/login": 5,
+    "/api/fs/list": 8,
+    "/api/fs/get": 8,
+    "/api/admin/storage/create": 10,
+}
+DEFAULT_TIMEOUT = 8
+
+class AlistClient:
+    """
+    异步 Alist API 客户端。
+    复用同一个 httpx.AsyncClient 保持 keep-alive 连接池，
+    并用信号量限制同时发往 Alist 的请求数量，避免手机端被打满。
+    """
+
+    def __init__(self, base_url, max_concurrency=4):
+        self.base_url = base_url.rstrip("/")
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"User-Agent": "TermuxBot", "Content-Type": "application/json"},
+            limits=httpx.Limits(
+                max_connections=max(2, max_concurrency * 2),
+                max_keepalive_connections=max(1, max_concurrency),
+                keepalive_expiry=60,
+            ),
+            timeout=DEFAULT_TIMEOUT,
+        )
+
+    @property
+    def closed(self):
+        return self._client.is_closed
+
+    async def post(self, endpoint, payload, token=None):
+        """
+        发送 POST 请求。
+        返回: (http_status, data_dict)；网络错误会抛出 httpx.HTTPError
+        """
+        headers = {}
+        if token:
+            headers["Authorization"] = token
+        timeout = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+        async with self._semaphore:
+            resp = await self._client.post(endpoint, json=payload, headers=headers, timeout=timeout)
+
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        return resp.status_code, data
+
+    async def aclose(self):
+        await self._client.aclose()
+
+# 进程级单例，Alist 地址变化时重建
+_client = None
+
+def get_alist_client():
+    """获取共享的 Alist 客户端 (需在事件循环中调用)"""
+    global _client
+    config = load_config()
+    base_url = config.get('alist_host', "http://127.0.0.1:5244").rstrip("/")
+
+    if _client is not None and not _client.closed and _client.base_url == base_url:
+        return _client
+
+    old = _client
+    _client = AlistClient(base_url, max_concurrency=config.get('alist_max_concurrency', 4))
+    if old is not None and not old.closed:
+        # 旧连接池在后台关闭，不阻塞当前请求
+        asyncio.get_running_loop().create_task(old.aclose())
+    logger.info(f"Alist client created for {base_url}")
+    return _client
+
+async def close_alist_client():
+    """关闭共享客户端 (机器人退出时调用)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
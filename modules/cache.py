@@ -0,0 +1,90 @@
+import time
+import threading
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    带过期时间的 LRU 缓存 (线程安全)。
+    - ttl: 默认存活秒数，可在 set 时单独指定
+    - max_entries: 最大条目数
+    - max_weight: 总权重上限 (例如列表条目数)，超出时淘汰最久未使用的条目
+    """
+
+    def __init__(self, max_entries=128, ttl=60, max_weight=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self._data = OrderedDict()  # key -> (value, expires_at, weight)
+        self._weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time.time())
+
+    def set(self, key, value, ttl=None, weight=1):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, weight)
+            self._weight += weight
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def invalidate(self, predicate=None):
+        """删除满足 predicate(key) 的条目；predicate 为空时清空缓存"""
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                self._weight = 0
+                return
+            for key in [k for k in self._data if predicate(k)]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'weight': self._weight,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _remove(self, key):
+        _, _, weight = self._data.pop(key)
+        self._weight -= weight
+
+    def _evict(self):
+        while self._data and (
+            len(self._data) > self.max_entries
+            or (self.max_weight is not None and self._weight > self.max_weight)
+        ):
+            oldest = next(iter(self._data))
+            self._remove(oldest)
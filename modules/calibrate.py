@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+import psutil
+from .config import load_config, save_config
+from .adaptive import build_encoder_ladder, calibration_target, profile_label
+
+logger = logging.getLogger("Calibrate")
+
+# 校准时画质最高从该 preset 开始尝试
+CALIBRATE_START_PRESET = "medium"
+# 每个档位编码的测试画面时长 (秒)
+BENCH_SECONDS = 8
+# 需要达到的实时倍速，留出余量给网络读取和音频
+REQUIRED_SPEED = 1.1
+# 低于该速度直接判定失败并提前结束测试
+MIN_SPEED = 0.3
+
+# 同一时间只允许一次校准，并发测试会互相拖慢并争抢保存结果
+_calibration_lock = asyncio.Lock()
+
+class CalibrationBusy(Exception):
+    pass
+
+def is_calibrating():
+    return _calibration_lock.locked()
+
+def calibration_candidates(config):
+    """从画质最高到最省 CPU 的候选档位 (与自适应档位相同的降级顺序)"""
+    base = dict(config, stream_preset=CALIBRATE_START_PRESET, stream_use_calibration=0)
+    return build_encoder_ladder(base)
+
+async def bench_profile(profile, seconds=BENCH_SECONDS):
+    """
+    用合成测试画面 (testsrc2 + 正弦音频) 以全速编码 seconds 秒内容
+    返回 (实时倍速, 编码帧率, 进程 CPU%)
+    """
+    width, height, fps, kbps = profile['width'], profile['height'], profile['fps'], profile['kbps']
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+        "-t", str(seconds),
+        "-c:v", "libx264", "-preset", profile['preset'], "-pix_fmt", "yuv420p",
+        "-g", str(fps * 2),
+        "-b:v", f"{kbps}k", "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k",
+        "-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k",
+        "-f", "null", "-"
+    ]
+    started = time.time()
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    cpu_time, cpu_elapsed = 0.0, 0.0
+    try:
+        ps = psutil.Process(process.pid)
+    except psutil.Error:
+        ps = None
+
+    timeout = seconds / MIN_SPEED
+    timed_out = False
+    while process.returncode is None:
+        try:
+            await asyncio.wait_for(process.wait(), timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+        if ps is not None and process.returncode is None:
+            try:
+                times = ps.cpu_times()
+                cpu_time, cpu_elapsed = times.user + times.system, time.time() - started
+            except psutil.Error:
+                pass
+        if process.returncode is None and time.time() - started > timeout:
+            timed_out = True
+            process.kill()
+            await process.wait()
+
+    elapsed = max(time.time() - started, 0.001)
+    if process.returncode != 0 and not timed_out:
+        raise RuntimeError(f"FFmpeg 退出码 {process.returncode}")
+    # 超时时内容尚未编码完，按全部时长计算的速度只是上限 (已低于 MIN_SPEED)
+    cpu = cpu_time * 100 / cpu_elapsed if cpu_elapsed else 0
+    return seconds / elapsed, seconds * fps / elapsed, cpu
+
+async def run_calibration(progress=None):
+    """
+    依次测试候选档位，保存第一个 (画质最高的) 能稳定达到 REQUIRED_SPEED 倍实时的档位。
+    progress: 每测完一个档位调用 progress(results)
+    返回 (选中的档位或 None, [(档位, 倍速, 帧率, CPU%)])；已有校准在运行时抛出 CalibrationBusy
+    """
+    if _calibration_lock.locked():
+        raise CalibrationBusy("已有校准正在进行")
+    async with _calibration_lock:
+        return await _run_calibration(progress)
+
+async def _run_calibration(progress):
+    config = load_config()
+    results = []
+    chosen = None
+    for profile in calibration_candidates(config):
+        speed, fps, cpu = await bench_profile(profile)
+        results.append((profile, speed, fps, cpu))
+        logger.info(f"校准 {profile_label(profile)}: {speed:.2f}x, {fps:.0f}fps, CPU {cpu:.0f}%")
+        if progress:
+            await progress(results)
+        if speed >= REQUIRED_SPEED:
+            chosen = profile
+            break
+
+    if chosen is not None:
+        best = results[-1]
+        save_config({'calibrated_profile': dict(
+            chosen,
+            target=calibration_target(config),
+            speed=round(best[1], 2),
+            cpu=round(best[3]),
+            calibrated_at=int(time.time()),
+        )})
+    return chosen, results
+
+def calibration_text(results, chosen=None, done=False):
+    lines = ["🧪 **编码性能校准**", f"目标: {calibration_target(load_config())}, 需要 ≥{REQUIRED_SPEED}x 实时", ""]
+    for profile, speed, fps, cpu in results:
+        mark = "✅" if speed >= REQUIRED_SPEED else "❌"
+        lines.append(f"{mark} `{profile_label(profile)}` {speed:.2f}x {fps:.0f}fps CPU {cpu:.0f}%")
+    if done:
+        lines.append("")
+        if chosen:
+            lines.append(f"💾 已保存默认编码档位: `{profile_label(chosen)}`")
+        else:
+            lines.append("⚠️ 所有档位都达不到实时，未保存校准结果")
+    else:
+        lines.append("\n⏳ 测试中...")
+    return "\n".join(lines)
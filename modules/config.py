@@ -2,6 +2,10 @@ import json
 import os
 import logging
 import sys
+import atexit
+import tempfile
+import threading
+from types import MappingProxyType
 from dotenv import load_dotenv
 
 # --- 加载环境变量 (.env) ---
@@ -42,21 +46,155 @@ def is_owner(user_id):
     owner_id = config.get('owner_id', 0)
     return uid_str == str(owner_id).strip()
 
-def load_config():
-    """
-    加载配置文件。
-    兼容新旧环境变量名称。
-    """
-    config = {}
-    
-    # 1. 尝试读取本地文件
-    if os.path.exists(CONFIG_FILE):
+# --- 配置快照缓存 ---
+# 每个 update 都会调用 is_owner() -> load_config()，为避免反复打开/解析 JSON，
+# 这里保存一份进程级只读快照，仅当配置文件的 mtime/size 变化或 save_config 写入后才重建。
+#
+# 持久化层：_raw_config 是 bot_config.json 在内存中的权威副本。
+# save_config 只更新内存并安排延迟写盘，短时间内的多次更新合并为一次原子写入
+# (临时文件 + fsync + rename)，进程退出时 flush_config 会写出剩余修改。
+SAVE_COALESCE_DELAY = float(os.getenv('CONFIG_SAVE_DELAY', 0.5))
+
+_config_lock = threading.RLock()
+_config_snapshot = None
+_config_signature = None
+_config_stats = {'hits': 0, 'misses': 0, 'disk_reads': 0, 'disk_writes': 0, 'coalesced': 0}
+
+_raw_config = None
+_raw_signature = None
+_dirty = False
+_flush_timer = None
+
+def _get_file_signature():
+    """返回配置文件的 (mtime_ns, size)，文件不存在时返回 None"""
+    try:
+        st = os.stat(CONFIG_FILE)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def _freeze(value):
+    """将配置值转换为只读结构，防止调用方意外修改共享快照"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def _read_raw_locked(signature):
+    """从磁盘读取配置文件到内存副本 (调用方需持有锁)"""
+    global _raw_config, _raw_signature
+    data = {}
+    if signature is not None:
         try:
             with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+                data = json.load(f)
+            _config_stats['disk_reads'] += 1
         except Exception as e:
             logger.error(f"加载配置失败: {e}")
-            
+            if _raw_config is not None:
+                # 文件损坏时保留内存中的上一份有效配置
+                return
+            # 备份损坏的文件，避免下一次写入将其覆盖后无法找回
+            try:
+                os.replace(CONFIG_FILE, CONFIG_FILE + ".corrupt")
+                logger.warning(f"已将损坏的配置文件备份为 {CONFIG_FILE}.corrupt")
+                signature = None
+            except OSError:
+                pass
+    _raw_config = data if isinstance(data, dict) else {}
+    _raw_signature = signature
+
+def _write_atomic(data):
+    """写入临时文件并 fsync 后 rename，保证配置文件不会半写"""
+    target = os.path.abspath(CONFIG_FILE)
+    directory = os.path.dirname(target)
+    fd, tmp_path = tempfile.mkstemp(prefix=".bot_config.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, target)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    # 目录 fsync 确保 rename 落盘 (部分文件系统不支持，忽略错误)
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+def flush_config():
+    """立即写出尚未落盘的配置修改"""
+    global _dirty, _flush_timer, _raw_signature, _config_signature
+    with _config_lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        if not _dirty:
+            return True
+        try:
+            _write_atomic(_raw_config)
+        except Exception as e:
+            logger.error(f"保存配置失败: {e}")
+            return False
+        _dirty = False
+        _config_stats['disk_writes'] += 1
+        # 记录自己写入后的签名，避免被当作外部修改而重复解析
+        _raw_signature = _get_file_signature()
+        if _config_snapshot is not None:
+            _config_signature = _raw_signature
+        logger.info("配置已保存")
+        return True
+
+atexit.register(flush_config)
+
+def invalidate_config_cache():
+    """强制下次 load_config() 重新构建快照"""
+    global _config_snapshot, _config_signature
+    with _config_lock:
+        _config_snapshot = None
+        _config_signature = None
+
+def get_config_cache_stats():
+    """返回配置快照的命中/重建次数及读写盘次数"""
+    with _config_lock:
+        stats = dict(_config_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = (stats['hits'] / total) if total else 0.0
+    return stats
+
+def load_config():
+    """
+    加载配置 (只读快照)。
+    兼容新旧环境变量名称。
+    返回值为只读映射，需要修改时请先复制，例如 list(config['stream_keys'])。
+    """
+    global _config_snapshot, _config_signature
+    signature = _get_file_signature()
+    with _config_lock:
+        # 有未落盘的修改时，内存副本才是权威版本，忽略磁盘变化
+        if _config_snapshot is not None and (_dirty or signature == _config_signature):
+            _config_stats['hits'] += 1
+            return _config_snapshot
+
+        _config_stats['misses'] += 1
+        if _raw_config is None or (not _dirty and signature != _raw_signature):
+            _read_raw_locked(signature)
+        _config_snapshot = _freeze(_build_config(dict(_raw_config)))
+        _config_signature = signature
+        return _config_snapshot
+
+def _build_config(config):
+    """根据配置文件内容与环境变量，生成完整配置字典"""
     # --- 迁移与初始化逻辑 ---
     if 'stream_keys' not in config:
         config['stream_keys'] = []
@@ -89,9 +227,46 @@ def load_config():
         
         # Alist 配置
         'alist_host': env_alist_host or config.get('alist_host', 'http://127.0.0.1:5244'),
-        'alist_token': os.getenv('ALIST_TOKEN', config.get('alist_token', '')),
+        # ALIST_TOKEN 只作为初始值：登录刷新后保存的新 Token 优先，否则每次都会退回已过期的环境变量值
+        'alist_token': config.get('alist_token') or os.getenv('ALIST_TOKEN', ''),
         'alist_user': os.getenv('ALIST_USER', config.get('alist_user', 'admin')),
         'alist_password': os.getenv('ALIST_PASSWORD', config.get('alist_password', '')),
+        'alist_max_concurrency': int(os.getenv('ALIST_MAX_CONCURRENCY', config.get('alist_max_concurrency', 4))),
+        'alist_list_cache_ttl': int(os.getenv('ALIST_LIST_CACHE_TTL', config.get('alist_list_cache_ttl', 120))),
+        'alist_list_cache_items': int(os.getenv('ALIST_LIST_CACHE_ITEMS', config.get('alist_list_cache_items', 20000))),
+        'alist_prefetch_concurrency': int(os.getenv('ALIST_PREFETCH_CONCURRENCY', config.get('alist_prefetch_concurrency', 2))),
+        'alist_prefetch_dirs': int(os.getenv('ALIST_PREFETCH_DIRS', config.get('alist_prefetch_dirs', 3))),
+        'alist_prefetch_budget_kb': int(os.getenv('ALIST_PREFETCH_BUDGET_KB', config.get('alist_prefetch_budget_kb', 256))),
+        'alist_link_ttl': int(os.getenv('ALIST_LINK_TTL', config.get('alist_link_ttl', 300))),
+        'alist_index_interval': int(os.getenv('ALIST_INDEX_INTERVAL', config.get('alist_index_interval', 360))),
+        'alist_index_concurrency': int(os.getenv('ALIST_INDEX_CONCURRENCY', config.get('alist_index_concurrency', 2))),
+        'alist_index_full_interval': int(os.getenv('ALIST_INDEX_FULL_INTERVAL', config.get('alist_index_full_interval', 24))),
+        'stream_max_sessions': int(os.getenv('STREAM_MAX_SESSIONS', config.get('stream_max_sessions', 3))),
+        'stream_cpu_reserve': int(os.getenv('STREAM_CPU_RESERVE', config.get('stream_cpu_reserve', 20))),
+        'stream_session_cpu_min': int(os.getenv('STREAM_SESSION_CPU_MIN', config.get('stream_session_cpu_min', 50))),
+        'stream_passthrough': int(os.getenv('STREAM_PASSTHROUGH', config.get('stream_passthrough', 1))),
+        'stream_copy_max_gop': float(os.getenv('STREAM_COPY_MAX_GOP', config.get('stream_copy_max_gop', 4))),
+        'stream_loop_clip': int(os.getenv('STREAM_LOOP_CLIP', config.get('stream_loop_clip', 1))),
+        'loop_cache_max_mb': int(os.getenv('LOOP_CACHE_MAX_MB', config.get('loop_cache_max_mb', 500))),
+        'playlist_loop': int(os.getenv('PLAYLIST_LOOP', config.get('playlist_loop', 0))),
+        'stream_ready_timeout': int(os.getenv('STREAM_READY_TIMEOUT', config.get('stream_ready_timeout', 20))),
+        'stream_adaptive': int(os.getenv('STREAM_ADAPTIVE', config.get('stream_adaptive', 1))),
+        'stream_adapt_down_speed': float(os.getenv('STREAM_ADAPT_DOWN_SPEED', config.get('stream_adapt_down_speed', 0.95))),
+        'stream_adapt_up_cpu': int(os.getenv('STREAM_ADAPT_UP_CPU', config.get('stream_adapt_up_cpu', 60))),
+        'stream_recover_retries': int(os.getenv('STREAM_RECOVER_RETRIES', config.get('stream_recover_retries', 5))),
+        'stream_recover_window': int(os.getenv('STREAM_RECOVER_WINDOW', config.get('stream_recover_window', 600))),
+        'stream_proxy': int(os.getenv('STREAM_PROXY', config.get('stream_proxy', 0))),
+        'stream_proxy_readahead_mb': int(os.getenv('STREAM_PROXY_READAHEAD_MB', config.get('stream_proxy_readahead_mb', 32))),
+        'stream_proxy_cache_mb': int(os.getenv('STREAM_PROXY_CACHE_MB', config.get('stream_proxy_cache_mb', 1024))),
+        'stream_record': int(os.getenv('STREAM_RECORD', config.get('stream_record', 0))),
+        'record_segment_seconds': int(os.getenv('RECORD_SEGMENT_SECONDS', config.get('record_segment_seconds', 600))),
+        'record_max_mb': int(os.getenv('RECORD_MAX_MB', config.get('record_max_mb', 2048))),
+        'stream_use_calibration': int(os.getenv('STREAM_USE_CALIBRATION', config.get('stream_use_calibration', 1))),
+        'calibrated_profile': config.get('calibrated_profile'),
+        'pretranscode': int(os.getenv('PRETRANSCODE', config.get('pretranscode', 1))),
+        'pretranscode_preset': os.getenv('PRETRANSCODE_PRESET', config.get('pretranscode_preset', 'slow')),
+        'pretranscode_charging_only': int(os.getenv('PRETRANSCODE_CHARGING_ONLY', config.get('pretranscode_charging_only', 0))),
+        'prepared_max_mb': int(os.getenv('PREPARED_MAX_MB', config.get('prepared_max_mb', 4096))),
         
         # Git / AutoUpdate 配置
         'github_owner': os.getenv('GITHUB_OWNER', config.get('github_owner', '')),
@@ -116,17 +291,25 @@ def load_config():
     return final_config
 
 def save_config(config_update):
-    """保存配置文件到 bot_config.json"""
+    """
+    保存配置到 bot_config.json。
+    修改立即在内存中生效，磁盘写入延迟 SAVE_COALESCE_DELAY 秒并与期间的其他修改合并。
+    """
+    global _dirty, _flush_timer
     try:
-        current_config = {}
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                current_config = json.load(f)
-        
-        current_config.update(config_update)
-        
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(current_config, f, indent=4)
-        logger.info("配置已保存")
+        with _config_lock:
+            if _raw_config is None or (not _dirty and _get_file_signature() != _raw_signature):
+                _read_raw_locked(_get_file_signature())
+
+            _raw_config.update(config_update)
+            if _dirty:
+                _config_stats['coalesced'] += 1
+            _dirty = True
+            invalidate_config_cache()
+
+            if _flush_timer is None:
+                _flush_timer = threading.Timer(SAVE_COALESCE_DELAY, flush_config)
+                _flush_timer.daemon = True
+                _flush_timer.start()
     except Exception as e:
-        logger.error(f"保存配置失败: {e}")
\ No newline at end of file
+        logger.error(f"保存配置失败: {e}")
@@ -3,6 +3,7 @@ import os
 import logging
 import psutil
 import time
+from .alist import invalidate_alist_listing
 
 logger = logging.getLogger("Downloader")
 
@@ -74,6 +75,8 @@ async def aria2_download_task(url: str, context, chat_id: int):
         stdout, stderr = await process.communicate()
         
         if process.returncode == 0:
+            # 新文件会出现在本机存储挂载中，清除目录缓存
+            invalidate_alist_listing()
             await context.bot.send_message(
                 chat_id=chat_id,
                 text=f"✅ **下载完成**\n\n📂 目录: `{download_dir}`\n📄 文件: `{filename_hint}`\n\n提示: 您现在可以在 [☁️ 云盘浏览] -> [{download_dir}] 中找到它。",
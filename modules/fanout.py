@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from .process import stop_process
+
+logger = logging.getLogger("FanOut")
+
+PUMP_CHUNK = 64 * 1024
+# 每个目标最多积压的数据块数，超出说明该目标卡住，单独重连
+RELAY_QUEUE = 64
+RELAY_MAX_DELAY = 30
+# 连接稳定超过该时间后，重连等待时间重新从头计算
+RELAY_STABLE = 60
+
+class RtmpRelay:
+    """
+    单个推流目标。
+    独立的 FFmpeg 从 stdin 读取编码好的 MPEG-TS 并直接封装推到一个 RTMP 地址；
+    进程退出或积压过多时只重连这一路，不影响其他目标。
+    """
+
+    def __init__(self, name, url, log_path):
+        self.name = name
+        self.url = url
+        self.log_path = log_path
+        self.process = None
+        self.state = "starting"
+        self.restarts = 0
+        self.closed = False
+        self._queue = None
+        self._task = None
+        self._skip_delay = False
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        delay = 0
+        while not self.closed:
+            if delay and not self._skip_delay:
+                self.state = "waiting"
+                await asyncio.sleep(delay)
+            self._skip_delay = False
+            if self.closed:
+                return
+
+            cmd = [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-f", "mpegts", "-i", "pipe:0",
+                "-map", "0", "-c", "copy",
+                "-f", "flv", "-flvflags", "no_duration_filesize",
+                self.url
+            ]
+            try:
+                with open(self.log_path, "a", encoding='utf-8') as log_file:
+                    process = await asyncio.create_subprocess_exec(
+                        *cmd, stdin=asyncio.subprocess.PIPE,
+                        stdout=asyncio.subprocess.DEVNULL, stderr=log_file
+                    )
+            except Exception as e:
+                logger.error(f"[{self.name}] 启动转推进程失败: {e}")
+                delay = min(max(delay * 2, 2), RELAY_MAX_DELAY)
+                continue
+
+            self.process = process
+            self._queue = asyncio.Queue(maxsize=RELAY_QUEUE)
+            self.state = "connected"
+            started = time.time()
+            writer = asyncio.get_running_loop().create_task(self._write(process, self._queue))
+            waiter = asyncio.get_running_loop().create_task(process.wait())
+            try:
+                await asyncio.wait({writer, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                writer.cancel()
+                self._queue = None
+                if process.returncode is None:
+                    try:
+                        process.kill()
+                    except ProcessLookupError:
+                        pass
+                await process.wait()
+
+            if self.closed:
+                return
+            self.restarts += 1
+            delay = 2 if time.time() - started > RELAY_STABLE else min(max(delay * 2, 2), RELAY_MAX_DELAY)
+            self.state = "reconnecting"
+            logger.warning(f"[{self.name}] 转推中断 (退出码 {process.returncode})，{delay}s 后重连 (第 {self.restarts} 次)")
+
+    async def _write(self, process, queue):
+        try:
+            while True:
+                chunk = await queue.get()
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError, RuntimeError):
+            return
+
+    def feed(self, chunk):
+        """非阻塞地投递数据；积压过多时丢弃该连接并重连"""
+        queue = self._queue
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(chunk)
+        except asyncio.QueueFull:
+            logger.warning(f"[{self.name}] 目标写入过慢，重新连接")
+            self._queue = None
+            self._kill()
+
+    def reset(self):
+        """编码器重启后立即重连 (新编码器的时间戳从头开始)"""
+        self._skip_delay = True
+        self._kill()
+
+    def _kill(self):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
+    async def close(self):
+        self.closed = True
+        if self.process is not None:
+            # 关闭 stdin 让 FFmpeg 正常写完 FLV 尾部
+            await stop_process(self.process, quit_input=b"")
+        if self._task is not None:
+            self._task.cancel()
+
+    def status_text(self):
+        labels = {
+            "starting": "⏳ 连接中",
+            "connected": "🟢 推流中",
+            "waiting": "🔄 等待重连",
+            "reconnecting": "🔄 重连中",
+        }
+        text = f"📡 {self.name}: {labels.get(self.state, self.state)}"
+        if self.restarts:
+            text += f" (已重连 {self.restarts} 次)"
+        return text
+
+class FanOut:
+    """
+    一次编码，多路推流。
+    编码器输出 MPEG-TS 到 stdout，由本对象复制给每个目标的转推进程。
+    """
+
+    def __init__(self, destinations, log_path):
+        self.relays = [RtmpRelay(name, url, log_path) for name, url in destinations]
+        self._pump = None
+        self._attached = False
+
+    def start(self):
+        for relay in self.relays:
+            relay.start()
+
+    def attach(self, process):
+        """接入 (新的) 编码器进程的输出"""
+        if self._pump is not None and not self._pump.done():
+            self._pump.cancel()
+        if self._attached:
+            for relay in self.relays:
+                relay.reset()
+        self._attached = True
+        self._pump = asyncio.get_running_loop().create_task(self._pump_from(process))
+
+    async def _pump_from(self, process):
+        while True:
+            chunk = await process.stdout.read(PUMP_CHUNK)
+            if not chunk:
+                return
+            for relay in self.relays:
+                relay.feed(chunk)
+
+    async def stop(self):
+        if self._pump is not None:
+            self._pump.cancel()
+        await asyncio.gather(*(relay.close() for relay in self.relays), return_exceptions=True)
+
+    def status_text(self):
+        return "\n   ".join(relay.status_text() for relay in self.relays)
@@ -11,42 +11,32 @@ def get_main_menu_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
-def get_alist_browser_keyboard(current_path, items, page=0):
+# Alist 浏览器每页条目数 (同时作为服务端分页的 per_page)
+ALIST_PAGE_SIZE = 15
+
+def get_alist_browser_keyboard(listing):
     """
     生成 Alist 文件浏览器键盘
-    current_path: 当前路径字符串
-    items: 文件对象列表
-    page: 当前页码
+    listing: 当前页数据 (AlistPage，条目已按文件夹优先排序)
+    生成结果缓存在 listing.markup 上，翻回同一页时直接复用
     """
+    if listing.markup is not None:
+        return listing.markup
+
     keyboard = []
+    current_path = listing.path
+    page = listing.page - 1
+    total_pages = listing.total_pages
     
-    # 排序：文件夹在前，文件在后
-    items.sort(key=lambda x: (not x['is_dir'], x['name']))
-    
-    # 分页设置
-    PAGE_SIZE = 15
-    total_items = len(items)
-    total_pages = (total_items + PAGE_SIZE - 1) // PAGE_SIZE
-    
-    # 修正页码范围
-    if page < 0: page = 0
-    if page >= total_pages and total_pages > 0: page = total_pages - 1
-    
-    start = page * PAGE_SIZE
-    end = start + PAGE_SIZE
-    display_items = items[start:end]
-    
-    for idx, item in enumerate(display_items):
-        # 使用绝对索引作为 callback
-        abs_idx = start + idx
-        name = item['name']
-        is_dir = item['is_dir']
+    for idx, item in enumerate(listing.entries):
+        name = item.name
         
         # 截断长文件名
         if len(name) > 30: name = name[:28] + ".."
         
-        icon = "📂" if is_dir else "📄"
-        callback = f"alist_go:{abs_idx}"
+        icon = "📂" if item.is_dir else "📄"
+        # 使用页内索引作为 callback
+        callback = f"alist_go:{idx}"
         
         keyboard.append([InlineKeyboardButton(f"{icon} {name}", callback_data=callback)])
     
@@ -69,19 +59,35 @@ def get_alist_browser_keyboard(current_path, items, page=0):
     if current_path != "/":
         nav_row.append(InlineKeyboardButton("🔙 上一级", callback_data="alist_up"))
     
+    nav_row.append(InlineKeyboardButton("🔄 刷新", callback_data="alist_refresh"))
     nav_row.append(InlineKeyboardButton("❌ 关闭", callback_data="btn_close"))
     keyboard.append(nav_row)
     
-    return InlineKeyboardMarkup(keyboard)
+    listing.markup = InlineKeyboardMarkup(keyboard)
+    return listing.markup
 
 def get_alist_file_actions_keyboard():
     """文件操作菜单"""
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📺 直播推流", callback_data="alist_act_stream")],
         [InlineKeyboardButton("📥 离线下载", callback_data="alist_act_download")],
+        [InlineKeyboardButton("📦 空闲时预转码", callback_data="alist_act_prepare")],
         [InlineKeyboardButton("🔙 返回列表", callback_data="alist_act_back")]
     ])
 
+def get_stream_sessions_keyboard(sessions):
+    """推流会话列表菜单：每个会话一行 (日志/停止)"""
+    keyboard = []
+    for sess in sessions:
+        keyboard.append([
+            InlineKeyboardButton(f"📜 #{sess.id} {sess.key_name}", callback_data=f"btn_view_log:{sess.id}"),
+            InlineKeyboardButton(f"🛑 停止 #{sess.id}", callback_data=f"btn_stop_stream_quick:{sess.id}")
+        ])
+    if len(sessions) > 1:
+        keyboard.append([InlineKeyboardButton("⛔ 全部停止", callback_data="btn_stop_stream_quick:all")])
+    keyboard.append([InlineKeyboardButton("❌ 关闭", callback_data="btn_close")])
+    return InlineKeyboardMarkup(keyboard)
+
 # --- 以下保留 Inline 键盘用于子菜单和列表选择 ---
 
 def get_settings_keyboard():
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger("LoopClip")
+
+LOOP_CACHE_DIR = "loop_cache"
+# 渲染参数变化时递增，使旧缓存失效
+CLIP_VERSION = 1
+# 单图模式的循环片段时长 (秒)
+SINGLE_IMAGE_SECONDS = 10
+RENDER_TIMEOUT = 600
+
+class LoopClipCache:
+    """
+    图片循环片段缓存。
+    把图片序列 (轮播或单图) 一次性渲染成关键帧对齐的短视频，
+    推流时用 -stream_loop 循环该片段并直接封装，只有音频需要实时编码。
+    片段以 (图片内容标识, 分辨率, 帧率, 每张时长) 为键缓存在磁盘上。
+    """
+
+    def __init__(self, cache_dir=LOOP_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._inflight = {}
+
+    def clip_key(self, images, width, height, fps, img_duration):
+        """图片路径 + 大小 + 修改时间 + 渲染参数 的摘要"""
+        h = hashlib.sha1(f"v{CLIP_VERSION}|{width}x{height}@{fps}|{img_duration}".encode())
+        for path in images:
+            st = os.stat(path)
+            h.update(f"|{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}".encode())
+        return h.hexdigest()[:20]
+
+    def clip_path(self, key):
+        return os.path.join(self.cache_dir, f"loop_{key}.mp4")
+
+    async def get_clip(self, images, width, height, fps, img_duration=10, max_mb=500, in_use=()):
+        """
+        返回可循环的片段路径，不存在时渲染 (同一片段并发请求只渲染一次)
+        渲染失败返回 None，调用方应回退到实时编码
+        in_use: 正在推流中使用的缓存文件，淘汰时跳过
+        """
+        try:
+            key = self.clip_key(images, width, height, fps, img_duration)
+        except OSError as e:
+            logger.warning(f"读取图片失败: {e}")
+            return None
+
+        path = self.clip_path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(
+                self._render(key, images, width, height, fps, img_duration, max_mb, in_use)
+            )
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _render(self, key, images, width, height, fps, img_duration, max_mb, in_use):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.clip_path(key)
+        tmp_path = path + ".part.mp4"
+        list_file = os.path.join(self.cache_dir, f"loop_{key}.txt")
+
+        if len(images) == 1:
+            duration = SINGLE_IMAGE_SECONDS
+            inputs = ["-loop", "1", "-framerate", str(fps), "-i", images[0]]
+        else:
+            duration = len(images) * img_duration
+            with open(list_file, "w", encoding='utf-8') as f:
+                for img_path in images:
+                    safe_path = os.path.abspath(img_path).replace("'", "'\\''")
+                    f.write(f"file '{safe_path}'\n")
+                    f.write(f"duration {img_duration}\n")
+                # concat 需要重复最后一张图片才能使其时长生效
+                safe_path = os.path.abspath(images[-1]).replace("'", "'\\''")
+                f.write(f"file '{safe_path}'\n")
+            inputs = ["-f", "concat", "-safe", "0", "-i", list_file]
+
+        gop = fps * 2
+        cmd = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            *inputs,
+            "-vf", (
+                f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,fps={fps},format=yuv420p"
+            ),
+            "-t", str(duration),
+            "-c:v", "libx264", "-preset", "veryfast", "-tune", "stillimage",
+            # 固定 GOP 且片段时长为 GOP 整数倍，循环衔接处正好是关键帧
+            "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+            "-b:v", "1000k", "-maxrate", "1500k", "-bufsize", "2000k",
+            "-an", "-movflags", "+faststart",
+            tmp_path
+        ]
+
+        logger.info(f"渲染循环片段 {key} ({len(images)} 张图, {duration}s)")
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), timeout=RENDER_TIMEOUT)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                logger.warning(f"循环片段渲染超时: {key}")
+                return None
+            if proc.returncode != 0:
+                logger.warning(f"循环片段渲染失败: {stderr.decode(errors='ignore').strip()[:300]}")
+                return None
+            os.replace(tmp_path, path)
+            prune_loop_cache(self.cache_dir, max_mb, keep={path, *in_use})
+            return path
+        except Exception as e:
+            logger.warning(f"循环片段渲染异常: {e}")
+            return None
+        finally:
+            self._inflight.pop(key, None)
+            for leftover in (tmp_path, list_file):
+                if os.path.exists(leftover):
+                    try: os.remove(leftover)
+                    except OSError: pass
+
+def prune_loop_cache(cache_dir, max_mb, keep=()):
+    """
+    按最近使用时间淘汰图片片段和视频编码缓存，使缓存总大小不超过 max_mb
+    keep: 不淘汰的文件 (刚写入的和推流中正在循环读取的，后者的修改时间不会更新)
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    clips = []
+    for name in os.listdir(cache_dir):
+        if name.startswith("loop_") and name.endswith((".mp4", ".ts")) and ".part" not in name:
+            full = os.path.join(cache_dir, name)
+            st = os.stat(full)
+            clips.append((st.st_mtime, st.st_size, full))
+    clips.sort()
+    total = sum(size for _, size, _ in clips)
+    limit = max_mb * 1024 * 1024
+    for _, size, full in clips:
+        if total <= limit:
+            break
+        if os.path.abspath(full) in keep:
+            continue
+        try:
+            os.remove(full)
+            total -= size
+        except OSError:
+            pass
+
+class EncodedLoopCache:
+    """
+    纯视频循环推流的编码结果缓存。
+    第一遍推流时把编码后的数据同时写入 .part 文件，完整播完一遍 (中途没有重启) 才转为正式缓存；
+    之后的循环直接封装该文件，不再编码。
+    以 (源文件版本键, 编码档位) 为键，与图片片段共用 loop_cache/ 目录和 LRU 淘汰。
+    """
+
+    def __init__(self, cache_dir=LOOP_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def cache_key(self, source_key, profile):
+        label = f"{profile['width']}x{profile['height']}@{profile['fps']}|{profile['preset']}|{profile['kbps']}"
+        return hashlib.sha1(f"v{CLIP_VERSION}|{source_key}|{label}".encode()).hexdigest()[:20]
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"loop_enc_{key}.ts")
+
+    def part_path(self, key):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return os.path.join(self.cache_dir, f"loop_enc_{key}.part.ts")
+
+    def lookup(self, source_key, profiles):
+        """按档位顺序 (画质从高到低) 返回第一个已缓存的 (档位, 路径)，没有返回 None"""
+        for profile in profiles:
+            path = self.path(self.cache_key(source_key, profile))
+            if os.path.exists(path):
+                os.utime(path)
+                return profile, path
+        return None
+
+    def commit(self, key, max_mb=500, in_use=()):
+        """
+        第一遍完整播完后把 .part 转为正式缓存，返回路径；文件不存在返回 None
+        in_use: 正在推流中使用的缓存文件，淘汰时跳过
+        """
+        part, path = self.part_path(key), self.path(key)
+        if not os.path.exists(part) or os.path.getsize(part) == 0:
+            return None
+        os.replace(part, path)
+        prune_loop_cache(self.cache_dir, max_mb, keep={path, *in_use})
+        return path
+
+    def discard(self, key):
+        try:
+            os.remove(self.part_path(key))
+        except OSError:
+            pass
+
+loop_clip_cache = LoopClipCache()
+loop_video_cache = EncodedLoopCache()
@@ -0,0 +1,291 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("Media")
+
+MEDIA_DB = "media_cache.db"
+# 探测结果格式变化时递增，使旧记录失效
+MEDIA_INFO_VERSION = 1
+
+# 可以直接封装进 FLV 的编码
+COPY_VIDEO_CODECS = ("h264",)
+COPY_AUDIO_CODECS = ("aac",)
+# 推流平台普遍支持的 H.264 Profile
+COPY_H264_PROFILES = ("Constrained Baseline", "Baseline", "Main", "High")
+
+async def _run_ffprobe(args, timeout):
+    """执行 ffprobe 并解析 JSON 输出，失败返回 None"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-print_format", "json", *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    except FileNotFoundError:
+        logger.warning("ffprobe 不可用")
+        return None
+
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        logger.warning(f"ffprobe 超时 ({timeout}s)")
+        return None
+
+    if proc.returncode != 0:
+        logger.warning(f"ffprobe 失败: {stderr.decode(errors='ignore').strip()[:200]}")
+        return None
+    try:
+        return json.loads(stdout.decode(errors='ignore') or "{}")
+    except ValueError:
+        return None
+
+def _parse_rate(rate):
+    """'30000/1001' -> 29.97"""
+    try:
+        num, _, den = str(rate).partition("/")
+        num, den = float(num), float(den or 1)
+        return num / den if den else 0.0
+    except ValueError:
+        return 0.0
+
+def _keyframe_interval(packets):
+    """根据视频包的关键帧时间戳计算最大 GOP 间隔 (秒)，样本不足返回 None"""
+    times = []
+    for pkt in packets:
+        if "K" in pkt.get("flags", "") and pkt.get("pts_time") not in (None, "N/A"):
+            times.append(float(pkt["pts_time"]))
+    if len(times) < 2:
+        return None
+    times.sort()
+    return max(b - a for a, b in zip(times, times[1:]))
+
+class MediaInfoStore:
+    """
+    媒体信息的持久缓存 (SQLite)。
+    以文件版本 (本地: 路径 + 大小 + mtime；Alist: 路径 + 大小 + 修改时间) 为键保存 ffprobe 结果，
+    同一文件再次推流或在文件菜单中查看时无需重新探测。
+    数据库操作在单独的线程中串行执行。
+    """
+
+    def __init__(self, db_path=MEDIA_DB, max_entries=5000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media-cache")
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS media (key TEXT PRIMARY KEY, info TEXT NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _get(self, key):
+        db = self._db()
+        row = db.execute("SELECT info FROM media WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with db:
+            db.execute("UPDATE media SET used_at = ? WHERE key = ?", (time.time(), key))
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+
+    def _put(self, key, info):
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO media (key, info, used_at) VALUES (?, ?, ?)",
+                (key, json.dumps(info, ensure_ascii=False), time.time())
+            )
+            # 只保留最近使用的 max_entries 条
+            db.execute(
+                "DELETE FROM media WHERE key NOT IN (SELECT key FROM media ORDER BY used_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+
+    async def _run_db(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def get(self, key):
+        try:
+            return await self._run_db(self._get, key)
+        except sqlite3.Error as e:
+            logger.warning(f"读取媒体信息缓存失败: {e}")
+            return None
+
+    async def put(self, key, info):
+        try:
+            await self._run_db(self._put, key, info)
+        except sqlite3.Error as e:
+            logger.warning(f"写入媒体信息缓存失败: {e}")
+
+media_info_store = MediaInfoStore()
+
+def local_media_key(path):
+    """本地文件的缓存键，文件不存在返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"v{MEDIA_INFO_VERSION}|local|{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+def alist_media_key(path, size, modified):
+    return f"v{MEDIA_INFO_VERSION}|alist|{path}|{size}|{modified}"
+
+async def probe_media(src, input_opts=None, timeout=15, gop_window=12, cache_key=None):
+    """
+    探测媒体信息。
+    input_opts: 与 FFmpeg 相同的输入参数 (如 -headers / -user_agent)
+    gop_window: 读取开头多少秒的视频包来估算关键帧间隔 (只读包头，不解码)
+    cache_key: 文件版本键，命中缓存时不再运行 ffprobe
+    返回 dict: video / audio (ffprobe stream 字典或 None)、duration、bit_rate、gop
+    """
+    if cache_key:
+        cached = await media_info_store.get(cache_key)
+        if cached is not None:
+            return cached
+        result = await _probe_media(src, input_opts, timeout, gop_window)
+        if result is not None:
+            await media_info_store.put(cache_key, result)
+        return result
+    return await _probe_media(src, input_opts, timeout, gop_window)
+
+async def _probe_media(src, input_opts, timeout, gop_window):
+    input_opts = list(input_opts or [])
+    info = await _run_ffprobe(
+        input_opts + ["-show_streams", "-show_format", src], timeout
+    )
+    if not info:
+        return None
+
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"
+                  and not s.get("disposition", {}).get("attached_pic")), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    fmt = info.get("format", {})
+
+    result = {
+        "video": video,
+        "audio": audio,
+        "duration": float(fmt.get("duration") or 0),
+        "bit_rate": int(fmt.get("bit_rate") or 0),
+        "gop": None,
+    }
+
+    if video and video.get("codec_name") in COPY_VIDEO_CODECS:
+        packets = await _run_ffprobe(
+            input_opts + [
+                "-select_streams", "v:0", "-read_intervals", f"%+{gop_window}",
+                "-show_entries", "packet=pts_time,flags", src
+            ],
+            timeout
+        )
+        if packets:
+            result["gop"] = _keyframe_interval(packets.get("packets", []))
+    return result
+
+def input_tuning_opts(info):
+    """
+    根据已知的媒体信息收紧 FFmpeg 的输入探测 (放在 -i 之前)，
+    远程文件无需再花默认 5MB / 5s 的探测预算
+    """
+    if not info or not info.get("video"):
+        return []
+    bit_rate = info.get("bit_rate") or 0
+    # 约 2 秒的数据量，限制在 512KB ~ 5MB
+    probesize = min(max(bit_rate // 8 * 2, 512 * 1024), 5 * 1024 * 1024) if bit_rate else 2 * 1024 * 1024
+    return ["-probesize", str(probesize), "-analyzeduration", "2000000"]
+
+def stream_maps(info):
+    """按探测到的流序号显式选择音视频 (跳过封面图等附加流)"""
+    video, audio = (info or {}).get("video"), (info or {}).get("audio")
+    maps = ["-map", f"0:{video['index']}" if video and "index" in video else "0:v:0"]
+    maps += ["-map", f"0:{audio['index']}" if audio and "index" in audio else "0:a:0?"]
+    return maps
+
+def media_summary(info):
+    """文件菜单中显示的一行摘要"""
+    if not info:
+        return ""
+    parts = []
+    duration = info.get("duration") or 0
+    if duration:
+        h, rem = divmod(int(duration), 3600)
+        parts.append(f"{h}:{rem // 60:02d}:{rem % 60:02d}" if h else f"{rem // 60}:{rem % 60:02d}")
+    video, audio = info.get("video"), info.get("audio")
+    if video:
+        fps = _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate"))
+        size = f"{video['width']}x{video['height']} " if video.get("width") else ""
+        parts.append(f"{size}{video.get('codec_name')}" + (f" {fps:.0f}fps" if fps else ""))
+    if audio:
+        parts.append(f"{audio.get('codec_name')}")
+    if info.get("bit_rate"):
+        parts.append(f"{info['bit_rate'] // 1000}kbps")
+    return " | ".join(parts)
+
+def _bitrate_kbps(value):
+    """'2000k' / '2M' / 2000000 -> kbps"""
+    text = str(value).strip().lower()
+    try:
+        if text.endswith("k"):
+            return int(float(text[:-1]))
+        if text.endswith("m"):
+            return int(float(text[:-1]) * 1000)
+        return int(float(text) / 1000)
+    except ValueError:
+        return 0
+
+def choose_stream_mode(info, config):
+    """
+    根据探测结果选择推流方式
+    返回: (mode, reason)
+      mode = "copy"       视频/音频均直接封装
+             "copy_video" 视频直接封装，仅转码音频
+             "encode"     完整转码
+    """
+    if not info or not info.get("video"):
+        return "encode", "无法探测视频流"
+
+    video = info["video"]
+    width, height = int(video.get("width") or 0), int(video.get("height") or 0)
+    target_w, target_h = config.get('stream_width', 1280), config.get('stream_height', 720)
+    target_fps = config.get('stream_fps', 25)
+
+    if video.get("codec_name") not in COPY_VIDEO_CODECS:
+        return "encode", f"视频编码 {video.get('codec_name')} 需转码"
+    if video.get("profile") not in COPY_H264_PROFILES:
+        return "encode", f"H.264 Profile {video.get('profile')} 不兼容"
+    if video.get("pix_fmt") not in ("yuv420p", "yuvj420p"):
+        return "encode", f"像素格式 {video.get('pix_fmt')} 不兼容"
+    if not width or width > target_w or height > target_h:
+        return "encode", f"分辨率 {width}x{height} 超出 {target_w}x{target_h}"
+
+    fps = _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate"))
+    if fps > target_fps * 1.25:
+        return "encode", f"帧率 {fps:.0f} 高于 {target_fps}"
+
+    max_gop = config.get('stream_copy_max_gop', 4)
+    gop = info.get("gop")
+    if gop is None or gop > max_gop:
+        return "encode", "关键帧间隔未知" if gop is None else f"关键帧间隔 {gop:.1f}s 过长"
+
+    target_kbps = _bitrate_kbps(config.get('stream_bitrate', '2000k'))
+    source_kbps = int(video.get("bit_rate") or info.get("bit_rate") or 0) // 1000
+    if target_kbps and source_kbps > target_kbps * 1.5:
+        return "encode", f"码率 {source_kbps}k 高于 {target_kbps}k"
+
+    audio = info.get("audio")
+    if audio is None or audio.get("codec_name") in COPY_AUDIO_CODECS:
+        return "copy", f"{width}x{height} H.264 直接封装"
+    return "copy_video", f"{width}x{height} H.264 直接封装，音频 {audio.get('codec_name')} 转 AAC"
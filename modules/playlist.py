@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from .config import load_config, save_config
+from .alist import prefetch_alist_link
+from .media import probe_media
+from .adaptive import base_encoder_profile
+from .stream import (
+    reserve_stream_session, resolve_stream_source, stream_manager, media_cache_key, stream_output_opts,
+    PROGRESS_PIPE, open_progress_pipe, read_progress
+)
+
+logger = logging.getLogger("Playlist")
+
+# 队列为空时插入的待机画面长度 (秒)，之后再次检查队列
+FILLER_SECONDS = 5
+PUMP_CHUNK = 64 * 1024
+
+class PlaylistChannel:
+    """
+    无缝播放列表推流。
+    一个常驻的输出 FFmpeg 保持 RTMP 连接，从 stdin 读取 MPEG-TS 并直接封装推出；
+    队列中的每个源由单独的输入 FFmpeg 按统一参数编码为 MPEG-TS，
+    通过 -output_ts_offset 接续上一个源的时间戳后写入输出进程。
+    队列为空时推送黑屏静音画面，连接不会断开；输出进程意外退出 (RTMP 断开) 时
+    按退避间隔重新连接，与单路推流的自动恢复使用相同的次数限制。
+    """
+
+    def __init__(self):
+        self.queue = deque()
+        self.current = None
+        self.session = None
+        self.offset = 0.0
+        self.played = 0
+        self._feeder = None
+        self._skipped = False
+        self._task = None
+        self._restarts = []
+        self._notify = None
+
+    def is_running(self):
+        # 输出进程重连期间仍视为运行中
+        return self.session is not None and (
+            self.session.is_running() or (self.session.supervising and not self.session.cancelled)
+        )
+
+    def add(self, source):
+        self.queue.append(source)
+        return len(self.queue)
+
+    def clear(self):
+        count = len(self.queue)
+        self.queue.clear()
+        return count
+
+    def remove_last(self):
+        """撤回最后加入的条目"""
+        return self.queue.pop() if self.queue else None
+
+    def skip(self):
+        """结束当前源，立即切换到下一个"""
+        if self._feeder is None or self._feeder.returncode is not None:
+            return False
+        self._skipped = True
+        self._kill_feeder()
+        return True
+
+    async def start(self, message, key_index=None):
+        """建立常驻输出连接并开始消费队列；返回是否成功"""
+        config = load_config()
+        session = await reserve_stream_session(message, config, "📻 播放列表", key_index=key_index)
+        if session is None:
+            return False
+        session.mode_text = "📻 播放列表"
+
+        # 输出进程从 stdin 读取数据，停止时关闭 stdin 让其正常收尾
+        session.stdin_quit = b""
+        try:
+            await session.launch(self._output_cmd(session))
+        except Exception as e:
+            session.starting = False
+            stream_manager.discard(session)
+            if message:
+                await message.reply_text(f"❌ 播放列表启动失败: {e}")
+            return False
+
+        session.on_stop = self._kill_feeder
+        self.session = session
+        self.offset = 0.0
+        self.played = 0
+        self._restarts = []
+        self._notify = message.reply_text if message else None
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return True
+
+    def _output_cmd(self, session):
+        return [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-f", "mpegts", "-i", "pipe:0",
+            "-map", "0", "-c", "copy",
+            *stream_output_opts(session)
+        ]
+
+    async def _ensure_output(self):
+        """
+        输出进程意外退出时按退避间隔重新启动，频道保持在线。
+        输入进程继续按 self.offset 接续时间戳；返回 False 表示放弃
+        """
+        session = self.session
+        process = session.process
+        if process is not None and process.returncode is None:
+            return True
+        if session.cancelled:
+            return False
+
+        config = load_config()
+        max_retries = config.get('stream_recover_retries', 5)
+        window = config.get('stream_recover_window', 600)
+        now = time.time()
+        self._restarts = [t for t in self._restarts if now - t < window]
+        code = process.returncode if process is not None else None
+        if len(self._restarts) >= max_retries:
+            logger.error(f"播放列表输出在 {window}s 内中断 {len(self._restarts)} 次，停止推流")
+            await self._report(
+                f"❌ 播放列表 #{session.id} 在 {window // 60} 分钟内断开 {len(self._restarts)} 次，已停止。\n"
+                f"🔍 日志:\n{session.get_log(500)}"
+            )
+            return False
+        self._restarts.append(now)
+        delay = min(2 ** len(self._restarts), 60)
+        logger.warning(f"播放列表输出进程退出 (code {code})，{delay}s 后重新连接")
+        await asyncio.sleep(delay)
+        if session.cancelled:
+            return False
+        try:
+            if await session.relaunch(self._output_cmd(session)):
+                session.recoveries += 1
+                logger.info(f"播放列表 #{session.id} 已重新连接")
+        except Exception as e:
+            logger.error(f"播放列表输出重启失败: {e}")
+        return not session.cancelled
+
+    async def _report(self, text):
+        if self._notify:
+            try:
+                await self._notify(text)
+            except Exception as e:
+                logger.warning(f"播放列表通知发送失败: {e}")
+
+    def _kill_feeder(self):
+        if self._feeder is not None and self._feeder.returncode is None:
+            try:
+                self._feeder.kill()
+            except ProcessLookupError:
+                pass
+
+    async def _run(self):
+        session = self.session
+        # 输出进程由本任务监督，重连期间会话不会被当作已结束清理
+        session.supervising = True
+        try:
+            while not session.cancelled:
+                if not await self._ensure_output():
+                    break
+                config = load_config()
+                if self.queue:
+                    raw_src = self.queue.popleft()
+                    if config.get('playlist_loop', 0):
+                        self.queue.append(raw_src)
+                    self.current = raw_src
+                    self._prefetch_next()
+                    cmd = await self._item_cmd(raw_src, config)
+                else:
+                    self.current = None
+                    cmd = self._filler_cmd(config)
+
+                if session.cancelled:
+                    break
+                output = session.process
+                played = await self._play(cmd)
+                if self.current is not None and (output.returncode is not None or session.process is not output):
+                    # 输出断开导致中断，重连后从头重播该条目
+                    if not session.cancelled and not config.get('playlist_loop', 0):
+                        self.queue.appendleft(self.current)
+                    logger.warning(f"输出中断，当前条目未播完: {self.current}")
+                elif self.current is not None:
+                    if played > 0 or self._skipped:
+                        self.played += 1
+                    else:
+                        logger.warning(f"播放失败，跳过: {self.current}")
+                        await asyncio.sleep(1)
+        except Exception as e:
+            logger.error(f"播放列表异常: {e}")
+        finally:
+            self.current = None
+            self._feeder = None
+            session.supervising = False
+            if session.is_running():
+                await session.stop()
+            else:
+                stream_manager.discard(session)
+
+    def _prefetch_next(self):
+        """提前解析下一个 Alist 源的直链，切换时无需等待"""
+        if not self.queue:
+            return
+        nxt = self.queue[0].strip()
+        if not os.path.exists(nxt) and not nxt.startswith(("http", "rtmp")):
+            prefetch_alist_link(nxt)
+
+    def _encode_opts(self, config):
+        profile = base_encoder_profile(config)
+        width, height, fps, kbps = profile['width'], profile['height'], profile['fps'], profile['kbps']
+        # 所有源使用相同的编码参数，输出端才能直接拼接
+        return [
+            "-c:v", "libx264", "-preset", profile['preset'],
+            "-vf", (
+                f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,fps={fps},format=yuv420p"
+            ),
+            "-g", str(fps * 2),
+            "-b:v", f"{kbps}k", "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k",
+            "-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k",
+        ]
+
+    def _blank_inputs(self, config):
+        profile = base_encoder_profile(config)
+        width, height, fps = profile['width'], profile['height'], profile['fps']
+        video = ["-f", "lavfi", "-i", f"color=c=black:s={width}x{height}:r={fps}"]
+        audio = ["-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo"]
+        return video, audio
+
+    async def _item_cmd(self, raw_src, config):
+        src, input_opts, is_local_file = await resolve_stream_source(raw_src, config)
+        info = await probe_media(src, input_opts, cache_key=media_cache_key(raw_src, is_local_file))
+        # 探测失败时按音视频俱全处理
+        has_video = info is None or info.get("video") is not None
+        has_audio = info is None or info.get("audio") is not None
+
+        blank_video, blank_audio = self._blank_inputs(config)
+        cmd = ["-re", *input_opts, "-i", src]
+        video_map, audio_map, next_input = "0:v:0", "0:a:0", 1
+        # 缺失的轨道用黑屏/静音补齐，保证每段 TS 的轨道布局一致
+        if not has_video:
+            cmd += blank_video
+            video_map, next_input = f"{next_input}:v:0", next_input + 1
+        if not has_audio:
+            cmd += blank_audio
+            audio_map = f"{next_input}:a:0"
+        cmd += ["-map", video_map, "-map", audio_map]
+        if not (has_video and has_audio):
+            cmd.append("-shortest")
+        return cmd + self._encode_opts(config)
+
+    def _filler_cmd(self, config):
+        blank_video, blank_audio = self._blank_inputs(config)
+        return [
+            "-re", *blank_video, "-re", *blank_audio,
+            "-map", "0:v:0", "-map", "1:a:0", "-t", str(FILLER_SECONDS),
+        ] + self._encode_opts(config)
+
+    async def _play(self, input_cmd):
+        """运行一个输入进程直到结束，返回其输出时长 (秒)"""
+        session = self.session
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+            *input_cmd,
+            "-f", "mpegts", "-output_ts_offset", f"{self.offset:.3f}",
+            "-progress", PROGRESS_PIPE, "-nostats",
+            "pipe:1"
+        ]
+        self._skipped = False
+        # 进度经管道读取 (与推流会话相同)，长时间运行也不会积累文件
+        cmd, progress_pipe, write_fd = open_progress_pipe(cmd)
+        try:
+            with open(session.log_path, "a", encoding='utf-8') as log_file:
+                self._feeder = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=log_file,
+                    pass_fds=(write_fd,)
+                )
+        except BaseException:
+            progress_pipe.close()
+            raise
+        finally:
+            os.close(write_fd)
+        progress = {}
+        reader = asyncio.get_running_loop().create_task(read_progress(progress_pipe, progress.update))
+
+        await self._pump(self._feeder, session.process)
+        await self._feeder.wait()
+        await reader
+
+        played = progress.get("out_time") or 0.0
+        # 进度文件每 0.5 秒更新一次，被中途结束时多留一点余量，避免时间戳回退
+        fps = load_config().get('stream_fps', 25)
+        margin = 1.0 if self._skipped else 1.0 / fps
+        if played > 0 or self._skipped:
+            self.offset += played + margin
+        return played
+
+    async def _pump(self, feeder, output):
+        """把输入进程的 TS 数据写入输出进程，受输出端背压控制"""
+        try:
+            while True:
+                chunk = await feeder.stdout.read(PUMP_CHUNK)
+                if not chunk:
+                    break
+                output.stdin.write(chunk)
+                await output.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError, RuntimeError):
+            # 输出进程已退出
+            self._kill_feeder()
+
+    def status_text(self):
+        lines = [f"📻 播放列表 ({'🟢 推流中' if self.is_running() else '⚪ 未启动'})"]
+        if self.session is not None and self.is_running():
+            lines.append(f"🔑 {self.session.key_name} | #{self.session.id} | 已播 {self.played} 个")
+        lines.append(f"▶️ 当前: {os.path.basename(self.current) if self.current else '待机画面'}")
+        loop = " (循环)" if load_config().get('playlist_loop', 0) else ""
+        if self.queue:
+            lines.append(f"\n📋 队列{loop}:")
+            for i, item in enumerate(list(self.queue)[:20], 1):
+                lines.append(f"{i}. {os.path.basename(item.rstrip('/')) or item}")
+            if len(self.queue) > 20:
+                lines.append(f"... 共 {len(self.queue)} 个")
+        else:
+            lines.append(f"\n📋 队列为空{loop}")
+        return "\n".join(lines)
+
+def set_playlist_loop(enabled):
+    save_config({'playlist_loop': 1 if enabled else 0})
+
+playlist_channel = PlaylistChannel()
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import posixpath
+from .config import load_config
+from .alist import get_alist_listing, listing_cache
+
+logger = logging.getLogger("Prefetch")
+
+class ListingPrefetcher:
+    """
+    Alist 目录预取器。
+    用户停留在某一页时，在后台预先拉取下一页和当前页前几个子目录的第一页，
+    写入共享的目录缓存，使下一次点击无需等待 Alist (及其背后的远程存储)。
+    每轮预取受并发数与字节预算限制；用户导航到新页面时取消上一轮。
+    """
+
+    def __init__(self):
+        self._task = None
+        self.stats = {'rounds': 0, 'fetched': 0, 'skipped': 0, 'bytes': 0}
+
+    def schedule(self, path, page, listing, per_page):
+        """
+        为刚渲染的页面安排一轮预取
+        page: Alist 页码 (从 1 开始)
+        listing: 当前页数据 (AlistPage)
+        """
+        config = load_config()
+        concurrency = config.get('alist_prefetch_concurrency', 2)
+        if concurrency <= 0:
+            return
+
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+        targets = []
+        if page < listing.total_pages:
+            targets.append((path, page + 1))
+        max_dirs = config.get('alist_prefetch_dirs', 3)
+        dirs = [item for item in listing.entries if item.is_dir][:max_dirs]
+        targets.extend((posixpath.join(path, item.name), 1) for item in dirs)
+
+        targets = [t for t in targets if (t[0], t[1], per_page) not in listing_cache]
+        if not targets:
+            return
+
+        budget = config.get('alist_prefetch_budget_kb', 256) * 1024
+        self._task = asyncio.get_running_loop().create_task(
+            self._run(targets, per_page, concurrency, budget)
+        )
+
+    async def _run(self, targets, per_page, concurrency, budget):
+        self.stats['rounds'] += 1
+        semaphore = asyncio.Semaphore(concurrency)
+        used = 0
+
+        async def fetch(target_path, target_page):
+            nonlocal used
+            async with semaphore:
+                # 预算用完后不再发起新请求
+                if used >= budget:
+                    self.stats['skipped'] += 1
+                    return
+                success, listing = await get_alist_listing(target_path, page=target_page, per_page=per_page)
+                if not success:
+                    return
+                size = listing.approx_bytes
+                used += size
+                self.stats['fetched'] += 1
+                self.stats['bytes'] += size
+
+        try:
+            await asyncio.gather(*(fetch(p, pg) for p, pg in targets))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"预取失败: {e}")
+
+prefetcher = ListingPrefetcher()
+
+def schedule_prefetch(path, page, listing, per_page):
+    """在当前事件循环中为浏览器页面安排预取"""
+    prefetcher.schedule(path, page, listing, per_page)
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("Prepared")
+
+PREPARED_DB = "prepared.db"
+PREPARED_DIR = "prepared"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prepared (
+    key TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    status TEXT NOT NULL,
+    output TEXT NOT NULL DEFAULT '',
+    error TEXT NOT NULL DEFAULT '',
+    added_at REAL NOT NULL,
+    finished_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+class PreparedCatalog:
+    """
+    预转码文件目录 (SQLite)。
+    以源文件版本键 (与媒体信息缓存相同) 记录每个源的转码状态:
+    queued -> running -> done / failed；done 的条目指向 prepared/ 下可直接封装推流的 MP4。
+    转码结果总大小超过上限时按最近使用时间淘汰 (同时删除条目)。
+    数据库操作在单独的线程中串行执行。
+    """
+
+    def __init__(self, db_path=PREPARED_DB):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prepared")
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.executescript(SCHEMA)
+            # 上次退出时未完成的任务重新排队
+            self._conn.execute("UPDATE prepared SET status = 'queued' WHERE status = 'running'")
+            self._conn.commit()
+        return self._conn
+
+    def _add(self, key, source, target):
+        db = self._db()
+        row = db.execute("SELECT status, target, output FROM prepared WHERE key = ?", (key,)).fetchone()
+        if row and row[1] == target and row[0] in ("queued", "running", "done"):
+            if row[0] != "done" or os.path.exists(row[2]):
+                return row[0]
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO prepared (key, source, target, status, added_at) VALUES (?, ?, ?, 'queued', ?)",
+                (key, source, target, time.time())
+            )
+        return "queued"
+
+    def _lookup(self, key, target):
+        row = self._db().execute(
+            "SELECT output FROM prepared WHERE key = ? AND target = ? AND status = 'done'", (key, target)
+        ).fetchone()
+        if not row or not os.path.exists(row[0]):
+            return None
+        # 记录使用时间，淘汰时保留常用的文件
+        os.utime(row[0])
+        return row[0]
+
+    def _next_queued(self):
+        return self._db().execute(
+            "SELECT key, source, target FROM prepared WHERE status = 'queued' ORDER BY added_at LIMIT 1"
+        ).fetchone()
+
+    def _set_status(self, key, status, output="", error=""):
+        db = self._db()
+        with db:
+            db.execute(
+                "UPDATE prepared SET status = ?, output = ?, error = ?, finished_at = ? WHERE key = ?",
+                (status, output, error, time.time() if status in ("done", "failed") else 0, key)
+            )
+
+    def _entries(self, limit):
+        return [
+            {'key': r[0], 'source': r[1], 'target': r[2], 'status': r[3], 'output': r[4], 'error': r[5]}
+            for r in self._db().execute(
+                "SELECT key, source, target, status, output, error FROM prepared ORDER BY added_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        ]
+
+    def _prune(self, max_mb, keep):
+        db = self._db()
+        files = []
+        for key, output in db.execute("SELECT key, output FROM prepared WHERE status = 'done'").fetchall():
+            try:
+                st = os.stat(output)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, key, output))
+        files.sort()
+        total = sum(size for _, size, _, _ in files)
+        limit = max_mb * 1024 * 1024
+        removed = 0
+        for _, size, key, output in files:
+            if total <= limit:
+                break
+            if output == keep:
+                continue
+            try:
+                os.remove(output)
+            except OSError:
+                continue
+            with db:
+                db.execute("DELETE FROM prepared WHERE key = ?", (key,))
+            total -= size
+            removed += 1
+        return removed
+
+    def _remove_unfinished(self):
+        db = self._db()
+        with db:
+            return db.execute("DELETE FROM prepared WHERE status IN ('queued', 'failed')").rowcount
+
+    async def _run_db(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    # --- 对外接口 ---
+
+    async def add(self, key, source, target):
+        """加入转码队列，已排队或已完成时返回原状态"""
+        return await self._run_db(self._add, key, source, target)
+
+    async def lookup(self, key, target):
+        """返回与目标画质匹配的已转码文件路径，没有时返回 None"""
+        if not key:
+            return None
+        try:
+            return await self._run_db(self._lookup, key, target)
+        except sqlite3.Error as e:
+            logger.warning(f"读取预转码目录失败: {e}")
+            return None
+
+    async def next_queued(self):
+        return await self._run_db(self._next_queued)
+
+    async def set_status(self, key, status, output="", error=""):
+        await self._run_db(self._set_status, key, status, output, error)
+
+    async def entries(self, limit=20):
+        return await self._run_db(self._entries, limit)
+
+    async def prune(self, max_mb, keep=None):
+        """按最近使用时间删除转码结果，使总大小不超过 max_mb；返回删除的文件数"""
+        return await self._run_db(self._prune, max_mb, keep)
+
+    async def remove_unfinished(self):
+        return await self._run_db(self._remove_unfinished)
+
+prepared_catalog = PreparedCatalog()
@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import psutil
+from .config import load_config
+from .media import probe_media
+from .adaptive import calibration_target, base_encoder_profile
+from .calibrate import is_calibrating
+from .prepared import prepared_catalog, PREPARED_DIR
+from .process import stop_process
+from .stream import stream_manager, resolve_stream_source, media_cache_key
+
+logger = logging.getLogger("Pretranscode")
+
+# 没有任务或条件不满足时的检查间隔 (秒)
+IDLE_POLL = 30
+# 转码期间检查是否有推流开始的间隔
+BUSY_POLL = 2
+
+def _battery_charging():
+    """是否正在充电，无法判断时返回 None"""
+    try:
+        output = subprocess.check_output(["termux-battery-status"], text=True, stderr=subprocess.DEVNULL, timeout=2)
+        data = json.loads(output)
+        return data.get("plugged", "UNPLUGGED") != "UNPLUGGED" or data.get("status") == "CHARGING"
+    except Exception:
+        pass
+    try:
+        battery = psutil.sensors_battery()
+    except Exception:
+        battery = None
+    return battery.power_plugged if battery is not None else None
+
+class PretranscodeQueue:
+    """
+    空闲时的离线预转码队列。
+    没有推流 (且按配置仅在充电) 时，以低优先级和慢速高压缩 preset 把排队的源转成
+    符合推流目标 (分辨率/帧率/固定 GOP/H.264 High + AAC) 的 MP4；
+    有推流开始时立即中止当前任务，空闲后重新开始。
+    转好的文件记录在 prepared_catalog 中，推流时自动替换源并直接封装。
+    """
+
+    def __init__(self):
+        self.current = None
+        self.position = 0.0
+        self.duration = 0.0
+        self._process = None
+        self._charging_warned = False
+
+    async def add(self, raw_src):
+        """加入队列，返回 (是否成功, 提示文本)"""
+        config = load_config()
+        raw_src = raw_src.strip()
+        if raw_src.startswith(("http", "rtmp")):
+            return False, "只支持本地文件或 Alist 文件"
+        _, _, is_local_file = await resolve_stream_source(raw_src, config)
+        key = media_cache_key(raw_src, is_local_file)
+        if key is None:
+            return False, "只支持本地文件或 Alist 文件"
+        status = await prepared_catalog.add(key, raw_src, calibration_target(config))
+        labels = {"queued": "已加入预转码队列", "running": "正在转码中", "done": "已有转码好的版本"}
+        return True, labels.get(status, status)
+
+    async def _idle(self, config):
+        # 校准期间也让出 CPU，否则测得的档位会偏低并用于之后所有推流
+        if stream_manager.running() or is_calibrating():
+            return False
+        if not config.get('pretranscode_charging_only', 0):
+            return True
+        charging = await asyncio.get_running_loop().run_in_executor(None, _battery_charging)
+        if charging is None:
+            if not self._charging_warned:
+                logger.warning("无法获取充电状态，忽略仅充电时转码的限制")
+                self._charging_warned = True
+            return True
+        return charging
+
+    async def run(self):
+        """后台常驻任务"""
+        while True:
+            try:
+                config = load_config()
+                job = await prepared_catalog.next_queued() if config.get('pretranscode', 1) else None
+                if job is None or not await self._idle(config):
+                    await asyncio.sleep(IDLE_POLL)
+                    continue
+                try:
+                    await self._transcode(*job)
+                except Exception as e:
+                    await prepared_catalog.set_status(job[0], "failed", error=str(e)[:300])
+                    raise
+            except Exception as e:
+                logger.error(f"预转码队列异常: {e}")
+                await asyncio.sleep(IDLE_POLL)
+
+    def _encode_cmd(self, src, input_opts, config, output):
+        # 离线转码不受实时性限制，按配置的目标画质而不是校准档位
+        profile = base_encoder_profile(dict(config, stream_use_calibration=0))
+        width, height, fps, kbps = profile['width'], profile['height'], profile['fps'], profile['kbps']
+        gop = fps * 2
+        return [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-nostdin",
+            *input_opts, "-i", src,
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-c:v", "libx264", "-preset", config.get('pretranscode_preset', 'slow'),
+            "-profile:v", "high", "-pix_fmt", "yuv420p",
+            "-vf", (
+                f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,fps={fps}"
+            ),
+            # 固定 GOP，满足直通推流对关键帧间隔的要求
+            "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+            # 限码率的 CRF：简单画面省码率，复杂画面不超过推流码率
+            "-crf", "21", "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k",
+            "-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k",
+            "-movflags", "+faststart",
+            "-progress", "pipe:1", "-nostats",
+            output
+        ]
+
+    async def _transcode(self, key, raw_src, target):
+        config = load_config()
+        if target != calibration_target(config):
+            # 目标画质已变化，按新目标重新排队
+            await prepared_catalog.add(key, raw_src, calibration_target(config))
+            return
+
+        src, input_opts, is_local_file = await resolve_stream_source(raw_src, config)
+        if media_cache_key(raw_src, is_local_file) != key:
+            # 源文件已变化 (或已删除)，旧任务作废
+            await prepared_catalog.set_status(key, "failed", error="源文件已变化")
+            return
+
+        info = await probe_media(src, input_opts, cache_key=key)
+        self.duration = (info or {}).get("duration", 0)
+        self.position = 0.0
+        self.current = raw_src
+
+        os.makedirs(PREPARED_DIR, exist_ok=True)
+        output = os.path.join(PREPARED_DIR, hashlib.sha1(key.encode()).hexdigest()[:20] + ".mp4")
+        tmp_output = output + ".part.mp4"
+        await prepared_catalog.set_status(key, "running")
+        logger.info(f"开始预转码: {raw_src}")
+
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                *self._encode_cmd(src, input_opts, config, tmp_output),
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                psutil.Process(self._process.pid).nice(19)
+            except (psutil.Error, OSError):
+                pass
+
+            reader = asyncio.get_running_loop().create_task(self._read_progress(self._process))
+            preempted = False
+            while self._process.returncode is None:
+                try:
+                    await asyncio.wait_for(self._process.wait(), timeout=BUSY_POLL)
+                except asyncio.TimeoutError:
+                    if not await self._idle(load_config()):
+                        preempted = True
+                        await stop_process(self._process)
+            await reader
+            stderr = (await self._process.stderr.read()).decode(errors='ignore').strip()
+
+            if preempted:
+                logger.info(f"空闲条件不再满足 (推流/校准开始或停止充电)，暂停预转码: {raw_src}")
+                await prepared_catalog.set_status(key, "queued")
+            elif self._process.returncode == 0 and os.path.exists(tmp_output):
+                os.replace(tmp_output, output)
+                await prepared_catalog.set_status(key, "done", output=output)
+                logger.info(f"预转码完成: {raw_src} -> {output}")
+                removed = await prepared_catalog.prune(config.get('prepared_max_mb', 4096), keep=output)
+                if removed:
+                    logger.info(f"已淘汰 {removed} 个最久未使用的预转码文件")
+            else:
+                await prepared_catalog.set_status(
+                    key, "failed", error=stderr[-300:] or f"退出码 {self._process.returncode}"
+                )
+                logger.warning(f"预转码失败: {raw_src}: {stderr[-300:]}")
+        finally:
+            if self._process is not None and self._process.returncode is None:
+                self._process.kill()
+                await self._process.wait()
+            self._process = None
+            self.current = None
+            if os.path.exists(tmp_output):
+                try: os.remove(tmp_output)
+                except OSError: pass
+
+    async def _read_progress(self, process):
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                return
+            key, _, value = line.decode(errors='ignore').strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                self.position = int(value) / 1_000_000
+
+    async def stop(self):
+        """机器人退出时中止当前任务 (下次启动重新排队)"""
+        if self._process is not None and self._process.returncode is None:
+            await stop_process(self._process)
+
+    async def status_text(self):
+        entries = await prepared_catalog.entries(limit=15)
+        lines = ["📦 **预转码队列**"]
+        if self.current:
+            percent = f" {self.position * 100 / self.duration:.0f}%" if self.duration else ""
+            lines.append(f"⏳ 正在转码{percent}: `{os.path.basename(self.current)}`")
+        elif any(e['status'] == "queued" for e in entries):
+            lines.append("💤 等待空闲 (无推流" + (" 且充电中" if load_config().get('pretranscode_charging_only', 0) else "") + ")")
+        icons = {"queued": "🕒", "running": "⏳", "done": "✅", "failed": "❌"}
+        if entries:
+            lines.append("")
+        for entry in entries:
+            name = os.path.basename(entry['source'].rstrip('/')) or entry['source']
+            lines.append(f"{icons.get(entry['status'], '•')} `{name}` ({entry['target']})")
+        if not entries:
+            lines.append("\n队列为空。用法: `/prepare <路径>`")
+        return "\n".join(lines)
+
+pretranscode_queue = PretranscodeQueue()
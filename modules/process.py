@@ -0,0 +1,37 @@
+import asyncio
+
+async def _wait_exit(process, timeout):
+    try:
+        await asyncio.wait_for(process.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+async def stop_process(process, quit_input=b"q", timeout=3):
+    """
+    优雅地结束 asyncio 子进程，每一步最多等待 timeout 秒:
+    向 stdin 发送 quit_input (FFmpeg 的 q) 并关闭 stdin -> SIGTERM -> SIGKILL
+    返回进程退出码
+    """
+    if process.returncode is not None:
+        return process.returncode
+    if process.stdin is not None:
+        try:
+            if quit_input:
+                process.stdin.write(quit_input)
+                await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError, RuntimeError):
+            pass
+        if await _wait_exit(process, timeout):
+            return process.returncode
+    try:
+        process.terminate()
+    except ProcessLookupError:
+        pass
+    if not await _wait_exit(process, timeout):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+    return await process.wait()
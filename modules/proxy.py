@@ -0,0 +1,361 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import httpx
+from .config import load_config
+from .alist import resolve_alist_path, invalidate_resolved_link, get_alist_file_stamp
+
+logger = logging.getLogger("ReadAheadProxy")
+
+PROXY_CACHE_DIR = "proxy_cache"
+CHUNK_SIZE = 2 * 1024 * 1024
+# 单个文件同时向上游发出的分块请求数
+FETCH_CONCURRENCY = 2
+FETCH_RETRIES = 3
+# 上游返回这些状态码时认为直链已失效，重新解析后再试
+EXPIRED_STATUS = (401, 403, 404, 410)
+# 超过该时间 (秒) 没有被读取的文件从代理中移除 (磁盘上的分块保留)
+FILE_IDLE_TIMEOUT = 1800
+
+_RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
+class UpstreamError(Exception):
+    pass
+
+class ProxyFile:
+    """
+    一个 Alist 文件的分块视图。
+    文件按 CHUNK_SIZE 切块，每块从上游用 Range 请求下载后落盘；
+    同一块并发请求只下载一次，读取时向后预读若干块。
+    """
+
+    def __init__(self, proxy, path, size, modified=""):
+        self.proxy = proxy
+        self.path = path
+        self.size = size
+        # 同名同大小的文件被覆盖后修改时间不同，不会读到旧分块
+        self.key = hashlib.sha1(f"{path}|{size}|{modified}".encode()).hexdigest()[:20]
+        self.chunk_count = (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.last_used = time.time()
+        self._semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    def busy(self):
+        return any(key == self.key for key, _ in self.proxy.inflight)
+
+    def chunk_path(self, index):
+        return os.path.join(self.proxy.cache_dir, self.key, f"{index}.chunk")
+
+    async def read_chunk(self, index, read_ahead=0):
+        """返回第 index 块的数据，并在后台预读其后 read_ahead 块"""
+        for nxt in range(index + 1, min(index + 1 + read_ahead, self.chunk_count)):
+            self._schedule(nxt)
+
+        path = self.chunk_path(index)
+        loop = asyncio.get_running_loop()
+        if os.path.exists(path):
+            data = await loop.run_in_executor(None, _read_file, path)
+            if data is not None:
+                self.proxy.stats['hits'] += 1
+                return data
+        self.proxy.stats['misses'] += 1
+        return await asyncio.shield(self._schedule(index, cached_ok=False))
+
+    def _schedule(self, index, cached_ok=True):
+        # 进行中的下载登记在代理上 (以文件键和块号为键)，同一块只下载、计数一次
+        task = self.proxy.inflight.get((self.key, index))
+        if task is None:
+            if cached_ok and os.path.exists(self.chunk_path(index)):
+                return None
+            task = asyncio.get_running_loop().create_task(self._fetch(index))
+            # 预读任务没有人等待结果，失败信息在回调中取出
+            task.add_done_callback(_fetch_error_logger(index))
+            self.proxy.inflight[(self.key, index)] = task
+        return task
+
+    async def _fetch(self, index):
+        start = index * CHUNK_SIZE
+        end = min(start + CHUNK_SIZE, self.size) - 1
+        try:
+            async with self._semaphore:
+                delay = 1
+                for attempt in range(FETCH_RETRIES):
+                    try:
+                        data = await self.proxy.fetch_range(self.path, start, end)
+                        break
+                    except (httpx.HTTPError, UpstreamError) as e:
+                        if attempt == FETCH_RETRIES - 1:
+                            raise
+                        logger.warning(f"分块 {index} 下载失败 ({e})，{delay}s 后重试")
+                        await asyncio.sleep(delay)
+                        delay *= 2
+            await asyncio.get_running_loop().run_in_executor(None, self._store, index, data)
+            return data
+        finally:
+            if self.proxy.inflight.get((self.key, index)) is asyncio.current_task():
+                del self.proxy.inflight[(self.key, index)]
+
+    def _store(self, index, data):
+        path = self.chunk_path(index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".part"
+        try:
+            # 覆盖已有分块 (被淘汰后重新下载的竞争) 时只登记大小差
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.proxy.add_cached_bytes(len(data) - replaced, keep=path)
+
+def _fetch_error_logger(index):
+    def _done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"分块 {index} 预读失败: {task.exception()}")
+    return _done
+
+def _read_file(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except OSError:
+        return None
+
+class ReadAheadProxy:
+    """
+    Alist 源的本地预读缓存代理。
+    在 127.0.0.1 上提供支持 Range 的 HTTP 服务，FFmpeg 从这里读取；
+    代理按块从上游下载并预读 stream_proxy_readahead_mb，数据缓存在磁盘上 (LRU，
+    总量不超过 stream_proxy_cache_mb)，网络抖动由预读缓冲吸收，重播同一文件无需重新下载。
+    """
+
+    def __init__(self, cache_dir=PROXY_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.files = {}
+        # 进行中的分块下载 {(文件键, 块号): Task}
+        self.inflight = {}
+        self.stats = {'hits': 0, 'misses': 0, 'upstream_bytes': 0}
+        self._server = None
+        self._client = None
+        self._port = None
+        self._cached_bytes = None
+        # add_cached_bytes 在线程池中执行，多个分块可能同时写入
+        self._cached_lock = threading.Lock()
+        self._start_lock = asyncio.Lock()
+
+    async def _ensure_started(self):
+        async with self._start_lock:
+            if self._server is not None:
+                return
+            self._client = httpx.AsyncClient(
+                headers={"User-Agent": "TermuxBot"},
+                follow_redirects=True,
+                timeout=httpx.Timeout(15, read=30),
+            )
+            self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+            self._port = self._server.sockets[0].getsockname()[1]
+            logger.info(f"预读代理已启动: 127.0.0.1:{self._port}")
+
+    async def url_for(self, path):
+        """
+        返回代理后的本地地址；上游不支持 Range 或探测失败时返回 None，
+        调用方应直接使用原始链接
+        """
+        try:
+            await self._ensure_started()
+            size = await self._probe_size(path)
+        except (OSError, httpx.HTTPError, UpstreamError) as e:
+            logger.warning(f"预读代理不可用，直接读取: {e}")
+            return None
+        self._prune_files()
+        stamp = get_alist_file_stamp(path)
+        proxy_file = ProxyFile(self, path, size, stamp[1] if stamp else "")
+        # 重启/续播同一文件时沿用原来的对象 (共享进行中的下载)
+        proxy_file = self.files.setdefault(proxy_file.key, proxy_file)
+        proxy_file.last_used = time.time()
+        return f"http://127.0.0.1:{self._port}/f/{proxy_file.key}"
+
+    def _prune_files(self):
+        """移除长时间没有读取的文件 (推流已结束)"""
+        now = time.time()
+        for key in [k for k, f in self.files.items() if now - f.last_used > FILE_IDLE_TIMEOUT and not f.busy()]:
+            del self.files[key]
+
+    async def _range_request(self, path, start, end):
+        """
+        带 Range 请求上游，返回 (Content-Range, 数据)，最多读取 end - start + 1 字节。
+        上游不返回 206 (忽略 Range 时会返回整个文件) 时不读取响应体，直接关闭连接；
+        直链失效时重新解析一次
+        """
+        want = end - start + 1
+        for refresh in (False, True):
+            url = await resolve_alist_path(path, use_cache=not refresh)
+            if not url:
+                raise UpstreamError("无法解析直链")
+            async with self._client.stream("GET", url, headers={"Range": f"bytes={start}-{end}"}) as resp:
+                if resp.status_code in EXPIRED_STATUS and not refresh:
+                    invalidate_resolved_link(path)
+                    continue
+                if resp.status_code != 206:
+                    raise UpstreamError(f"上游不支持 Range (HTTP {resp.status_code})")
+                pieces = []
+                size = 0
+                async for piece in resp.aiter_bytes():
+                    piece = piece[:want - size]
+                    pieces.append(piece)
+                    size += len(piece)
+                    if size >= want:
+                        break
+                return resp.headers.get("content-range", ""), b"".join(pieces)
+
+    async def _probe_size(self, path):
+        content_range, _ = await self._range_request(path, 0, 0)
+        total = content_range.rsplit("/", 1)[1] if "/" in content_range else ""
+        if not total.isdigit():
+            raise UpstreamError("上游未返回文件大小")
+        return int(total)
+
+    async def fetch_range(self, path, start, end):
+        _, data = await self._range_request(path, start, end)
+        if len(data) != end - start + 1:
+            raise UpstreamError(f"数据不完整 ({len(data)}/{end - start + 1})")
+        self.stats['upstream_bytes'] += len(data)
+        return data
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=30)
+            lines = head.decode("latin-1").split("\r\n")
+            method, target = lines[0].split(" ")[:2]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            proxy_file = self.files.get(target.rsplit("/", 1)[-1])
+            if method not in ("GET", "HEAD") or proxy_file is None:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+
+            start, end = 0, proxy_file.size - 1
+            match = _RANGE_RE.match(headers.get("range", ""))
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(int(match.group(2)), end)
+                else:
+                    start = max(0, proxy_file.size - int(match.group(2)))
+                if start > end:
+                    writer.write(
+                        f"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */{proxy_file.size}\r\n"
+                        f"Content-Length: 0\r\nConnection: close\r\n\r\n".encode()
+                    )
+                    return
+                status = "206 Partial Content"
+            else:
+                status = "200 OK"
+
+            response = [
+                f"HTTP/1.1 {status}",
+                "Content-Type: application/octet-stream",
+                "Accept-Ranges: bytes",
+                f"Content-Length: {end - start + 1}",
+                "Connection: close",
+            ]
+            if status.startswith("206"):
+                response.append(f"Content-Range: bytes {start}-{end}/{proxy_file.size}")
+            writer.write(("\r\n".join(response) + "\r\n\r\n").encode())
+            if method == "HEAD":
+                return
+            await self._send(proxy_file, writer, start, end)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError):
+            pass
+        except (ConnectionError, BrokenPipeError):
+            # FFmpeg seek 时会直接断开旧连接
+            pass
+        except (httpx.HTTPError, UpstreamError) as e:
+            logger.warning(f"上游读取失败: {e}")
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def _send(self, proxy_file, writer, start, end):
+        read_ahead = max(1, load_config().get('stream_proxy_readahead_mb', 32) * 1024 * 1024 // CHUNK_SIZE)
+        position = start
+        while position <= end:
+            proxy_file.last_used = time.time()
+            index = position // CHUNK_SIZE
+            data = await proxy_file.read_chunk(index, read_ahead)
+            offset = position - index * CHUNK_SIZE
+            piece = data[offset:offset + end - position + 1]
+            writer.write(piece)
+            await writer.drain()
+            position += len(piece)
+
+    def add_cached_bytes(self, size, keep=None):
+        """登记新写入的分块，超出上限时按最近使用时间淘汰 (在线程池中调用)"""
+        with self._cached_lock:
+            self._add_cached_bytes_locked(size, keep)
+
+    def _add_cached_bytes_locked(self, size, keep):
+        if self._cached_bytes is None:
+            self._cached_bytes = sum(size for _, size, _ in self._scan())
+        else:
+            self._cached_bytes += size
+        limit = load_config().get('stream_proxy_cache_mb', 1024) * 1024 * 1024
+        if self._cached_bytes <= limit:
+            return
+        chunks = sorted(self._scan())
+        self._cached_bytes = sum(size for _, size, _ in chunks)
+        for _, chunk_size, full in chunks:
+            if self._cached_bytes <= limit * 0.9:
+                break
+            if full == keep:
+                continue
+            try:
+                os.remove(full)
+                self._cached_bytes -= chunk_size
+            except OSError:
+                pass
+
+    def _scan(self):
+        chunks = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".chunk"):
+                    full = os.path.join(root, name)
+                    try:
+                        st = os.stat(full)
+                    except OSError:
+                        continue
+                    chunks.append((st.st_mtime, st.st_size, full))
+        return chunks
+
+    def status_text(self):
+        if self._server is None:
+            return "💾 预读代理: 未启动"
+        hits, misses = self.stats['hits'], self.stats['misses']
+        rate = hits * 100 // (hits + misses) if hits + misses else 0
+        return (
+            f"💾 预读代理: 命中 {hits}/{hits + misses} 块 ({rate}%), "
+            f"上游下载 {self.stats['upstream_bytes'] / 1024 / 1024:.1f}MB"
+        )
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+read_ahead_proxy = ReadAheadProxy()
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from .config import load_config
+
+logger = logging.getLogger("Recorder")
+
+RECORDINGS_DIR = "recordings"
+RETENTION_INTERVAL = 60
+# 最近仍在写入的分段不参与清理
+ACTIVE_GRACE = 30
+
+def _escape_tee(text):
+    """tee 输出列表中 | [ ] 与反斜杠需要转义"""
+    return re.sub(r"([\\|\[\]])", r"\\\1", text)
+
+def record_output(session, segment_seconds):
+    """
+    录像分段输出 (tee 子输出)。
+    与推流共用已编码的数据包，按 segment_seconds 切分为 MPEG-TS 文件；
+    写盘失败不影响推流 (onfail=ignore)
+    """
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    name = re.sub(r"[^\w.-]+", "_", session.key_name).strip("_") or "stream"
+    pattern = os.path.join(RECORDINGS_DIR, f"{name}_{session.id}_%Y%m%d-%H%M%S.ts")
+    options = (
+        f"f=segment:segment_format=mpegts:segment_time={segment_seconds}"
+        ":reset_timestamps=1:strftime=1:onfail=ignore"
+    )
+    return tee_slave(options, pattern)
+
+def tee_slave(options, target):
+    """tee 的一个子输出"""
+    return f"[{options}]{_escape_tee(target)}"
+
+def tee_output_opts(slaves):
+    """把同一份编码数据写到多个子输出 (推流 + 录像/缓存) 的 tee 输出参数"""
+    return [
+        # 编码器把参数集写入 extradata，FLV 与分段文件都能取到
+        "-flags", "+global_header",
+        "-f", "tee", "|".join(slaves)
+    ]
+
+def list_recordings(limit=20):
+    """返回最近的录像 [(路径, 大小, 修改时间)]，新的在前"""
+    if not os.path.isdir(RECORDINGS_DIR):
+        return []
+    items = []
+    for name in os.listdir(RECORDINGS_DIR):
+        if not name.endswith(".ts"):
+            continue
+        full = os.path.join(RECORDINGS_DIR, name)
+        try:
+            st = os.stat(full)
+        except OSError:
+            continue
+        items.append((full, st.st_size, st.st_mtime))
+    items.sort(key=lambda item: item[2], reverse=True)
+    return items[:limit] if limit else items
+
+def prune_recordings(max_mb):
+    """按时间从旧到新删除录像，使总大小不超过 max_mb；返回删除的文件数"""
+    items = list_recordings(limit=0)
+    total = sum(size for _, size, _ in items)
+    limit = max_mb * 1024 * 1024
+    removed = 0
+    now = time.time()
+    for path, size, mtime in reversed(items):
+        if total <= limit:
+            break
+        if now - mtime < ACTIVE_GRACE:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+async def run_retention():
+    """后台定期清理录像"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            removed = await loop.run_in_executor(None, prune_recordings, load_config().get('record_max_mb', 2048))
+            if removed:
+                logger.info(f"已清理 {removed} 个旧录像")
+        except Exception as e:
+            logger.error(f"录像清理失败: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
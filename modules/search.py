@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import posixpath
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .config import load_config
+from .alist import alist_list_files, get_alist_pid
+
+logger = logging.getLogger("Search")
+
+INDEX_DB = "alist_index.db"
+
+# Alist 对不支持修改时间的存储返回零值时间，这类目录每次都需要重新列出
+ZERO_TIMES = ("", "0001-01-01T00:00:00Z")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    modified TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_entries_parent ON entries(parent);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    modified TEXT NOT NULL DEFAULT '',
+    crawled_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    name, content='entries', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts(rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+"""
+
+def _like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class AlistSearchIndex:
+    """
+    Alist 文件树的本地全文索引 (SQLite FTS5 trigram)。
+    后台爬虫以有限并发遍历 Alist，只重新列出修改时间变化 (或超过 full_interval 未校验) 的目录。
+    所有数据库操作在单独的线程中串行执行，不阻塞事件循环。
+    """
+
+    def __init__(self, db_path=INDEX_DB):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="alist-index")
+        self._conn = None
+        self.fts = False
+        self.crawling = False
+        self.last_crawl = None
+
+    # --- 数据库操作 (在索引线程中执行) ---
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.executescript(SCHEMA)
+            try:
+                self._conn.executescript(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError as e:
+                # 旧版 SQLite 不支持 trigram，退化为 LIKE 查询
+                logger.warning(f"FTS5 trigram 不可用，使用 LIKE 搜索: {e}")
+            self._conn.commit()
+        return self._conn
+
+    def _get_dir_state(self, path):
+        row = self._db().execute("SELECT modified, crawled_at FROM dirs WHERE path = ?", (path,)).fetchone()
+        return row if row else (None, 0)
+
+    def _get_subdirs(self, path):
+        return self._db().execute(
+            "SELECT path, modified FROM entries WHERE parent = ? AND is_dir = 1", (path,)
+        ).fetchall()
+
+    def _replace_dir(self, path, modified, items):
+        """用新的列表替换目录下的条目，并删除已消失子目录的整个子树"""
+        db = self._db()
+        new_names = {item.get('name', '') for item in items}
+        removed_dirs = [
+            row[0] for row in db.execute(
+                "SELECT path, name FROM entries WHERE parent = ? AND is_dir = 1", (path,)
+            ) if row[1] not in new_names
+        ]
+        with db:
+            for sub in removed_dirs:
+                prefix = sub + "/"
+                db.execute("DELETE FROM entries WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+                db.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (sub, len(prefix), prefix))
+            db.execute("DELETE FROM entries WHERE parent = ?", (path,))
+            db.executemany(
+                "INSERT OR IGNORE INTO entries (path, parent, name, is_dir, size, modified) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (posixpath.join(path, item.get('name', '')), path, item.get('name', ''),
+                     1 if item.get('is_dir') else 0, item.get('size') or 0, item.get('modified') or '')
+                    for item in items
+                ]
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO dirs (path, modified, crawled_at) VALUES (?, ?, ?)",
+                (path, modified or '', time.time())
+            )
+
+    def _search(self, query, limit):
+        db = self._db()
+        terms = query.split()
+        long_terms = [t for t in terms if len(t) >= 3] if self.fts else []
+        short_terms = [t for t in terms if t not in long_terms]
+
+        like_sql = "".join(" AND e.name LIKE ? ESCAPE '\\'" for _ in short_terms)
+        like_args = [f"%{_like_escape(t)}%" for t in short_terms]
+        columns = "e.path, e.name, e.is_dir, e.size, e.modified"
+
+        if long_terms:
+            match = " AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+            sql = (
+                f"SELECT {columns} FROM entries_fts f JOIN entries e ON e.id = f.rowid "
+                f"WHERE entries_fts MATCH ?{like_sql} ORDER BY bm25(entries_fts), length(e.name) LIMIT ?"
+            )
+            args = [match] + like_args + [limit]
+        else:
+            sql = (
+                f"SELECT {columns} FROM entries e WHERE 1 = 1{like_sql} "
+                f"ORDER BY (lower(e.name) = lower(?)) DESC, length(e.name) LIMIT ?"
+            )
+            args = like_args + [query, limit]
+        return [
+            {'path': r[0], 'name': r[1], 'is_dir': bool(r[2]), 'size': r[3], 'modified': r[4]}
+            for r in db.execute(sql, args).fetchall()
+        ]
+
+    def _counts(self):
+        db = self._db()
+        files = db.execute("SELECT COUNT(*) FROM entries WHERE is_dir = 0").fetchone()[0]
+        dirs = db.execute("SELECT COUNT(*) FROM dirs").fetchone()[0]
+        return files, dirs
+
+    async def _run_db(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    # --- 对外接口 ---
+
+    async def search(self, query, limit=10):
+        """按相关度返回匹配的条目列表"""
+        query = query.strip()
+        if not query:
+            return []
+        return await self._run_db(self._search, query, limit)
+
+    async def status(self):
+        files, dirs = await self._run_db(self._counts)
+        return {'files': files, 'dirs': dirs, 'crawling': self.crawling, 'last_crawl': self.last_crawl}
+
+    async def crawl(self, root="/"):
+        """增量遍历 Alist，返回本次 (列出目录数, 跳过目录数)"""
+        if self.crawling:
+            return 0, 0
+        self.crawling = True
+        config = load_config()
+        concurrency = max(1, config.get('alist_index_concurrency', 2))
+        full_interval = config.get('alist_index_full_interval', 24) * 3600
+
+        queue = asyncio.Queue()
+        queue.put_nowait((root, None))
+        stats = {'listed': 0, 'skipped': 0}
+
+        async def worker():
+            while True:
+                path, modified = await queue.get()
+                try:
+                    await self._crawl_dir(path, modified, full_interval, queue, stats)
+                except Exception as e:
+                    logger.warning(f"索引目录失败 {path}: {e}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            await queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+            self.crawling = False
+            self.last_crawl = time.time()
+        logger.info(f"索引完成: 列出 {stats['listed']} 个目录，跳过 {stats['skipped']} 个未变化目录")
+        return stats['listed'], stats['skipped']
+
+    async def _crawl_dir(self, path, modified, full_interval, queue, stats):
+        stored_modified, crawled_at = await self._run_db(self._get_dir_state, path)
+        unchanged = (
+            modified is not None
+            and modified not in ZERO_TIMES
+            and modified == stored_modified
+            and time.time() - crawled_at < full_interval
+        )
+
+        if unchanged:
+            stats['skipped'] += 1
+            subdirs = await self._run_db(self._get_subdirs, path)
+        else:
+            success, items = await alist_list_files(path)
+            if not success:
+                logger.warning(f"列出目录失败 {path}: {items}")
+                return
+            stats['listed'] += 1
+            await self._run_db(self._replace_dir, path, modified, items)
+            subdirs = [
+                (posixpath.join(path, item.get('name', '')), item.get('modified') or '')
+                for item in items if item.get('is_dir')
+            ]
+
+        for sub_path, sub_modified in subdirs:
+            queue.put_nowait((sub_path, sub_modified))
+
+    async def run_periodic(self):
+        """按 alist_index_interval (分钟) 周期性更新索引，0 表示关闭"""
+        while True:
+            interval = load_config().get('alist_index_interval', 360)
+            if interval <= 0:
+                return
+            if get_alist_pid():
+                try:
+                    await self.crawl()
+                except Exception as e:
+                    logger.error(f"索引任务异常: {e}")
+            await asyncio.sleep(interval * 60)
+
+search_index = AlistSearchIndex()
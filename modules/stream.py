@@ -1,16 +1,33 @@
 import asyncio
 import subprocess
 import os
+import time
 import logging
+import psutil
+from functools import partial
 from urllib.parse import quote
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from .config import load_config, FFMPEG_LOG_FILE
-from .alist import resolve_alist_path
+from .alist import resolve_alist_path, get_auth_token, invalidate_resolved_link, get_alist_file_stamp
+from .media import (
+    probe_media, choose_stream_mode, local_media_key, alist_media_key, input_tuning_opts, stream_maps
+)
+from .loopclip import loop_clip_cache, loop_video_cache
+from .adaptive import AdaptiveController, build_encoder_ladder, profile_label, calibration_target
+from .prepared import prepared_catalog
+from .process import stop_process
+from .fanout import FanOut
+from .proxy import read_ahead_proxy
+from .recorder import tee_output_opts, tee_slave, record_output
 
 logger = logging.getLogger("Stream")
 
-# 全局变量用于存储 FFmpeg 进程
-ffmpeg_process = None
+# 命令中的 -progress 目标占位符，启动时替换为管道的写端 (pipe:<fd>)
+# 用管道而不是文件：24 小时推流时进度文件会无限增长
+PROGRESS_PIPE = "pipe:{progress}"
+
+# 未探测到轨道信息时的默认映射。tee 输出不会自动选择流，必须显式指定
+DEFAULT_MAPS = ["-map", "0:v:0", "-map", "0:a:0?"]
 
 def kill_zombie_processes():
     """启动时清除残留的 FFmpeg 和 Aria2 进程"""
@@ -21,27 +38,11 @@ def kill_zombie_processes():
     except:
         pass
 
-def get_stream_status():
-    global ffmpeg_process
-    return ffmpeg_process is not None and ffmpeg_process.poll() is None
-
-def stop_ffmpeg_process():
-    global ffmpeg_process
-    if ffmpeg_process:
-        ffmpeg_process.terminate()
-        try:
-            ffmpeg_process.wait(timeout=3)
-        except subprocess.TimeoutExpired:
-            ffmpeg_process.kill()
-        ffmpeg_process = None
-        return True
-    return False
-
-def get_log_content(max_chars=1500):
+def _read_log_tail(log_path, max_chars):
     content = "暂无日志"
     try:
-         if os.path.exists(FFMPEG_LOG_FILE):
-             with open(FFMPEG_LOG_FILE, "r", encoding='utf-8', errors='ignore') as f:
+         if os.path.exists(log_path):
+             with open(log_path, "r", encoding='utf-8', errors='ignore') as f:
                  f.seek(0, os.SEEK_END)
                  file_size = f.tell()
                  seek_point = max(0, file_size - max_chars * 2) 
@@ -56,61 +57,493 @@ def get_log_content(max_chars=1500):
         content = "日志为空 (FFmpeg 可能刚启动或未输出错误)。"
     return content
 
-async def run_ffmpeg_stream(update: Update, raw_src: str, custom_rtmp: str = None, background_image=None):
-    """执行推流逻辑"""
-    global ffmpeg_process
-    
-    message = update.effective_message
-    if not message and update.callback_query:
-        message = update.callback_query.message
+def _parse_progress_block(block):
+    """把 -progress 输出的一组 key=value 转成指标字典"""
+    def num(value, cast=float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
 
-    if get_stream_status():
-        if message:
-            await message.reply_text("⚠️ **推流正在进行中**\n请先使用 `/stopstream` 停止当前任务。", parse_mode='Markdown')
-        return
+    bitrate = block.get("bitrate", "")
+    speed = block.get("speed", "")
+    out_time_us = num(block.get("out_time_us") or block.get("out_time_ms"), int)
+    return {
+        "frame": num(block.get("frame"), int),
+        "fps": num(block.get("fps")),
+        "bitrate_kbps": num(bitrate[:-len("kbits/s")]) if bitrate.endswith("kbits/s") else None,
+        "total_size": num(block.get("total_size"), int),
+        "out_time": out_time_us / 1_000_000 if out_time_us is not None and out_time_us >= 0 else None,
+        "dup_frames": num(block.get("dup_frames"), int),
+        "drop_frames": num(block.get("drop_frames"), int),
+        "speed": num(speed[:-1]) if speed.endswith("x") else None,
+        "updated_at": time.time(),
+    }
 
-    # --- 获取配置 ---
-    config = load_config()
+def open_progress_pipe(cmd):
+    """
+    为 -progress 创建管道：把命令中的 PROGRESS_PIPE 替换为写端。
+    返回 (新命令, 读端文件, 写端 fd)；启动子进程时传 pass_fds=(写端,)，之后在本进程中关闭写端
+    """
+    read_fd, write_fd = os.pipe()
+    cmd = [f"pipe:{write_fd}" if arg == PROGRESS_PIPE else arg for arg in cmd]
+    return cmd, os.fdopen(read_fd, "rb", buffering=0), write_fd
+
+async def read_progress(progress_pipe, on_block):
+    """解析 -progress 管道直到 EOF (进程退出)，每组数据调用一次 on_block(指标)"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    try:
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), progress_pipe)
+    except Exception:
+        progress_pipe.close()
+        raise
+    block = {}
+    try:
+        async for raw in reader:
+            key, sep, value = raw.decode(errors='ignore').strip().partition("=")
+            if not sep:
+                continue
+            block[key] = value
+            # 每组数据以 progress=continue/end 结尾
+            if key == "progress":
+                on_block(_parse_progress_block(block))
+                block = {}
+    finally:
+        transport.close()
+
+class StreamSession:
+    """单个推流会话，绑定一个推流密钥和一个 FFmpeg 进程 (asyncio 子进程)"""
+
+    # 启动阶段超过该时间仍未创建进程，视为启动失败并释放密钥
+    STARTING_TIMEOUT = 60
+
+    def __init__(self, session_id, key_index, key_name, rtmp_url, source, mode_text):
+        self.id = session_id
+        self.key_index = key_index
+        # 会话占用的全部密钥 (多路推流时不止一个)
+        self.key_indexes = {key_index} if key_index is not None else set()
+        # 多路推流: 编码一次，由 fanout 复制到每个目标
+        self.fanout = None
+        # 同时把推流内容写入本地录像分段
+        self.record = False
+        self.key_name = key_name
+        self.rtmp_url = rtmp_url
+        self.source = source
+        self.mode_text = mode_text
+        self.process = None
+        # 启动阶段 (解析路径/构建命令) 已占用密钥，但进程尚未创建
+        self.starting = True
+        self.cancelled = False
+        self.started_at = time.time()
+        self.log_path = f"{os.path.splitext(FFMPEG_LOG_FILE)[0]}_{session_id}.log"
+        # FFmpeg -progress 输出 (经管道)，由后台任务解析为实时指标
+        self.metrics = {}
+        # 首批数据真正发出后置为 True
+        self.ready = False
+        self._telemetry_task = None
+        # 编码器重启期间 (自适应调整) 仍视为运行中
+        self.restarting = False
+        self.adaptive = None
+        # 推流方式 (build_stream_cmd 的参数)，重启时复用
+        self.plan = None
+        # 最近一次 (重新) 启动时源文件的起始位置
+        self.position_base = 0.0
+        self.recoveries = 0
+        # 监督任务运行中 (进程退出后可能被自动恢复)
+        self.supervising = False
+        # 停止时的附加清理 (如播放列表的输入进程)
+        self.on_stop = None
+        # 停止时写入 stdin 的内容；为空时只关闭 stdin (输入来自管道的进程)
+        self.stdin_quit = b"q"
+        self.exit_code = None
+        self._ps = None
+
+    def is_running(self):
+        if self.restarting and not self.cancelled:
+            return True
+        if self.process is None:
+            return self.starting and time.time() - self.started_at < self.STARTING_TIMEOUT
+        return self.process.returncode is None
+
+    def cpu_percent(self):
+        """进程 CPU 占用 (单核百分比)，自上次调用以来的平均值"""
+        if not self.is_running():
+            return 0.0
+        try:
+            if self._ps is None or self._ps.pid != self.process.pid:
+                self._ps = psutil.Process(self.process.pid)
+                self._ps.cpu_percent(interval=None)
+                return 0.0
+            return self._ps.cpu_percent(interval=None)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return 0.0
+
+    async def stop(self):
+        self.starting = False
+        self.cancelled = True
+        if self.on_stop:
+            self.on_stop()
+        process = self.process
+        if process:
+            await stop_process(process, self.stdin_quit)
+            self.process = None
+        if self.fanout:
+            await self.fanout.stop()
+        self.discard_loop_cache()
+        return process is not None
+
+    def discard_loop_cache(self):
+        """删除循环推流第一遍未写完的编码缓存"""
+        plan = self.plan or {}
+        if plan.get('kind') == 'encode' and plan.get('loop_source_key'):
+            loop_video_cache.discard(loop_video_cache.cache_key(plan['loop_source_key'], plan['profile']))
+
+    async def launch(self, cmd, append=False):
+        """启动 FFmpeg (stdin 保留用于优雅退出)，并开始解析进度与监听退出"""
+        cmd, progress_pipe, write_fd = open_progress_pipe(cmd)
+        try:
+            with open(self.log_path, "a" if append else "w", encoding='utf-8') as log_file:
+                if self.fanout:
+                    # 多路推流时 stdout 是编码后的 TS 数据
+                    process = await asyncio.create_subprocess_exec(
+                        *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=log_file,
+                        pass_fds=(write_fd,)
+                    )
+                    self.fanout.attach(process)
+                else:
+                    process = await asyncio.create_subprocess_exec(
+                        *cmd, stdin=asyncio.subprocess.PIPE, stdout=log_file, stderr=asyncio.subprocess.STDOUT,
+                        pass_fds=(write_fd,)
+                    )
+        except BaseException:
+            progress_pipe.close()
+            raise
+        finally:
+            # 写端只留在子进程中，进程退出时读端收到 EOF
+            os.close(write_fd)
+        self.process = process
+        self.starting = False
+        self.exit_code = None
+        self.start_telemetry(process, progress_pipe)
+        asyncio.get_running_loop().create_task(self._watch_exit(process))
+        return process
+
+    async def _watch_exit(self, process):
+        """每个进程一个退出监听任务"""
+        code = await process.wait()
+        if process is self.process:
+            self.exit_code = code
+        logger.info(f"#{self.id} FFmpeg (PID {process.pid}) 已退出，退出码 {code}")
+
+    def position(self):
+        """当前播放到源文件的位置 (秒)"""
+        return self.position_base + (self.metrics.get("out_time") or 0)
+
+    def get_log(self, max_chars=1500):
+        return _read_log_tail(self.log_path, max_chars)
+
+    def start_telemetry(self, process, progress_pipe):
+        """
+        进程启动后调用，开始在后台解析 -progress 输出。
+        旧进程的解析任务在其管道 EOF 时自行结束，不再更新指标
+        """
+        self.metrics = {}
+        self.ready = False
+        self._telemetry_task = asyncio.get_running_loop().create_task(
+            read_progress(progress_pipe, partial(self._on_progress, process))
+        )
+
+    async def relaunch(self, cmd):
+        """结束当前进程并以新命令重启 (日志追加写入)，返回是否成功启动"""
+        self.restarting = True
+        try:
+            old = self.process
+            if old is not None:
+                await stop_process(old, self.stdin_quit)
+            if self.cancelled:
+                return False
+            await self.launch(cmd, append=True)
+            return True
+        finally:
+            self.restarting = False
+
+    def _on_progress(self, process, metrics):
+        # 已被替换的旧进程最后输出的数据不再更新指标
+        if process is not self.process:
+            return
+        self.metrics = metrics
+        if (metrics.get("total_size") or 0) > 0 or (metrics.get("out_time") or 0) > 0:
+            self.ready = True
+
+    async def wait_ready(self, timeout):
+        """
+        等待首批数据发出
+        返回: True 已开始输出 / False 进程已退出或被停止 / None 超时但进程仍在运行
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.ready:
+                return True
+            if self.process is None or self.process.returncode is not None:
+                return False
+            await asyncio.sleep(0.2)
+        return True if self.ready else None
+
+    def metrics_text(self):
+        m = self.metrics
+        if not m:
+            return "📈 等待数据..."
+        out_time = int(m.get("out_time") or 0)
+        size_mb = (m.get("total_size") or 0) / 1024 / 1024
+        parts = [
+            f"{m['fps']:.1f}fps" if m.get("fps") is not None else "-fps",
+            f"{m['speed']:.2f}x" if m.get("speed") is not None else "-x",
+            f"{m['bitrate_kbps']:.0f}kbps" if m.get("bitrate_kbps") is not None else "-kbps",
+            f"{out_time // 3600:02d}:{out_time % 3600 // 60:02d}:{out_time % 60:02d}",
+            f"{size_mb:.1f}MB",
+        ]
+        text = "📈 " + " | ".join(parts) + f"\n   丢帧 {m.get('drop_frames') or 0} / 重复 {m.get('dup_frames') or 0}"
+        speed = m.get("speed")
+        if speed is not None and speed < 0.95 and out_time > 10:
+            text += "\n   ⚠️ 编码速度跟不上实时，建议降低分辨率/码率或使用更快的 preset"
+        if time.time() - m.get("updated_at", 0) > 10 and self.is_running():
+            text += "\n   ⚠️ 超过 10 秒没有新数据"
+        return text
+
+    def status_text(self):
+        state = "🟢 运行中" if self.is_running() else "⚪ 已结束"
+        uptime = int(time.time() - self.started_at)
+        return (
+            f"#{self.id} {state} | 🔑 {self.key_name}\n"
+            f"   📄 {os.path.basename(self.source)}\n"
+            f"   🛠 {self.mode_text} | ⏱ {uptime // 60}分{uptime % 60}秒\n"
+            f"   {self.metrics_text()}"
+            + (f"\n   {self.adaptive.status_text()}" if self.adaptive else "")
+            + (f"\n   ♻️ 已自动恢复 {self.recoveries} 次" if self.recoveries else "")
+            + (f"\n   {self.fanout.status_text()}" if self.fanout else "")
+            + ("\n   ⏺ 录像中" if self.record else "")
+        )
+
+class StreamManager:
+    """
+    多会话推流管理器。
+    每个会话绑定一个推流密钥，同一密钥不能同时推两路；
+    新会话根据当前 CPU 余量决定是否允许启动。
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self._next_id = 1
+
+    def cleanup(self):
+        """移除已退出的会话 (等待自动恢复的会话保留)"""
+        for sid in [sid for sid, sess in self.sessions.items() if not sess.is_running() and not sess.supervising]:
+            sess = self.sessions.pop(sid)
+            if sess.fanout:
+                # 编码器已结束，关闭各路转推
+                asyncio.get_running_loop().create_task(sess.fanout.stop())
+
+    def running(self):
+        self.cleanup()
+        return list(self.sessions.values())
+
+    def loop_cache_files(self):
+        """会话正在循环读取的缓存文件 (图片循环片段和循环编码缓存)，淘汰缓存时需要保留"""
+        files = set()
+        for sess in self.sessions.values():
+            plan = sess.plan or {}
+            files.update(path for path in (plan.get('loop_clip'), plan.get('cache_file')) if path)
+        return files
+
+    def get(self, session_id):
+        return self.sessions.get(str(session_id))
+
+    def key_in_use(self, key_index):
+        return any(key_index in sess.key_indexes for sess in self.running())
+
+    def pick_key(self, stream_keys, preferred):
+        """优先使用指定密钥，被占用时选择第一个空闲密钥；全部占用返回 None"""
+        if 0 <= preferred < len(stream_keys) and not self.key_in_use(preferred):
+            return preferred
+        for idx in range(len(stream_keys)):
+            if not self.key_in_use(idx):
+                return idx
+        return None
+
+    async def check_admission(self, config):
+        """
+        根据 CPU 余量判断能否再启动一路推流
+        返回: (allowed, reason)
+        """
+        running = self.running()
+        if not running:
+            return True, ""
+
+        max_sessions = config.get('stream_max_sessions', 3)
+        if len(running) >= max_sessions:
+            return False, f"已达到最大并发推流数 ({max_sessions})"
+
+        # 采样系统 CPU (在线程中执行，避免阻塞事件循环)
+        loop = asyncio.get_running_loop()
+        for sess in running:
+            sess.cpu_percent()
+        system_usage = await loop.run_in_executor(None, lambda: psutil.cpu_percent(interval=1))
+        session_costs = [sess.cpu_percent() for sess in running]
+
+        cores = psutil.cpu_count() or 1
+        reserve = config.get('stream_cpu_reserve', 20)
+        headroom = cores * (100 - reserve) - system_usage * cores
+        # 以现有会话的平均占用估算新会话开销 (单位: 单核百分比)
+        estimate = max(sum(session_costs) / len(session_costs), config.get('stream_session_cpu_min', 50))
+        if headroom < estimate:
+            return False, f"CPU 余量不足 (剩余约 {max(headroom, 0):.0f}%，预计需要 {estimate:.0f}%)"
+        return True, ""
+
+    def create(self, key_index, key_name, rtmp_url, source, mode_text):
+        session = StreamSession(str(self._next_id), key_index, key_name, rtmp_url, source, mode_text)
+        self._next_id += 1
+        self.sessions[session.id] = session
+        return session
+
+    def discard(self, session):
+        self.sessions.pop(session.id, None)
+        if session.fanout:
+            asyncio.get_running_loop().create_task(session.fanout.stop())
+
+    async def stop(self, session_id=None):
+        """停止指定会话，session_id 为空时停止全部；返回停止的会话数"""
+        if session_id is None:
+            targets = list(self.sessions.values())
+        else:
+            sess = self.get(session_id)
+            targets = [sess] if sess else []
+        for sess in targets:
+            self.discard(sess)
+        results = await asyncio.gather(*(sess.stop() for sess in targets))
+        return sum(1 for stopped in results if stopped)
+
+stream_manager = StreamManager()
+
+def get_stream_status():
+    """是否有任意推流会话在运行"""
+    return bool(stream_manager.running())
+
+async def stop_ffmpeg_process(session_id=None):
+    """停止指定会话 (为空时停止全部)，有会话被停止时返回 True"""
+    return await stream_manager.stop(session_id) > 0
+
+def get_log_content(max_chars=1500, session_id=None):
+    """读取指定会话 (默认最近一个) 的 FFmpeg 日志"""
+    sess = stream_manager.get(session_id) if session_id else None
+    if sess is None and session_id is None and stream_manager.sessions:
+        sess = list(stream_manager.sessions.values())[-1]
+    if sess is not None:
+        return sess.get_log(max_chars)
+    return _read_log_tail(FFMPEG_LOG_FILE, max_chars)
+
+async def reserve_stream_session(message, config, raw_src, custom_rtmp=None, key_index=None, key_indexes=None):
+    """
+    选择推流密钥并通过 CPU 准入检查后登记新会话
+    key_indexes: 多个密钥时为多路推流 (编码一次，推到每个密钥)
+    失败时回复原因并返回 None
+    """
     server = config.get('rtmp_server', '')
     stream_keys = config.get('stream_keys', [])
     active_index = config.get('active_key_index', 0)
-    
-    # 高级推流参数 (从 .env 读取)
-    stream_width = config.get('stream_width', 1280)
-    stream_height = config.get('stream_height', 720)
-    stream_fps = config.get('stream_fps', 25)
-    stream_preset = config.get('stream_preset', 'veryfast')
-    stream_bitrate = config.get('stream_bitrate', '2000k')
-    
-    alist_host = config.get('alist_host', "http://127.0.0.1:5244")
+
+    if key_indexes and len(key_indexes) > 1 and not custom_rtmp:
+        return await _reserve_multi_session(message, config, raw_src, key_indexes)
 
     key = ""
     current_key_name = "未命名"
-    if stream_keys and 0 <= active_index < len(stream_keys):
-        key = stream_keys[active_index]['key']
-        current_key_name = stream_keys[active_index]['name']
+    chosen_index = None
+    if not custom_rtmp:
+        if stream_keys:
+            preferred = key_index if key_index is not None else active_index
+            chosen_index = stream_manager.pick_key(stream_keys, preferred)
+            if chosen_index is None:
+                if message:
+                    await message.reply_text("⚠️ **所有推流密钥都在使用中**\n请先使用 `/stopstream` 停止一路推流，或添加新的密钥。", parse_mode='Markdown')
+                return None
+            key = stream_keys[chosen_index]['key']
+            current_key_name = stream_keys[chosen_index]['name']
+        elif stream_manager.running():
+            # 未配置密钥时只能使用单一 rtmp 地址推一路
+            if message:
+                await message.reply_text("⚠️ **推流正在进行中**\n请先使用 `/stopstream` 停止当前任务。", parse_mode='Markdown')
+            return None
     
     rtmp_url = custom_rtmp if custom_rtmp else (server + key if server and key else config.get('rtmp', ''))
         
     if not rtmp_url:
         if message:
             await message.reply_text("❌ **推流地址无效**\n请检查 [📺 推流设置]。", parse_mode='Markdown')
-        return
+        return None
+
+    # 根据 CPU 余量决定是否允许新会话
+    allowed, reason = await stream_manager.check_admission(config)
+    if not allowed:
+        if message:
+            await message.reply_text(f"⚠️ **无法启动新的推流**\n{reason}", parse_mode='Markdown')
+        return None
 
-    # --- 处理文件路径 ---
+    # 立即登记会话以占用密钥，防止并发请求选中同一密钥
+    session = stream_manager.create(chosen_index, current_key_name, rtmp_url, raw_src, "")
+    session.record = bool(config.get('stream_record', 0))
+    return session
+
+async def _reserve_multi_session(message, config, raw_src, key_indexes):
+    server = config.get('rtmp_server', '')
+    stream_keys = config.get('stream_keys', [])
+    key_indexes = [idx for idx in dict.fromkeys(key_indexes) if 0 <= idx < len(stream_keys)]
+
+    if not server:
+        if message:
+            await message.reply_text("❌ **推流地址无效**\n多路推流需要先设置服务器地址。", parse_mode='Markdown')
+        return None
+    busy = [stream_keys[idx]['name'] for idx in key_indexes if stream_manager.key_in_use(idx)]
+    if busy:
+        if message:
+            await message.reply_text(f"⚠️ 以下密钥正在使用中: {', '.join(busy)}")
+        return None
+
+    allowed, reason = await stream_manager.check_admission(config)
+    if not allowed:
+        if message:
+            await message.reply_text(f"⚠️ **无法启动新的推流**\n{reason}", parse_mode='Markdown')
+        return None
+
+    destinations = [(stream_keys[idx]['name'], server + stream_keys[idx]['key']) for idx in key_indexes]
+    names = "+".join(name for name, _ in destinations)
+    session = stream_manager.create(key_indexes[0], names, destinations[0][1], raw_src, "")
+    session.key_indexes = set(key_indexes)
+    session.fanout = FanOut(destinations, session.log_path)
+    session.record = bool(config.get('stream_record', 0))
+    return session
+
+async def resolve_stream_source(raw_src, config):
+    """
+    把本地路径 / Alist 路径 / URL 解析为 FFmpeg 输入
+    返回: (src, input_opts, is_local_file)
+    input_opts 为放在该输入 -i 之前的参数 (FFmpeg 与 ffprobe 共用)
+    """
+    alist_host = config.get('alist_host', "http://127.0.0.1:5244")
     src = raw_src.strip()
     is_local_file = os.path.exists(src)
     resolved_via_api = False
+    input_opts = []
     
     # 智能判断 Alist 路径
     if not is_local_file and not src.startswith("http") and not src.startswith("rtmp"):
         # 尝试通过 API 解析真实链接 (解决 401 和重定向问题)
         try:
-            loop = asyncio.get_running_loop()
-            real_url = await loop.run_in_executor(None, lambda: resolve_alist_path(src))
+            real_url = await resolve_alist_path(src)
             
             if real_url:
-                src = real_url
+                # 开启预读代理时由本地代理读取上游，FFmpeg 只访问本地缓存
+                proxy_url = await read_ahead_proxy.url_for(src) if config.get('stream_proxy', 0) else None
+                src = proxy_url or real_url
                 resolved_via_api = True
                 logger.info("Alist path resolved successfully via API.")
             else:
@@ -122,39 +555,8 @@ async def run_ffmpeg_stream(update: Update, raw_src: str, custom_rtmp: str = Non
             logger.error(f"Path resolution error: {e}")
             encoded_src = quote(src, safe='/')
             src = f"{alist_host}/d{encoded_src}"
-    
-    # --- 模式判断 ---
-    display_rtmp = rtmp_url[:20] + "..." + rtmp_url[-5:] if len(rtmp_url) > 30 else rtmp_url
-    is_slideshow = isinstance(background_image, list) and len(background_image) > 0
-    is_single_image = isinstance(background_image, str) and background_image
-    
-    mode_text = "未知模式"
-    if is_slideshow:
-        mode_text = f"🎵 音频+轮播 ({len(background_image)}图)"
-    elif is_single_image:
-        mode_text = "🎵 音频+单图"
-    elif is_local_file:
-        mode_text = "💿 本地视频"
-    else:
-        mode_text = "🌐 网络流/Alist"
-
-    status_msg = None
-    if message:
-        status_msg = await message.reply_text(
-            f"🚀 启动推流 ({stream_width}x{stream_height}@{stream_fps}fps)...\n\n"
-            f"📄 {os.path.basename(raw_src)}\n"
-            f"🔑 {current_key_name}\n"
-            f"📡 {display_rtmp}\n"
-            f"🛠 {mode_text}"
-        )
 
-    # --- 构建命令 ---
-    # 基础命令
-    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
-    
-    if is_local_file:
-        cmd.append("-re")
-    else:
+    if not is_local_file:
         # Header 逻辑优化:
         # 1. 如果是 API 解析出的外部链接 (signed url)，通常不需要 Auth Header，避免干扰 (400 Bad Request)
         # 2. 如果是 fallback 的 /d/ 链接，或者解析后依然是 alist host，则添加 Token
@@ -166,56 +568,125 @@ async def run_ffmpeg_stream(update: Update, raw_src: str, custom_rtmp: str = Non
             need_auth = True
             
         if need_auth:
-            alist_token = config.get('alist_token', '')
+            alist_token = await get_auth_token()
             if alist_token:
-                cmd.extend(["-headers", f"Authorization: {alist_token}\r\nUser-Agent: TermuxBot\r\n"])
+                input_opts.extend(["-headers", f"Authorization: {alist_token}\r\nUser-Agent: TermuxBot\r\n"])
             else:
-                cmd.extend(["-user_agent", "TermuxBot"])
+                input_opts.extend(["-user_agent", "TermuxBot"])
         else:
             # 外部链接只加 UA
-            cmd.extend(["-user_agent", "TermuxBot"])
+            input_opts.extend(["-user_agent", "TermuxBot"])
         
-        cmd.extend([
+        input_opts.extend([
             "-reconnect", "1", "-reconnect_at_eof", "1", 
             "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
             "-rw_timeout", "15000000"
         ])
+    return src, input_opts, is_local_file
+
+def media_cache_key(raw_src, is_local_file):
+    """媒体信息缓存键：本地文件按 mtime，Alist 文件按解析直链时得到的修改时间；其他 URL 不缓存"""
+    path = raw_src.strip()
+    if is_local_file:
+        return local_media_key(path)
+    if path.startswith(("http", "rtmp")):
+        return None
+    stamp = get_alist_file_stamp(path)
+    return alist_media_key(path, *stamp) if stamp else None
+
+def build_encode_cmd(src, input_opts, paced, profile, start_at=0, maps=None):
+    """
+    纯视频转码命令的输入与编码部分 (profile 为自适应档位，start_at 为起始播放位置)
+    paced: 按实际速率读取输入 (点播源)，直播源本身就是实时的
+    """
+    width, height, fps, kbps = profile['width'], profile['height'], profile['fps'], profile['kbps']
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+    if paced:
+        cmd.append("-re")
+    cmd.extend(input_opts)
+    if start_at:
+        cmd.extend(["-ss", f"{start_at:.2f}"])
+    cmd.extend(["-i", src, *(maps or DEFAULT_MAPS)])
+    cmd.extend([
+        "-c:v", "libx264", "-preset", profile['preset'],
+        # 如果原视频不是 16:9，也会加黑边，保持专业感
+        "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,fps={fps},format=yuv420p",
+        "-g", str(fps * 2),
+        "-b:v", f"{kbps}k", "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k",
+        "-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k",
+    ])
+    return cmd
 
-    # --- 场景分歧 (动态画质) ---
+def stream_output_opts(session, cache_part=None):
+    """
+    推流输出部分 (进度输出 + FLV/RTMP；多路推流时输出 TS 到 stdout)
+    开启录像或写循环编码缓存 (cache_part) 时用 tee 同时写出
+    """
+    opts = ["-progress", PROGRESS_PIPE]
+    ts_offset = (session.plan or {}).get('ts_offset')
+    if ts_offset:
+        # 循环推流换用缓存文件后接续之前的时间戳
+        opts += ["-output_ts_offset", f"{ts_offset:.3f}"]
 
+    slaves = []
+    if session.record:
+        slaves.append(record_output(session, load_config().get('record_segment_seconds', 600)))
+    if cache_part:
+        slaves.append(tee_slave("f=mpegts:onfail=ignore", cache_part))
+
+    if session.fanout:
+        if slaves:
+            return opts + tee_output_opts([tee_slave("f=mpegts", "pipe:1")] + slaves)
+        return opts + ["-f", "mpegts", "pipe:1"]
+    if slaves:
+        return opts + tee_output_opts([tee_slave("f=flv:flvflags=no_duration_filesize", session.rtmp_url)] + slaves)
+    return opts + [
+        "-f", "flv", 
+        "-flvflags", "no_duration_filesize", 
+        session.rtmp_url
+    ]
+
+def build_stream_cmd(plan, src, input_opts, is_local_file, session, start_at=0):
+    """
+    根据推流方式生成完整的 FFmpeg 命令
+    start_at: 源文件的起始位置 (秒)，用于续播
+    """
+    width, height, fps = plan['width'], plan['height'], plan['fps']
+    kind = plan['kind']
+    # 已知媒体信息时收紧输入探测
+    input_opts = list(input_opts) + plan.get('input_tuning', [])
     # 滤镜：动态分辨率缩放
-    SCALE_FILTER = f"scale={stream_width}:{stream_height}:force_original_aspect_ratio=decrease,pad={stream_width}:{stream_height}:(ow-iw)/2:(oh-ih)/2"
+    SCALE_FILTER = f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2"
+    # 本地文件和有时长的点播源按实际速率读取，否则直接封装会以下载速度推完整个文件
+    # (图片模式下由画面输入控制速率)；直播源本身就是实时的
+    pace_opts = ["-re"] if is_local_file or plan.get('duration') else []
+    seek_opts = ["-ss", f"{start_at:.2f}"] if start_at else []
 
-    if is_slideshow:
-        # === 轮播模式 ===
-        list_file = os.path.abspath("slideshow_list.txt")
-        try:
-            target_duration = 20000 
-            img_duration = 10 
-            loops_needed = int(target_duration / (len(background_image) * img_duration)) + 1
-            
-            with open(list_file, "w", encoding='utf-8') as f:
-                for _ in range(loops_needed):
-                    for img_path in background_image:
-                        safe_path = img_path.replace("'", "'\\''")
-                        f.write(f"file '{safe_path}'\n")
-                        f.write(f"duration {img_duration}\n")
-                if background_image:
-                     safe_path = background_image[-1].replace("'", "'\\''")
-                     f.write(f"file '{safe_path}'\n")
-        except Exception as e:
-            if status_msg: await status_msg.edit_text(f"❌ 列表生成失败: {e}")
-            return
+    # 基础命令
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+
+    if kind == "loop":
+        cmd.extend([
+            "-stream_loop", "-1", "-re", "-i", plan['loop_clip'],  # [0] 循环画面
+            *input_opts, *seek_opts, "-i", src,                   # [1] 音频流
+
+            "-map", "0:v:0", "-c:v", "copy",
+
+            "-map", "1:a:0",
+            "-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k",
+            "-shortest"
+        ])
 
+    elif kind == "slideshow":
         cmd.extend([
-            "-f", "concat", "-safe", "0", "-i", list_file, # [0] 视频流
-            "-i", src,                                     # [1] 音频流
+            *pace_opts, "-f", "concat", "-safe", "0", "-i", plan['list_file'], # [0] 视频流
+            *input_opts, *seek_opts, "-i", src,                               # [1] 音频流
             
             "-map", "0:v:0",
             "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage",
             "-pix_fmt", "yuv420p",
-            "-vf", f"{SCALE_FILTER},fps={stream_fps}", 
-            "-g", str(stream_fps * 2), 
+            "-vf", f"{SCALE_FILTER},fps={fps}", 
+            "-g", str(fps * 2), 
             "-b:v", "1000k", "-maxrate", "1500k", "-bufsize", "2000k",
 
             "-map", "1:a:0",
@@ -223,17 +694,16 @@ async def run_ffmpeg_stream(update: Update, raw_src: str, custom_rtmp: str = Non
             "-shortest"
         ])
 
-    elif is_single_image:
-        # === 单图模式 ===
+    elif kind == "single":
         cmd.extend([
-            "-loop", "1", "-framerate", str(stream_fps), "-i", background_image, # [0]
-            "-i", src,                                                # [1]
+            *pace_opts, "-loop", "1", "-framerate", str(fps), "-i", plan['image'], # [0]
+            *input_opts, *seek_opts, "-i", src,                                   # [1]
             
             "-map", "0:v:0",
             "-c:v", "libx264", "-preset", "ultrafast", "-tune", "stillimage",
             "-pix_fmt", "yuv420p",
             "-vf", f"{SCALE_FILTER},format=yuv420p",
-            "-g", str(stream_fps * 2),
+            "-g", str(fps * 2),
             "-b:v", "800k", "-maxrate", "1200k", "-bufsize", "2000k",
 
             "-map", "1:a:0",
@@ -241,63 +711,408 @@ async def run_ffmpeg_stream(update: Update, raw_src: str, custom_rtmp: str = Non
             "-shortest"
         ])
 
+    elif kind == "encode":
+        cmd = build_encode_cmd(src, input_opts, bool(pace_opts), plan['profile'], start_at, plan.get('maps'))
+        if plan.get('loop_source_key') and not start_at:
+            # 循环推流的一遍从头开始：同时把编码结果写入缓存
+            # (build_encode_cmd 总会带上 -map，tee 输出不依赖探测结果)
+            key = loop_video_cache.cache_key(plan['loop_source_key'], plan['profile'])
+            return cmd + stream_output_opts(session, loop_video_cache.part_path(key))
+
+    elif kind == "cached_loop":
+        # 循环推流: 直接封装已缓存的编码结果，FFmpeg 循环时自动接续时间戳
+        cmd.extend(["-re", "-stream_loop", "-1", "-i", plan['cache_file'], *DEFAULT_MAPS, "-c", "copy"])
+
     else:
-        # === 纯视频模式 ===
+        # copy / copy_video: 视频直接封装 (循环推流时由 FFmpeg 循环读取源)
+        loop_opts = ["-stream_loop", "-1"] if plan.get('loop') else []
+        cmd.extend(pace_opts + loop_opts + input_opts + seek_opts)
         cmd.append("-i")
         cmd.append(src)
-        
-        cmd.extend([
-            "-c:v", "libx264", "-preset", stream_preset,
-            # 如果原视频不是 16:9，也会加黑边，保持专业感
-            "-vf", f"{SCALE_FILTER},format=yuv420p",
-            "-g", str(stream_fps * 2),
-            "-b:v", stream_bitrate, "-maxrate", stream_bitrate, "-bufsize", str(int(stream_bitrate.replace('k',''))*2)+'k',
-            "-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k"
-        ])
+        cmd.extend(plan.get('maps') or DEFAULT_MAPS)
+        cmd.extend(["-c:v", "copy"])
+        if kind == "copy":
+            cmd.extend(["-c:a", "copy"])
+        else:
+            cmd.extend(["-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k"])
 
     # --- 输出部分 ---
-    cmd.extend([
-        "-f", "flv", 
-        "-flvflags", "no_duration_filesize", 
-        rtmp_url
-    ])
+    cmd.extend(stream_output_opts(session))
+    return cmd
+
+async def restart_stream(session, start_at=0, refresh_source=False):
+    """
+    按会话的 plan 重建命令并重启 FFmpeg
+    refresh_source: 丢弃缓存的 Alist 直链并重新解析 (链接可能已失效)
+    """
+    if refresh_source and not os.path.exists(session.source) and not session.source.startswith(("http", "rtmp")):
+        invalidate_resolved_link(session.source.strip())
+    src, input_opts, is_local_file = await resolve_stream_source(session.source, load_config())
+    if start_at and session.plan.get('loop_source_key'):
+        # 这一遍中途重启过，写出的编码缓存不完整
+        session.plan['loop_cache_dirty'] = True
+    cmd = build_stream_cmd(session.plan, src, input_opts, is_local_file, session, start_at)
+    session.position_base = start_at
+    return await session.relaunch(cmd)
+
+def _format_position(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
 
-    log_file = None
+def _quality_text(session):
+    """按实际推流方式 (plan) 描述输出画质"""
+    plan = session.plan
+    kind = plan['kind']
+    if kind == 'encode':
+        return profile_label(plan['profile']) + (" (自适应)" if session.adaptive else "")
+    if kind == 'cached_loop':
+        return profile_label(plan['profile']) + " (已缓存编码)"
+    if kind in ('copy', 'copy_video'):
+        return "源画质 (直接封装)"
+    return f"{plan['width']}x{plan['height']}@{plan['fps']}fps"
+
+async def supervise_stream(session, notify=None):
+    """
+    监督推流进程：意外退出时重新解析源并从中断位置续播。
+    重试间隔指数增长；stream_recover_window 秒内最多恢复 stream_recover_retries 次，
+    稳定运行超过该窗口后重新计数。
+    notify: 可选的协程函数，用于在聊天中报告恢复过程
+    """
+    async def report(text):
+        if notify:
+            try:
+                await notify(text)
+            except Exception as e:
+                logger.warning(f"恢复通知发送失败: {e}")
+
+    session.supervising = True
     try:
-        log_file = open(FFMPEG_LOG_FILE, "w", encoding='utf-8')
-        ffmpeg_process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
-        log_file.close()
-        log_file = None 
+        await _supervise_loop(session, report)
+    finally:
+        session.supervising = False
+
+async def _supervise_loop(session, report):
+    attempts = []
+    while True:
+        if session.cancelled:
+            return
+        if session.restarting:
+            # 自适应调整正在重启编码器
+            await asyncio.sleep(0.2)
+            continue
+        process = session.process
+        if process is None:
+            return
+        code = await process.wait()
+        if session.cancelled:
+            return
+        if session.restarting or session.process is not process:
+            continue
+
+        # 正常播放结束 (退出码为 0 且已到达文件末尾) 时不恢复
+        position = session.position()
+        duration = session.plan.get('duration') or 0
+        if code == 0 and (not session.plan.get('seekable') or not duration or position >= duration - 10):
+            if session.plan.get('loop'):
+                await _next_loop_pass(session)
+                continue
+            logger.info(f"#{session.id} 推流结束 (退出码 0)")
+            return
+
+        config = load_config()
+        max_retries = config.get('stream_recover_retries', 5)
+        window = config.get('stream_recover_window', 600)
+        now = time.time()
+        attempts = [t for t in attempts if now - t < window]
+        if len(attempts) >= max_retries:
+            logger.error(f"#{session.id} 恢复次数用尽，停止推流")
+            await report(f"❌ 推流 #{session.id} 在 {window // 60} 分钟内中断 {len(attempts)} 次，已放弃自动恢复。\n🔍 日志:\n{session.get_log(500)}")
+            return
+        attempts.append(now)
+
+        start_at = position if session.plan.get('seekable') else 0
+        if session.plan.get('loop') and duration:
+            # 循环读取时位置会超过时长
+            start_at %= duration
+        delay = min(2 ** len(attempts), 60)
+        logger.warning(f"#{session.id} FFmpeg 意外退出 (code {code})，{delay}s 后从 {start_at:.1f}s 恢复")
+        await report(
+            f"♻️ 推流 #{session.id} 意外中断 (退出码 {code})\n"
+            f"{delay} 秒后从 {_format_position(start_at)} 恢复 (第 {len(attempts)}/{max_retries} 次)"
+        )
+
+        # 等待期间保持会话 (占用密钥)，用户仍可手动停止
+        session.restarting = True
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            session.restarting = False
+        if session.cancelled:
+            return
+
+        try:
+            started = await restart_stream(session, start_at, refresh_source=True)
+        except Exception as e:
+            logger.error(f"#{session.id} 恢复失败: {e}")
+            started = False
+        if not started:
+            if session.cancelled:
+                return
+            continue
+
+        ready = await session.wait_ready(config.get('stream_ready_timeout', 20))
+        if ready:
+            session.recoveries += 1
+            await report(f"✅ 推流 #{session.id} 已恢复 ({_format_position(start_at)})")
+
+async def _next_loop_pass(session):
+    """
+    循环推流播完一遍：编码缓存完整时改为直接封装缓存，否则重新编码下一遍
+    """
+    plan = session.plan
+    if plan['kind'] == 'encode' and plan.get('loop_source_key'):
+        key = loop_video_cache.cache_key(plan['loop_source_key'], plan['profile'])
+        cache_file = None
+        if not plan.get('loop_cache_dirty'):
+            cache_file = loop_video_cache.commit(
+                key, load_config().get('loop_cache_max_mb', 500), in_use=stream_manager.loop_cache_files()
+            )
+        else:
+            loop_video_cache.discard(key)
+        if cache_file:
+            logger.info(f"#{session.id} 循环编码缓存完成，之后直接封装: {cache_file}")
+            plan.update(kind='cached_loop', cache_file=cache_file, seekable=False, ts_offset=plan['duration'])
+            session.adaptive = None
+            session.mode_text += " | 📦 已缓存编码"
+    plan['loop_cache_dirty'] = False
+    logger.info(f"#{session.id} 开始下一遍循环")
+    try:
+        await restart_stream(session, 0)
+    except Exception as e:
+        logger.error(f"#{session.id} 循环重启失败: {e}")
+
+async def _restart_encoder(session, profile, start_at):
+    """自适应调整时切换编码档位并重启"""
+    # 换档后这一遍的编码缓存作废
+    session.discard_loop_cache()
+    session.plan['profile'] = profile
+    await restart_stream(session, start_at)
+
+async def run_ffmpeg_stream(update: Update, raw_src: str, custom_rtmp: str = None, background_image=None, key_index: int = None, key_indexes=None, loop=False):
+    """
+    执行推流逻辑 (新建一个推流会话)
+    key_index: 指定使用的推流密钥，默认使用当前选中的密钥；被占用时自动选择空闲密钥
+    key_indexes: 同时推到多个密钥，只编码一次
+    loop: 纯视频无限循环播放；需要转码时只编码第一遍，之后直接封装缓存的编码结果
+    """
+    message = update.effective_message
+    if not message and update.callback_query:
+        message = update.callback_query.message
+
+    # --- 获取配置 ---
+    config = load_config()
+    
+    # 高级推流参数 (从 .env 读取)
+    stream_width = config.get('stream_width', 1280)
+    stream_height = config.get('stream_height', 720)
+    stream_fps = config.get('stream_fps', 25)
+    
+    session = await reserve_stream_session(message, config, raw_src, custom_rtmp, key_index, key_indexes)
+    if session is None:
+        return
+    status_msg = None
+    # 登记会话之后的任何异常都要释放会话 (否则密钥在 STARTING_TIMEOUT 内一直显示为启动中)
+    try:
+        rtmp_url = session.rtmp_url
+        current_key_name = session.key_name
+
+        # --- 处理文件路径 ---
+        src, input_opts, is_local_file = await resolve_stream_source(raw_src, config)
+        
+        # --- 模式判断 ---
+        display_rtmp = rtmp_url[:20] + "..." + rtmp_url[-5:] if len(rtmp_url) > 30 else rtmp_url
+        if session.fanout:
+            display_rtmp = f"多路推流 ({len(session.fanout.relays)} 个目标)"
+        is_slideshow = isinstance(background_image, list) and len(background_image) > 0
+        is_single_image = isinstance(background_image, str) and background_image
+        
+        mode_text = "未知模式"
+        if is_slideshow:
+            mode_text = f"🎵 音频+轮播 ({len(background_image)}图)"
+        elif is_single_image:
+            mode_text = "🎵 音频+单图"
+        elif is_local_file:
+            mode_text = "💿 本地视频"
+        else:
+            mode_text = "🌐 网络流/Alist"
+
+        session.mode_text = mode_text
+
+        if message:
+            status_msg = await message.reply_text(
+                f"🚀 启动推流 #{session.id} ({stream_width}x{stream_height}@{stream_fps}fps)...\n\n"
+                f"📄 {os.path.basename(raw_src)}\n"
+                f"🔑 {current_key_name}\n"
+                f"📡 {display_rtmp}\n"
+                f"🛠 {mode_text}"
+            )
+
+        # --- 确定推流方式 (plan)，命令由 build_stream_cmd 生成，重启时复用 ---
+        plan = {'kind': 'encode', 'width': stream_width, 'height': stream_height, 'fps': stream_fps,
+                'seekable': is_local_file, 'duration': 0}
+        session.plan = plan
+
+        # 图片模式优先使用预渲染的循环片段：画面直接封装，只实时编码音频
+        loop_clip = None
+        if (is_slideshow or is_single_image) and config.get('stream_loop_clip', 1):
+            images = background_image if is_slideshow else [background_image]
+            if status_msg:
+                await status_msg.edit_text(status_msg.text + "\n\n🎬 正在准备循环画面...")
+            loop_clip = await loop_clip_cache.get_clip(
+                images, stream_width, stream_height, stream_fps,
+                max_mb=config.get('loop_cache_max_mb', 500), in_use=stream_manager.loop_cache_files()
+            )
+
+        if loop_clip:
+            # === 图片循环片段模式 ===
+            plan.update(kind='loop', loop_clip=loop_clip)
+            mode_text += " | ⚡ 循环片段"
+
+        elif is_slideshow:
+            # === 轮播模式 ===
+            list_file = os.path.abspath(f"slideshow_list_{session.id}.txt")
+            try:
+                target_duration = 20000 
+                img_duration = 10 
+                loops_needed = int(target_duration / (len(background_image) * img_duration)) + 1
+                
+                with open(list_file, "w", encoding='utf-8') as f:
+                    for _ in range(loops_needed):
+                        for img_path in background_image:
+                            safe_path = img_path.replace("'", "'\\''")
+                            f.write(f"file '{safe_path}'\n")
+                            f.write(f"duration {img_duration}\n")
+                    if background_image:
+                         safe_path = background_image[-1].replace("'", "'\\''")
+                         f.write(f"file '{safe_path}'\n")
+            except Exception as e:
+                if status_msg: await status_msg.edit_text(f"❌ 列表生成失败: {e}")
+                stream_manager.discard(session)
+                return
+            plan.update(kind='slideshow', list_file=list_file)
+
+        elif is_single_image:
+            # === 单图模式 ===
+            plan.update(kind='single', image=background_image)
+
+        else:
+            # === 纯视频模式 ===
+            # 源文件已符合推流要求时直接封装，避免手机端全力转码
+            stream_mode, mode_reason = "encode", ""
+            info = None
+            # 有空闲时预转码好的版本则改用该本地文件 (续播/重启也使用它)
+            prepared = await prepared_catalog.lookup(media_cache_key(raw_src, is_local_file), calibration_target(config))
+            if prepared:
+                src, input_opts, is_local_file = prepared, [], True
+                session.source = prepared
+                mode_text += " | 📦 预转码版本"
+            if not src.startswith("rtmp") and (config.get('stream_passthrough', 1) or config.get('stream_adaptive', 1)):
+                info = await probe_media(src, input_opts, cache_key=media_cache_key(session.source, is_local_file))
+            if config.get('stream_passthrough', 1) and not src.startswith("rtmp"):
+                stream_mode, mode_reason = choose_stream_mode(info, config)
+                logger.info(f"Stream mode: {stream_mode} ({mode_reason})")
+
+            # 有时长的文件可从中断位置续播；直播源从当前直播重新拉取
+            live_source = src.startswith("rtmp") or (info is not None and not info.get("duration"))
+            seekable = is_local_file or (info is not None and info.get("duration", 0) > 0)
+            plan.update(kind=stream_mode, seekable=seekable, duration=(info or {}).get("duration", 0))
+            if info is not None:
+                plan.update(input_tuning=input_tuning_opts(info), maps=stream_maps(info))
+
+            if stream_mode == "encode":
+                ladder = build_encoder_ladder(config)
+                plan['profile'] = ladder[0]
+                if mode_reason:
+                    mode_text += f" | 转码 ({mode_reason})"
+                # 探测失败 (无法续播也不确定是直播) 时不做自适应
+                if config.get('stream_adaptive', 1) and (seekable or live_source) and len(ladder) > 1:
+                    session.adaptive = AdaptiveController(
+                        session, ladder, partial(_restart_encoder, session), seekable, config
+                    )
+                    mode_text += f" | 🎚 {profile_label(ladder[0])}"
+            else:
+                mode_text += f" | ⚡ 直通 ({mode_reason})"
+
+            if loop and seekable and plan['duration']:
+                plan['loop'] = True
+                source_key = media_cache_key(session.source, is_local_file)
+                cached = None
+                if stream_mode == "encode" and source_key:
+                    plan['loop_source_key'] = source_key
+                    cached = loop_video_cache.lookup(source_key, ladder)
+                if cached:
+                    plan.update(kind='cached_loop', profile=cached[0], cache_file=cached[1], seekable=False)
+                    session.adaptive = None
+                    mode_text += f" | 🔁 循环 (📦 已缓存编码 {profile_label(cached[0])})"
+                else:
+                    mode_text += " | 🔁 循环"
+            elif loop:
+                mode_text += " | 🔁 无法循环 (直播或无时长的源)"
+
+        session.mode_text = mode_text
+        cmd = build_stream_cmd(plan, src, input_opts, is_local_file, session)
+
+        if session.cancelled:
+            # 启动准备期间已被手动停止
+            if status_msg: await status_msg.edit_text(f"🛑 推流 #{session.id} 已取消")
+            return
+
+        if session.fanout:
+            session.fanout.start()
+        await session.launch(cmd)
         
-        await asyncio.sleep(4)
+        # 等待首批数据真正发出，而不是固定等待
+        ready = await session.wait_ready(config.get('stream_ready_timeout', 20))
         
-        if ffmpeg_process.poll() is not None:
-            error_log = get_log_content(800)
+        if session.process is None:
+            # 启动等待期间已被手动停止
+            return
+        if session.process.returncode is not None:
+            error_log = session.get_log(800)
             if status_msg:
-                await status_msg.edit_text(f"❌ 推流启动失败 (Exit Code: {ffmpeg_process.poll()})")
+                await status_msg.edit_text(f"❌ 推流 #{session.id} 启动失败 (Exit Code: {session.process.returncode})")
                 await message.reply_text(f"🔍 错误日志:\n{error_log}")
-            ffmpeg_process = None
+            stream_manager.discard(session)
         else:
+            if session.adaptive:
+                session.adaptive.start()
+            if config.get('stream_recover_retries', 5) > 0 or plan.get('loop'):
+                notify = message.reply_text if message else None
+                asyncio.get_running_loop().create_task(supervise_stream(session, notify))
             keyboard = InlineKeyboardMarkup([
-                 [InlineKeyboardButton("📜 实时日志", callback_data="btn_view_log")],
-                 [InlineKeyboardButton("🛑 停止推流", callback_data="btn_stop_stream_quick")]
+                 [InlineKeyboardButton("📊 实时状态", callback_data=f"btn_stream_stats:{session.id}")],
+                 [InlineKeyboardButton("📜 实时日志", callback_data=f"btn_view_log:{session.id}")],
+                 [InlineKeyboardButton("🛑 停止推流", callback_data=f"btn_stop_stream_quick:{session.id}")]
              ])
             
             if status_msg:
                 await status_msg.edit_text(
-                    f"✅ 推流运行中\n"
-                    f"PID: {ffmpeg_process.pid}\n"
-                    f"模式: {mode_text}\n"
-                    f"画质: {stream_width}x{stream_height} (自适应)\n\n"
-                    f"💡 请确保推流码已正确配置。",
+                    f"{'✅' if ready else '⏳'} 推流 #{session.id} 运行中\n"
+                    f"PID: {session.process.pid}\n"
+                    f"密钥: {current_key_name}\n"
+                    f"模式: {session.mode_text}\n"
+                    f"画质: {_quality_text(session)}\n"
+                    f"{session.metrics_text()}\n\n"
+                    + ("💡 请确保推流码已正确配置。" if ready else "⚠️ 进程已启动但尚未发出数据，请稍后查看实时状态。"),
                     reply_markup=keyboard
                 )
 
     except Exception as e:
-        if log_file:
-            try: log_file.close()
-            except: pass
-        ffmpeg_process = None
+        logger.error(f"#{session.id} 启动推流失败: {e}")
+        session.starting = False
+        stream_manager.discard(session)
+        if session.process is not None:
+            await session.stop()
         msg = f"❌ 系统异常: {str(e)}"
         if status_msg: await status_msg.edit_text(msg)
-        else: await message.reply_text(msg)
+        elif message: await message.reply_text(msg)
@@ -6,7 +6,8 @@ import time
 import asyncio
 import requests
 from .alist import get_alist_pid, check_alist_version
-from .stream import get_stream_status
+from .stream import get_stream_status, stream_manager
+from .config import get_config_cache_stats
 
 def check_program_version(cmd):
     """通用程序版本检查"""
@@ -258,6 +259,7 @@ async def get_env_report():
     alist_ver = check_alist_version()
     alist_pid = get_alist_pid()
     stream_active = get_stream_status()
+    stream_count = len(stream_manager.running())
     local_ip = get_local_ip()
     temp = get_thermal_status()
     
@@ -270,6 +272,7 @@ async def get_env_report():
     disk_usage = get_disk_usage()
     sys_uptime = get_system_uptime()
     bot_uptime = get_bot_uptime()
+    cfg_stats = get_config_cache_stats()
     
     # 检查本地端口 5244 状态
     alist_port_open = check_port_open('127.0.0.1', 5244)
@@ -285,9 +288,10 @@ async def get_env_report():
         f"🌡 **温度**: {temp}\n\n"
         f"🎥 **FFmpeg**:\n"
         f"• 状态: {'✅ ' + ffmpeg_ver if ffmpeg_ver else '❌ 未安装'}\n"
-        f"• 任务: {'🔴 推流中' if stream_active else '⚪ 空闲'}\n\n"
+        f"• 任务: {f'🔴 推流中 ({stream_count} 路)' if stream_active else '⚪ 空闲'}\n\n"
         f"🗂 **Alist**:\n"
         f"• 状态: {'✅ ' + alist_ver if alist_ver else '❌ 未安装'}\n"
         f"• 连接: {alist_status_icon} (端口5244: {'通' if alist_port_open else '不通'})\n\n"
-        f"⚙️ **资源**: CPU {cpu_usage}% | RAM {mem_usage}"
+        f"⚙️ **资源**: CPU {cpu_usage}% | RAM {mem_usage}\n"
+        f"🧠 **配置缓存**: 命中 {cfg_stats['hits']} / 重建 {cfg_stats['misses']} ({cfg_stats['hit_rate']:.0%}) | 写盘 {cfg_stats['disk_writes']}"
     )